@@ -37,6 +37,7 @@ import { getRole, onAuthChange } from './utils/auth';
 
 function App() {
   const [data, setData] = useState(null);
+  const [datasetId, setDatasetId] = useState(null); // uploaded checklist kept on the server
   const [pdfUploaded, setPdfUploaded] = useState(false);
   const [readyForDownload, setReadyForDownload] = useState(false);
   const [sessionId, setSessionId] = useState(null); // manage sessionId state
@@ -59,6 +60,11 @@ function App() {
     setReadyForDownload(false);
   }, []);
 
+  const handleDatasetChange = React.useCallback((id) => {
+    logger.info("handleDatasetChange", id);
+    setDatasetId(id || null);
+  }, []);
+
   const handlePdfUploadStatusChange = React.useCallback((uploaded) => {
     logger.info("handlePdfUploadStatusChange", uploaded);
     setPdfUploaded(!!uploaded);
@@ -108,12 +114,13 @@ function App() {
 
         {/* Two-column layout */}
         <div className="two-column-layout">
-          <ExcelUpload onDataChange={handleDataChange} />
+          <ExcelUpload onDataChange={handleDataChange} onDatasetChange={handleDatasetChange} />
           <PdfUpload onUploadStatusChange={handlePdfUploadStatusChange} />
         </div>
 
         <BatchProcessing 
           data={data}
+          datasetId={datasetId}
           pdfUploaded={pdfUploaded}
           onReadyForDownload={handleReadyForDownload}
           onDataChange={handleDataChange}
@@ -25,7 +25,7 @@
 import React, { useEffect } from 'react';
 import { useBatchQuery } from '../hooks/useBatchQuery';
 
-const BatchProcessing = ({ data, pdfUploaded, onReadyForDownload, onDataChange, onSessionIdChange, onBatchQueryStatsChange }) => {
+const BatchProcessing = ({ data, datasetId, pdfUploaded, onReadyForDownload, onDataChange, onSessionIdChange, onBatchQueryStatsChange }) => {
   const {
     batchQueryLoading,
     batchQueryProgress,
@@ -35,7 +35,9 @@ const BatchProcessing = ({ data, pdfUploaded, onReadyForDownload, onDataChange,
     batchQueryCompleted,
     batchQueryStats,
     sessionId,
+    batchCancelling,
     handleBatchQuery,
+    handleCancelBatch,
   } = useBatchQuery();
 
   // Listen for sessionId changes and notify the parent component
@@ -64,7 +66,7 @@ const BatchProcessing = ({ data, pdfUploaded, onReadyForDownload, onDataChange,
     }
   }, [batchQueryCompleted, onReadyForDownload]);
 
-  const handleStartProcessing = async () => {
+  const handleStartProcessing = async (options = {}) => {
     if (!data || data.length === 0) {
       alert('Please upload an Excel file first');
       return;
@@ -82,18 +84,36 @@ const BatchProcessing = ({ data, pdfUploaded, onReadyForDownload, onDataChange,
       if (onDataChange) {
         onDataChange(newData, { fromBatch: true });
       }
-    });
+    }, { ...options, datasetId });
   };
 
   return (
     <div className="batch-process-section">
       <button 
         className="batch-process-button"
-        onClick={handleStartProcessing}
+        onClick={() => handleStartProcessing()}
         disabled={batchQueryLoading || !data || data.length === 0 || !pdfUploaded}
       >
         {batchQueryLoading ? 'In batch processing...' : 'Start batch AI processing'}
       </button>
+      <button 
+        className="batch-process-button"
+        onClick={() => handleStartProcessing({ mode: 'retrieval', summarize: true })}
+        disabled={batchQueryLoading || !data || data.length === 0 || !pdfUploaded}
+        title="Fill every row with the best matching passages and page references right away, without calling the AI model"
+      >
+        Pre-fill evidence only (no AI)
+      </button>
+      {batchQueryLoading && (
+        <button 
+          className="stop-retry-button"
+          onClick={handleCancelBatch}
+          disabled={batchCancelling || !sessionId}
+          style={{marginLeft: '10px', backgroundColor: '#ff4444', color: 'white'}}
+        >
+          {batchCancelling ? 'Cancelling...' : 'Cancel'}
+        </button>
+      )}
       
       {/* Progress bar display */}
       {batchQueryLoading && (
@@ -25,12 +25,13 @@
 import React from 'react';
 import { useExcelUpload } from '../hooks/useExcelUpload';
 
-const ExcelUpload = ({ onDataChange }) => {
+const ExcelUpload = ({ onDataChange, onDatasetChange }) => {
   const {
     file,
     loading,
     error,
     data,
+    datasetId,
     handleFileChange,
     handleSubmit
   } = useExcelUpload();
@@ -42,6 +43,12 @@ const ExcelUpload = ({ onDataChange }) => {
     }
   }, [data, onDataChange]);
 
+  React.useEffect(() => {
+    if (onDatasetChange) {
+      onDatasetChange(datasetId);
+    }
+  }, [datasetId, onDatasetChange]);
+
   return (
     <div className="upload-section excel-section">
       <h3>1. Select Audit Template Excel File</h3>
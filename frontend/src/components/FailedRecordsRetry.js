@@ -29,6 +29,7 @@ import { useRetryFailed } from '../hooks/useRetryFailed';
 const FailedRecordsRetry = ({ 
   failedRecords, 
   data, 
+  sessionId,
   onDataChange, 
   onFailedRecordsChange, 
   onBatchCompleteChange 
@@ -53,7 +54,8 @@ const FailedRecordsRetry = ({
       onDataChange, 
       failedRecords, 
       onFailedRecordsChange, 
-      onBatchCompleteChange
+      onBatchCompleteChange,
+      sessionId
     );
   };
 
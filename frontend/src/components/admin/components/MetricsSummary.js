@@ -25,7 +25,7 @@
 
 import React from 'react';
 import StatCard from '../StatCard';
-import { fmtInt, fmtUsd2 } from '../utils/formatters';
+import { fmtInt, fmtUsd2, fmtPct } from '../utils/formatters';
 
 export default function MetricsSummary({ data }) {
   return (
@@ -55,6 +55,12 @@ export default function MetricsSummary({ data }) {
         gradient={["#fff7ed", "#fff1e6"]}
         accent="#f59e0b"
       />
+      <StatCard
+        title="Cache Hit Share"
+        value={fmtPct(data.summary?.cache_hit_ratio)}
+        gradient={["#f5f3ff", "#ede9fe"]}
+        accent="#8b5cf6"
+      />
       <StatCard
         title="Total Cost"
         value={fmtUsd2(data.summary?.total_cost)}
@@ -38,6 +38,11 @@ export function fmtUsd2(n) {
   return "$" + v.toFixed(2);
 }
 
+export function fmtPct(ratio) {
+  const v = Number(ratio) || 0;
+  return (v * 100).toFixed(1) + "%";
+}
+
 // CSV export utilities
 export function toCsv(rows) {
   if (!rows || rows.length === 0) return "";
@@ -25,6 +25,8 @@
 
 import { useState } from 'react';
 import logger from '../utils/logger';
+import { API_BASE } from '../utils/api';
+import { runJob } from '../utils/sseClient';
 
 export const useBatchQuery = () => {
   const [batchQueryLoading, setBatchQueryLoading] = useState(false);
@@ -36,14 +38,35 @@ export const useBatchQuery = () => {
   const [batchQueryStats, setBatchQueryStats] = useState({ total: 0, success: 0, failed: 0 });
   const [failedRecords, setFailedRecords] = useState([]);
   const [sessionId, setSessionId] = useState(null); // Added: store session_id
+  const [batchCancelling, setBatchCancelling] = useState(false);
 
-  const handleBatchQuery = async (data, callback) => {
+  // Cancel the running batch; rows already finished are kept and can be downloaded
+  const handleCancelBatch = async () => {
+    if (!sessionId || !batchQueryLoading) {
+      return;
+    }
+    setBatchCancelling(true);
+    try {
+      const response = await fetch(`${API_BASE}/jobs/${sessionId}/cancel`, { method: 'POST' });
+      if (response.ok) {
+        const result = await response.json();
+        logger.info('Requested to cancel batch job', { jobId: sessionId, cancellation: result.cancellation });
+      }
+    } catch (error) {
+      logger.error('Cancel batch request failed', { error: error.message });
+    }
+  };
+
+  // options.mode: 'llm' (default) or 'retrieval' (evidence passages only, no AI call)
+  // options.datasetId: id returned by /upload/, sent instead of the rows
+  const handleBatchQuery = async (data, callback, options = {}) => {
     if (!data || data.length === 0) {
       setBatchQueryError('No data available for query');
       return;
     }
 
-    logger.info('Starting batch AI query', { rowCount: data.length });
+    const mode = options.mode || 'llm';
+    logger.info('Starting batch AI query', { rowCount: data.length, mode });
     setBatchQueryLoading(true);
     setBatchQueryError('');
     setBatchQueryProgress(0);
@@ -54,98 +77,97 @@ export const useBatchQuery = () => {
     setSessionId(null); // Reset session_id
     
     try {
-      // Use a streaming API to receive real-time progress
-      const apiUrl = 'http://localhost:8000/batch-query-stream/';
-      logger.debug('Sending streaming batch query request to backend', { url: apiUrl });
-      
-      const response = await fetch(apiUrl, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          data: data
-        }),
-      });
+      // Run as a background job: it survives page reloads and server restarts, and
+      // its row events are replayed from the job store when the connection drops
+      const apiUrl = `${API_BASE}/jobs/batch`;
+      logger.debug('Submitting batch job to backend', { url: apiUrl });
 
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
+      let streamError = null;
+      let finalEvent = null;
+      const rows = new Array(data.length);
+      let received = 0;
+      await runJob(apiUrl, {
+        // With a dataset id the rows are already on the server; only post them as a fallback
+        ...(options.datasetId ? { dataset_id: options.datasetId } : { data: data }),
+        mode: mode,
+        summarize: !!options.summarize
+      }, (event) => {
+        if (event.type === 'row') {
+          // Each finished row arrives on its own, in completion order
+          if (rows[event.index] === undefined) {
+            received += 1;
+          }
+          rows[event.index] = event.row;
+          setCompletedQuestionsCount(event.completed);
+          setTotalQuestionsCount(event.total);
+          setBatchQueryProgress(event.total ? Math.round(event.completed / event.total * 10000) / 100 : 100);
+        } else if (event.type === 'failed') {
+          streamError = event.error || 'Batch query failed';
+        } else if (event.type === 'complete' || event.type === 'cancelled') {
+          finalEvent = event;
+        }
+      }, (job) => {
+        setSessionId(job.id);
+        setTotalQuestionsCount(job.total);
+        logger.info('Batch job queued', { jobId: job.id, total: job.total });
+      });
+      if (streamError) {
+        throw new Error(streamError);
       }
+      if (finalEvent) {
+        let results = rows;
+        if (received < data.length) {
+          // (after a cancel, the rows that never ran come back unprocessed)
+          // Some row events were lost beyond the replay window; fetch the stored result set once
+          const resp = await fetch(`${API_BASE}/session-data/${finalEvent.session_id}`);
+          if (!resp.ok) {
+            throw new Error(`HTTP error! status: ${resp.status}`);
+          }
+          results = (await resp.json()).data;
+        }
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
+        // Processing completed
+        setBatchQueryProgress(100);
+        setCompletedQuestionsCount(results.length);
       
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
-        
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            try {
-              const jsonData = JSON.parse(line.slice(6));
-              
-              if (jsonData.type === 'progress') {
-                // Update progress in real time
-                setBatchQueryProgress(jsonData.percentage);
-                setCompletedQuestionsCount(jsonData.completed);
-                setTotalQuestionsCount(jsonData.total);
-                logger.debug('Received progress update', { 
-                  completed: jsonData.completed, 
-                  total: jsonData.total, 
-                  percentage: jsonData.percentage 
-                });
-              } else if (jsonData.type === 'complete') {
-                // Processing completed
-                setBatchQueryProgress(100);
-                setCompletedQuestionsCount(jsonData.data.length);
-                
-                // Retrieve and store session_id
-                if (jsonData.session_id) {
-                  setSessionId(jsonData.session_id);
-                  logger.info('Received session_id for download', { session_id: jsonData.session_id });
-                }
-                
-                // Invoke callback with processed data
-                if (callback && typeof callback === 'function') {
-                  callback(jsonData.data);
-                }
-                
-                setBatchQueryCompleted(true);
-                
-                // Handle statistics
-                const statistics = jsonData.statistics || {};
-                const failedCount = statistics.failed || 0;
-                const failedIndices = statistics.failed_indices || [];
-                const successCount = statistics.success || 0;
-                const totalCount = statistics.total || jsonData.data.length;
-                
-                setBatchQueryStats({
-                  total: totalCount,
-                  success: successCount,
-                  failed: failedCount
-                });
-                
-                if (failedCount > 0) {
-                  setFailedRecords(failedIndices);
-                } else {
-                  setFailedRecords([]);
-                }
-                
-                logger.info('Batch AI query completed', { 
-                  totalRows: totalCount,
-                  successCount: successCount,
-                  failedCount: failedCount,
-                  session_id: jsonData.session_id
-                });
-              }
-            } catch (parseError) {
-              logger.warn('Failed to parse streaming data', { error: parseError.message });
-            }
-          }
+        // Retrieve and store session_id
+        if (finalEvent.session_id) {
+          setSessionId(finalEvent.session_id);
+          logger.info('Received session_id for download', { session_id: finalEvent.session_id });
         }
+      
+        // Invoke callback with processed data
+        if (callback && typeof callback === 'function') {
+          callback(results);
+        }
+      
+        setBatchQueryCompleted(true);
+      
+        // Handle statistics
+        const statistics = finalEvent.statistics || {};
+        const failedCount = statistics.failed || 0;
+        const failedIndices = statistics.failed_indices || [];
+        const successCount = statistics.success || 0;
+        const totalCount = statistics.total || results.length;
+      
+        setBatchQueryStats({
+          total: totalCount,
+          success: successCount,
+          failed: failedCount
+        });
+      
+        if (failedCount > 0) {
+          setFailedRecords(failedIndices);
+        } else {
+          setFailedRecords([]);
+        }
+      
+        logger.info('Batch AI query completed', { 
+          totalRows: totalCount,
+          successCount: successCount,
+          failedCount: failedCount,
+          session_id: finalEvent.session_id
+        });
       }
     } catch (err) {
       const errorMsg = err.message || 'Error occurred during batch query';
@@ -156,6 +178,7 @@ export const useBatchQuery = () => {
       setTotalQuestionsCount(0);
     } finally {
       setBatchQueryLoading(false);
+      setBatchCancelling(false);
     }
   };
 
@@ -169,7 +192,9 @@ export const useBatchQuery = () => {
     batchQueryStats,
     failedRecords,
     sessionId, // Added: return session_id
+    batchCancelling,
     handleBatchQuery,
+    handleCancelBatch,
     setFailedRecords,
     setBatchQueryCompleted
   };
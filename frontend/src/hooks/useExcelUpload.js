@@ -31,6 +31,7 @@ export const useExcelUpload = () => {
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
   const [data, setData] = useState(null);
+  const [datasetId, setDatasetId] = useState(null); // server-side copy of the uploaded rows
 
   const handleFileChange = (e) => {
     const selectedFile = e.target.files[0];
@@ -48,6 +49,7 @@ export const useExcelUpload = () => {
       setFile(selectedFile);
       setError('');
       setData(null); // Reset data state, need to re-upload
+      setDatasetId(null);
       logger.debug('File set to state', { fileName: selectedFile.name });
     }
   };
@@ -67,6 +69,7 @@ export const useExcelUpload = () => {
     setLoading(true);
     setError('');
     setData(null);
+    setDatasetId(null);
 
     const formData = new FormData();
     formData.append('file', file);
@@ -91,8 +94,10 @@ export const useExcelUpload = () => {
       logger.info('File uploaded successfully', { 
         fileName: file.name, 
         recordCount: result.data.length,
+        datasetId: result.dataset_id,
         responseTime: Date.now() - startTime
       });
+      setDatasetId(result.dataset_id || null);
       setData(result.data);
     } catch (err) {
       const errorMsg = err.message || 'Error occurred during upload';
@@ -109,6 +114,7 @@ export const useExcelUpload = () => {
     loading,
     error,
     data,
+    datasetId,
     handleFileChange,
     handleSubmit,
     setData
@@ -25,6 +25,8 @@
 
 import { useState } from 'react';
 import logger from '../utils/logger';
+import { API_BASE } from '../utils/api';
+import { runJob } from '../utils/sseClient';
 
 export const useRetryFailed = () => {
   const [retryLoading, setRetryLoading] = useState(false);
@@ -33,10 +35,14 @@ export const useRetryFailed = () => {
   const [retryCanStop, setRetryCanStop] = useState(false);
   const [showFailedRecords, setShowFailedRecords] = useState(false);
   const [selectedFailedIndexes, setSelectedFailedIndexes] = useState([]);
+  const [retryId, setRetryId] = useState(null); // id of the running retry job, used to cancel only it
 
   const handleStopRetry = async () => {
+    if (!retryId) {
+      return;
+    }
     try {
-      const response = await fetch('http://localhost:8000/stop-retry/', {
+      const response = await fetch(`${API_BASE}/jobs/${retryId}/cancel`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -44,7 +50,8 @@ export const useRetryFailed = () => {
       });
       
       if (response.ok) {
-        logger.info('Requested to stop retry');
+        const result = await response.json();
+        logger.info('Requested to stop retry', { retryId, cancellation: result.cancellation });
         setRetryCanStop(false);
       }
     } catch (error) {
@@ -52,7 +59,9 @@ export const useRetryFailed = () => {
     }
   };
 
-  const handleRetryFailed = async (data, setData, failedRecords, setFailedRecords, setBatchQueryCompleted) => {
+  // With sessionId the backend retries on its cached copy of the batch session (only the
+  // failed Hint/AET sub-queries) and merges the results there, so nothing is re-uploaded
+  const handleRetryFailed = async (data, setData, failedRecords, setFailedRecords, setBatchQueryCompleted, sessionId = null) => {
     if (selectedFailedIndexes.length === 0) {
       alert('Please select failed records to retry first');
       return;
@@ -65,112 +74,65 @@ export const useRetryFailed = () => {
     setRetryCanStop(true);
 
     try {
-      const retryData = selectedFailedIndexes.map(index => data[index]);
-      const apiUrl = 'http://localhost:8000/retry-failed-stream/';
-      
-      const response = await fetch(apiUrl, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          failed_indices: selectedFailedIndexes,
-          data: retryData,
-          max_retry_rounds: 10,
-          auto_retry: true
-        }),
-      });
+      // Run as a background job; each row is retried (with backoff) until it succeeds
+      // or max_retry_rounds is used up, so there are no separate rounds to report
+      const apiUrl = `${API_BASE}/jobs/retry`;
 
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
+      let streamError = null;
+      const updatedData = [...data];
+      await runJob(apiUrl, {
+        failed_indices: selectedFailedIndexes,
+        // failed_indices refer to positions in the full table
+        ...(sessionId ? { session_id: sessionId } : { data }),
+        max_retry_rounds: 10,
+        auto_retry: true
+      }, (event) => {
+        if (event.type === 'row') {
+          updatedData[event.index] = event.row;
+          setRetryProgress(event.total ? Math.round(event.completed / event.total * 10000) / 100 : 100);
+          logger.debug('Retry progress update', {
+            completed: event.completed,
+            total: event.total
+          });
+        } else if (event.type === 'failed') {
+          streamError = event.error || 'Retry failed';
+        } else if (event.type === 'cancelled') {
+          // Rows retried before the cancel are kept
+          setData(updatedData);
+          setFailedRecords((event.statistics || {}).failed_indices || failedRecords);
+          logger.info('Retry cancelled', { jobId: event.job_id });
+          setRetryCanStop(false);
+          setRetryProgress(0);
+        } else if (event.type === 'complete') {
+          setRetryProgress(100);
 
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
-      
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done) break;
-        
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
-        
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            try {
-              const jsonData = JSON.parse(line.slice(6));
-              
-              if (jsonData.type === 'progress') {
-                setRetryProgress(jsonData.percentage);
-                if (jsonData.round) {
-                  setCurrentRetryRound(jsonData.round);
-                }
-                logger.debug('Retry progress update', { 
-                  round: jsonData.round,
-                  completed: jsonData.completed, 
-                  total: jsonData.total, 
-                  percentage: jsonData.percentage 
-                });
-              } else if (jsonData.type === 'round_completed') {
-                logger.info(`Round ${jsonData.round} retry completed`, {
-                  round: jsonData.round,
-                  successCount: jsonData.success_count,
-                  failedCount: jsonData.failed_count,
-                  successIndices: jsonData.success_indices,
-                  failedIndices: jsonData.failed_indices
-                });
-                setRetryProgress(0); // Reset progress bar for next round
-              } else if (jsonData.type === 'complete') {
-                setRetryProgress(100);
-                
-                // Update retry results in original data
-                const updatedData = [...data];
-                selectedFailedIndexes.forEach((originalIndex, i) => {
-                  if (jsonData.data[i]) {
-                    updatedData[originalIndex] = jsonData.data[i];
-                  }
-                });
-                setData(updatedData);
-                
-                // Update failed records list
-                const retryStats = jsonData.retry_statistics || {};
-                if (retryStats.still_failed_indices && retryStats.still_failed_indices.length > 0) {
-                  setFailedRecords(retryStats.still_failed_indices);
-                  logger.info('Multi-round retry completed with remaining failed records', {
-                    totalRounds: jsonData.total_rounds,
-                    stopReason: jsonData.stop_reason,
-                    retrySuccess: retryStats.retry_success,
-                    stillFailed: retryStats.still_failed,
-                    skipped: retryStats.skipped || 0,
-                    stillFailedIndices: retryStats.still_failed_indices,
-                    skippedIndices: retryStats.skipped_indices || []
-                  });
-                } else {
-                  setFailedRecords([]);
-                  logger.info('Multi-round retry completed, all fixed successfully', { 
-                    totalRounds: jsonData.total_rounds,
-                    stopReason: jsonData.stop_reason,
-                    retrySuccess: retryStats.retry_success,
-                    skipped: retryStats.skipped || 0
-                  });
-                }
-                
-                setSelectedFailedIndexes([]);
-                setCurrentRetryRound(0);
-                setRetryCanStop(false);
-                setBatchQueryCompleted(true);
-                setTimeout(() => {
-                  setRetryProgress(0);
-                }, 2000);
-                break;
-              } else if (jsonData.type === 'error') {
-                throw new Error(jsonData.error || 'Retry failed');
-              }
-            } catch (parseError) {
-              logger.warn('Error parsing retry response', { error: parseError.message, line });
-            }
-          }
+          // Retried rows arrived as row events
+          setData(updatedData);
+
+          // The job's statistics cover the whole table, so its failed rows are the new list
+          const statistics = event.statistics || {};
+          const stillFailed = statistics.failed_indices || [];
+          setFailedRecords(stillFailed);
+          logger.info('Retry job completed', {
+            jobId: event.job_id,
+            retried: statistics.processed,
+            stillFailed: stillFailed.length,
+            stillFailedIndices: stillFailed
+          });
+
+          setSelectedFailedIndexes([]);
+          setRetryCanStop(false);
+          setBatchQueryCompleted(true);
+          setTimeout(() => {
+            setRetryProgress(0);
+          }, 2000);
         }
+      }, (job) => {
+        setRetryId(job.id);
+        logger.info('Retry job queued', { jobId: job.id, total: job.total });
+      });
+      if (streamError) {
+        throw new Error(streamError);
       }
     } catch (err) {
       const errorMsg = err.message || 'Error occurred during retry';
@@ -181,6 +143,7 @@ export const useRetryFailed = () => {
       setRetryCanStop(false);
     } finally {
       setRetryLoading(false);
+      setRetryId(null);
     }
   };
 
@@ -29,8 +29,10 @@
 import { getToken, saveAuth, logout, willExpireSoon, getTokenPayload } from "./auth";
 import * as logger from "./logger";
 
-const DEFAULT_BASE =
-  process.env.REACT_APP_API_BASE_URL || "http://localhost:8000";
+// Backend origin, shared with the fetch/SSE helpers that cannot go through apiFetch
+export const API_BASE = (
+  process.env.REACT_APP_API_BASE_URL || "http://localhost:8000"
+).replace(/\/+$/, "");
 
 let tokenRefresher = null; // (oldToken) => Promise<newToken|null>
 let refreshInFlight = null; // Promise<string|null>
@@ -85,8 +87,7 @@ async function runRefresherOnce(oldToken) {
  * @param {boolean} attachAuth - whether to auto attach Authorization header (default true)
  */
 export async function apiFetch(path, options = {}, attachAuth = true) {
-  const base = DEFAULT_BASE.replace(/\/+$/, "");
-  const url = `${base}${path.startsWith("/") ? path : `/${path}`}`;
+  const url = `${API_BASE}${path.startsWith("/") ? path : `/${path}`}`;
   const method = String(options.method || "GET").toUpperCase();
 
   let headers = new Headers(options.headers || {});
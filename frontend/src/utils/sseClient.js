@@ -0,0 +1,159 @@
+/*
+ * Author: Bruce Chen <bruce.chen@effem.com>
+ * Date: 2025-08-29
+ *
+ * Copyright (c) 2025 Mars Corporation
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy
+ * of this software and associated documentation files (the "Software"), to deal
+ * in the Software without restriction, including without limitation the rights
+ * to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the Software is
+ * furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in all
+ * copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ * OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+ * SOFTWARE.
+ */
+
+// Reader for the backend's resumable SSE streams (batch / retry, background jobs).
+// Events are parsed from a buffer that survives chunk boundaries; when the connection
+// drops before a terminal event, the stream is reattached (through /stream/{session_id},
+// or the resumeUrl given by the caller) with Last-Event-ID so no progress is lost.
+
+import logger from './logger';
+import { API_BASE } from './api';
+
+const TERMINAL_TYPES = ['complete', 'error', 'stopped', 'cancelled', 'failed'];
+
+const parseBlock = (block) => {
+  let id = null;
+  const dataLines = [];
+  for (const line of block.split('\n')) {
+    if (line.startsWith('id:')) {
+      id = line.slice(3).trim();
+    } else if (line.startsWith('data:')) {
+      dataLines.push(line.slice(line.startsWith('data: ') ? 6 : 5));
+    }
+    // ':' comment lines are heartbeats
+  }
+  return { id, data: dataLines.join('\n') };
+};
+
+// Read one response; returns true when a terminal event was seen
+const readResponse = async (response, state, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    let chunk;
+    try {
+      chunk = await reader.read();
+    } catch (err) {
+      logger.warn('Event stream interrupted', { error: err.message, sessionId: state.sessionId });
+      return false;
+    }
+    const { done, value } = chunk;
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, '\n');
+
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) >= 0) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      const { id, data } = parseBlock(block);
+      if (!data) continue;
+      if (id !== null) state.lastEventId = id;
+
+      let event;
+      try {
+        event = JSON.parse(data);
+      } catch (parseError) {
+        logger.warn('Failed to parse streaming data', { error: parseError.message });
+        continue;
+      }
+      if (event.type === 'session' && event.session_id) {
+        state.sessionId = event.session_id;
+      }
+      onEvent(event);
+      if (TERMINAL_TYPES.includes(event.type)) {
+        return true;
+      }
+    }
+  }
+  return false;
+};
+
+// Run a streaming request and keep following it across dropped connections.
+// onEvent receives every parsed event object (including replayed ones).
+// resumeUrl: where to reconnect when the stream is not keyed by a session event (e.g. job events)
+export const streamWithResume = async (url, fetchOptions, onEvent, { maxReconnects = 5, resumeUrl = null } = {}) => {
+  const state = { sessionId: null, lastEventId: null };
+  let attempt = 0;
+  let response = await fetch(url, fetchOptions);
+
+  while (true) {
+    if (!response.ok) {
+      // The first request failing, or the stream being gone (404), is not recoverable
+      if (attempt === 0 || response.status === 404) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+    } else {
+      if (await readResponse(response, state, onEvent)) {
+        return state;
+      }
+    }
+    const reconnectUrl = resumeUrl || (state.sessionId && `${API_BASE}/stream/${state.sessionId}`);
+    if (!reconnectUrl || attempt >= maxReconnects) {
+      throw new Error('Connection to the server was lost');
+    }
+
+    attempt += 1;
+    await new Promise((resolve) => setTimeout(resolve, Math.min(1000 * 2 ** (attempt - 1), 10000)));
+    logger.info('Reconnecting to event stream', { sessionId: state.sessionId, lastEventId: state.lastEventId, attempt });
+    try {
+      response = await fetch(reconnectUrl, {
+        headers: state.lastEventId ? { 'Last-Event-ID': state.lastEventId } : {},
+      });
+    } catch (err) {
+      response = { ok: false, status: err.message };
+    }
+  }
+};
+
+// Submit a background job (/jobs/batch, /jobs/retry) and follow its events until it finishes.
+// The job keeps running on the server if the page goes away; onSubmitted receives the job
+// record (its id cancels the job and doubles as the download session id).
+export const runJob = async (submitUrl, body, onEvent, onSubmitted = null) => {
+  const response = await fetch(submitUrl, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(body),
+  });
+  if (!response.ok) {
+    let detail = null;
+    try {
+      detail = (await response.json()).detail;
+    } catch {
+      // not a JSON error body
+    }
+    throw new Error(detail || `HTTP error! status: ${response.status}`);
+  }
+  const job = await response.json();
+  if (onSubmitted) {
+    onSubmitted(job);
+  }
+  const eventsUrl = `${API_BASE}/jobs/${job.id}/events`;
+  await streamWithResume(eventsUrl, {}, onEvent, { resumeUrl: eventsUrl });
+  return job;
+};
@@ -0,0 +1,267 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Pool of OpenAI-compatible LLM backends (endpoint + key pairs).
+
+Calls are routed with weighted least-outstanding-requests balancing. An endpoint
+that keeps failing is ejected for a cooldown (doubling on repeat ejections) and
+re-admitted automatically once the cooldown ends and a probe call succeeds.
+
+Configuration (first match wins):
+  LLM_BACKENDS_FILE  path to a JSON file with a list of backends
+  LLM_BACKENDS       the same list inline, e.g.
+    [{"name": "east", "url": "https://east/gateway", "api_key_env": "EAST_KEY", "weight": 2},
+     {"name": "mock", "url": "http://127.0.0.1:8901/v1", "api_key": "test"}]
+  otherwise a single backend built from MAX_AI_URL / MAX_API_KEY.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from llm_limiter import classify_llm_error
+
+logger = logging.getLogger(__name__)
+
+EJECT_AFTER_FAILURES = int(os.environ.get("LLM_POOL_EJECT_AFTER", "3") or 3)
+EJECT_SECONDS = float(os.environ.get("LLM_POOL_EJECT_SECONDS", "30") or 30)
+MAX_EJECT_SECONDS = float(os.environ.get("LLM_POOL_MAX_EJECT_SECONDS", "300") or 300)
+
+# Failures that are specific to one endpoint/key. Unlike the circuit breaker, 429s count:
+# they mean this key's quota is used up while other keys may still have room.
+ENDPOINT_FAILURES = {"server_error", "timeout", "connection", "rate_limit"}
+AUTH_STATUS_CODES = {401, 403}
+
+class BackendEndpoint:
+    def __init__(self, name: str, url: str, api_key: str, weight: float = 1.0,
+                 headers: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.weight = max(0.01, float(weight or 1.0))
+        self.headers = {
+            "Authorization": f"Bearer {api_key}" if api_key else "",
+            "Content-Type": "application/json",
+            **(headers or {}),
+        }
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.eject_seconds = EJECT_SECONDS
+        self.on_probation = False  # ejected before and not yet proven healthy again
+        self.probing = False
+        self.latency_ewma: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.stats = {"requests": 0, "successes": 0, "failures": 0, "ejections": 0}
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def load(self) -> float:
+        return self.outstanding / self.weight
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    try:
+        return int(status) if status is not None else None
+    except Exception:
+        return None
+
+def _load_backend_config() -> List[Dict[str, Any]]:
+    path = os.environ.get("LLM_BACKENDS_FILE", "").strip()
+    raw = ""
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                raw = f.read()
+        except Exception as e:
+            logger.error(f"Failed to read LLM_BACKENDS_FILE {path}: {e}")
+    raw = raw or os.environ.get("LLM_BACKENDS", "").strip()
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+        return [d for d in (data or []) if isinstance(d, dict)]
+    except Exception as e:
+        logger.warning(f"Invalid LLM backend pool configuration, ignoring: {e}")
+        return []
+
+class BackendPool:
+    def __init__(self, endpoints: List[BackendEndpoint]):
+        self._lock = threading.Lock()
+        self._endpoints = endpoints
+
+    @classmethod
+    def from_env(cls) -> "BackendPool":
+        endpoints: List[BackendEndpoint] = []
+        for i, item in enumerate(_load_backend_config()):
+            url = str(item.get("url") or "").strip()
+            if not url:
+                continue
+            key = item.get("api_key")
+            if not key and item.get("api_key_env"):
+                key = os.environ.get(str(item["api_key_env"]), "")
+            endpoints.append(BackendEndpoint(
+                name=str(item.get("name") or f"backend-{i + 1}"),
+                url=url,
+                api_key=str(key or ""),
+                weight=item.get("weight", 1.0),
+                headers=item.get("headers") if isinstance(item.get("headers"), dict) else None,
+            ))
+        if not endpoints:
+            endpoints.append(BackendEndpoint("default", os.environ.get("MAX_AI_URL", ""),
+                                             os.environ.get("MAX_API_KEY", "")))
+        logger.info(f"LLM backend pool: {', '.join(f'{e.name}(w={e.weight:g})' for e in endpoints)}")
+        return cls(endpoints)
+
+    def _pick(self, exclude: Optional[BackendEndpoint] = None) -> BackendEndpoint:
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for ep in self._endpoints:
+                if ep.is_ejected(now):
+                    continue
+                # Right after re-admission one probe call at a time decides the endpoint's fate
+                if ep.on_probation and ep.probing:
+                    continue
+                candidates.append(ep)
+            if exclude is not None and any(ep is not exclude for ep in candidates):
+                # Another healthy endpoint is available (e.g. for a hedged duplicate)
+                candidates = [ep for ep in candidates if ep is not exclude]
+            if candidates:
+                lowest = min(ep.load() for ep in candidates)
+                chosen = random.choice([ep for ep in candidates if ep.load() == lowest])
+            else:
+                # Everything is ejected: fail open to the endpoint that comes back first
+                chosen = min(self._endpoints, key=lambda ep: ep.ejected_until)
+            if chosen.on_probation:
+                chosen.probing = True
+            chosen.outstanding += 1
+            chosen.stats["requests"] += 1
+            return chosen
+
+    def _release(self, ep: BackendEndpoint, error: Optional[BaseException], elapsed: float,
+                 neutral: bool = False) -> None:
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            ep.probing = False
+            if neutral:
+                return
+            if error is None:
+                ep.stats["successes"] += 1
+                ep.consecutive_failures = 0
+                if ep.on_probation:
+                    ep.on_probation = False
+                    ep.eject_seconds = EJECT_SECONDS
+                    logger.info(f"[backend:{ep.name}] probe succeeded, back in rotation")
+                ep.latency_ewma = elapsed if ep.latency_ewma is None else 0.8 * ep.latency_ewma + 0.2 * elapsed
+                return
+            kind = classify_llm_error(error)
+            if kind not in ENDPOINT_FAILURES and _status_code(error) not in AUTH_STATUS_CODES:
+                # Request-level problem (bad prompt etc.): says nothing about this endpoint
+                return
+            ep.stats["failures"] += 1
+            ep.consecutive_failures += 1
+            ep.last_error = f"{kind}: {str(error)[:200]}"
+            if ep.is_ejected(time.monotonic()):
+                return
+            if ep.on_probation or ep.consecutive_failures >= EJECT_AFTER_FAILURES:
+                # A failed probe doubles the cooldown
+                if ep.on_probation:
+                    ep.eject_seconds = min(ep.eject_seconds * 2, MAX_EJECT_SECONDS)
+                ep.on_probation = True
+                ep.ejected_until = time.monotonic() + ep.eject_seconds
+                ep.stats["ejections"] += 1
+                logger.warning(f"[backend:{ep.name}] ejected for {ep.eject_seconds:.0f}s after "
+                               f"{ep.consecutive_failures} consecutive failures ({kind})")
+
+    def acquire(self, exclude: Optional[BackendEndpoint] = None) -> BackendEndpoint:
+        """
+        Pick an endpoint for a call whose outcome is not decided by one with-block (a hedged
+        duplicate); every acquire must be matched by release()
+        """
+        return self._pick(exclude)
+
+    def release(self, ep: BackendEndpoint, error: Optional[BaseException] = None, elapsed: float = 0.0,
+                neutral: bool = False) -> None:
+        """Record the outcome of an acquired call; neutral for calls cancelled before an answer"""
+        self._release(ep, error, elapsed, neutral)
+
+    @contextmanager
+    def lease(self, exclude: Optional[BackendEndpoint] = None):
+        """Pick an endpoint for one call; the outcome of the with-block is recorded against it"""
+        ep = self._pick(exclude)
+        start = time.monotonic()
+        try:
+            yield ep
+        except Exception as e:
+            self._release(ep, e, time.monotonic() - start)
+            raise
+        except BaseException:
+            # Cancelled/closed by the caller (e.g. a client disconnecting from a stream)
+            self._release(ep, None, 0.0, neutral=True)
+            raise
+        else:
+            self._release(ep, None, time.monotonic() - start)
+
+    def readmit(self, name: str) -> bool:
+        with self._lock:
+            for ep in self._endpoints:
+                if ep.name == name:
+                    ep.ejected_until = 0.0
+                    ep.consecutive_failures = 0
+                    ep.on_probation = False
+                    ep.eject_seconds = EJECT_SECONDS
+                    logger.info(f"[backend:{ep.name}] re-admitted manually")
+                    return True
+        return False
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            backends = [{
+                "name": ep.name,
+                "url": ep.url,
+                "weight": ep.weight,
+                "state": "ejected" if ep.is_ejected(now) else ("probation" if ep.on_probation else "healthy"),
+                "ejected_for_seconds": round(ep.ejected_until - now, 1) if ep.is_ejected(now) else 0.0,
+                "outstanding": ep.outstanding,
+                "consecutive_failures": ep.consecutive_failures,
+                "avg_latency_seconds": round(ep.latency_ewma, 3) if ep.latency_ewma is not None else None,
+                "last_error": ep.last_error,
+                **ep.stats,
+            } for ep in self._endpoints]
+        return {"checked_at": datetime.now().isoformat(), "backends": backends}
+
+backend_pool = BackendPool.from_env()
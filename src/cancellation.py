@@ -0,0 +1,241 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Per-session cancellation of batch runs, retries and background jobs.
+
+Each run registers a CancelToken under its session (or job) id and binds it to the
+current context. asyncio tasks and asyncio.to_thread copy the context, so the worker
+threads of that run see the token too: the LLM path checks it before waiting for a
+rate-limit slot, while waiting, and before every attempt, and raises OperationCancelled
+instead of starting a call nobody will read. Cancelling one session never touches another.
+
+Running sessions and cancel flags are also kept in the shared state backend, so a cancel
+request handled by another uvicorn worker reaches the worker running the session (its
+token polls the flag at most every CANCEL_POLL_SECONDS).
+"""
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from typing import Dict, Any, Optional, Callable
+
+import orjson
+
+from state_backend import state_backend
+
+logger = logging.getLogger(__name__)
+
+# How long a finished run's token (and its cancellation report) is kept
+CANCEL_RETENTION_SECONDS = int(os.environ.get("CANCEL_RETENTION_SECONDS", "600") or 600)
+CANCEL_POLL_SECONDS = float(os.environ.get("CANCEL_POLL_SECONDS", "1") or 1)
+# Upper bound for a run to stay listed in the backend if its worker dies
+_RUN_TTL_SECONDS = 24 * 3600
+_NS_RUNS = "runs"
+_NS_FLAGS = "cancel_flags"
+
+class OperationCancelled(Exception):
+    """Raised inside a run whose session was cancelled"""
+
+    error_type = "cancelled"
+
+_current_token: contextvars.ContextVar = contextvars.ContextVar("cancel_token", default=None)
+
+class CancelToken:
+    def __init__(self, session_id: str, kind: str, total_units: int = 0,
+                 remote_check: Optional[Callable[[str], bool]] = None):
+        self.session_id = session_id
+        self.kind = kind
+        self.total_units = total_units
+        self.completed_units = 0
+        self.tokens = {"input": 0, "output": 0, "cached": 0}
+        self.created = time.time()
+        self.cancelled_at: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._remote_check = remote_check
+        self._next_poll = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        if self._event.is_set():
+            return True
+        if self._remote_check is not None and self.finished is None:
+            now = time.monotonic()
+            if now >= self._next_poll:
+                self._next_poll = now + CANCEL_POLL_SECONDS
+                try:
+                    if self._remote_check(self.session_id):
+                        self.cancel("Cancelled by user (via another worker)")
+                except Exception as e:
+                    logger.debug(f"Cancel flag check failed for {self.session_id}: {e}")
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "Cancelled by user") -> None:
+        with self._lock:
+            if not self._event.is_set():
+                self.reason = reason
+                self.cancelled_at = time.time()
+                self._event.set()
+
+    def raise_if_cancelled(self) -> None:
+        if self.cancelled:
+            raise OperationCancelled(f"{self.kind} {self.session_id} cancelled")
+
+    def record(self, tokens: Optional[Dict[str, int]] = None, units: int = 1) -> None:
+        """Account one finished unit of work (a row) and the tokens it used"""
+        with self._lock:
+            self.completed_units += units
+            for k in self.tokens:
+                self.tokens[k] += int((tokens or {}).get(k, 0) or 0)
+
+    def report(self) -> Dict[str, Any]:
+        """Tokens spent so far and an estimate of the tokens not spent thanks to the cancel"""
+        with self._lock:
+            spent = self.tokens["input"] + self.tokens["output"]
+            remaining = max(self.total_units - self.completed_units, 0)
+            per_unit = spent / self.completed_units if self.completed_units else 0.0
+            return {
+                "session_id": self.session_id,
+                "kind": self.kind,
+                "cancelled": self._event.is_set(),
+                "reason": self.reason,
+                "units_total": self.total_units,
+                "units_completed": self.completed_units,
+                "units_skipped": remaining if self._event.is_set() else 0,
+                "tokens_spent": dict(self.tokens),
+                # Average cost of a finished unit times the units that will not run
+                "estimated_tokens_saved": int(per_unit * remaining) if self._event.is_set() else 0,
+            }
+
+class CancellationRegistry:
+    def __init__(self, backend=state_backend):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, CancelToken] = {}
+        self._stats = {"registered": 0, "cancelled": 0, "estimated_tokens_saved": 0}
+
+    def register(self, session_id: str, kind: str, total_units: int = 0) -> CancelToken:
+        token = CancelToken(session_id, kind, total_units, remote_check=self._flagged)
+        self._backend.delete(_NS_FLAGS, session_id)
+        self._backend.set(_NS_RUNS, session_id, orjson.dumps({"kind": kind, "pid": os.getpid()}), _RUN_TTL_SECONDS)
+        with self._lock:
+            self._sweep_locked()
+            previous = self._tokens.get(session_id)
+            self._tokens[session_id] = token
+            self._stats["registered"] += 1
+        if previous is not None and previous.finished is None:
+            # The same session restarted (e.g. a job resumed after a restart)
+            previous.cancel("Superseded by a new run")
+        return token
+
+    def get(self, session_id: str) -> Optional[CancelToken]:
+        with self._lock:
+            return self._tokens.get(session_id)
+
+    def cancel(self, session_id: str, kind: Optional[str] = None, reason: str = "Cancelled by user") -> Optional[Dict[str, Any]]:
+        """Cancel a running session; returns its report, or None if there is no such run"""
+        token = self.get(session_id)
+        if token is None:
+            return self._cancel_remote(session_id, kind)
+        if kind is not None and token.kind != kind:
+            return None
+        already = token.cancelled
+        token.cancel(reason)
+        report = token.report()
+        self._backend.set(_NS_FLAGS, session_id, b"1", CANCEL_RETENTION_SECONDS)
+        if not already:
+            with self._lock:
+                self._stats["cancelled"] += 1
+                self._stats["estimated_tokens_saved"] += report["estimated_tokens_saved"]
+            logger.info(f"Cancelled {token.kind} {session_id}: {report['units_completed']}/{report['units_total']} done, "
+                        f"~{report['estimated_tokens_saved']} tokens saved")
+        return report
+
+    def _cancel_remote(self, session_id: str, kind: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Flag a session running in another worker process; it stops at its next poll"""
+        raw = self._backend.get(_NS_RUNS, session_id)
+        if raw is None:
+            return None
+        run = orjson.loads(raw)
+        if kind is not None and run.get("kind") != kind:
+            return None
+        self._backend.set(_NS_FLAGS, session_id, b"1", CANCEL_RETENTION_SECONDS)
+        with self._lock:
+            self._stats["cancelled"] += 1
+        logger.info(f"Flagged {run.get('kind')} {session_id} (worker pid {run.get('pid')}) for cancellation")
+        # Spent/saved figures are only known to the worker running it (sent in its final event)
+        return {"session_id": session_id, "kind": run.get("kind"), "cancelled": True,
+                "reason": "Cancelled by user", "remote": True}
+
+    def _flagged(self, session_id: str) -> bool:
+        return self._backend.get(_NS_FLAGS, session_id) is not None
+
+    def is_cancelled(self, session_id: str) -> bool:
+        token = self.get(session_id)
+        return bool(token and token.cancelled)
+
+    def finish(self, token: CancelToken) -> None:
+        token.finished = time.time()
+        self._backend.delete(_NS_RUNS, token.session_id)
+
+    def _sweep_locked(self) -> None:
+        cutoff = time.time() - CANCEL_RETENTION_SECONDS
+        for sid in [sid for sid, t in self._tokens.items() if t.finished is not None and t.finished < cutoff]:
+            del self._tokens[sid]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._sweep_locked()
+            active = [t for t in self._tokens.values() if t.finished is None]
+            return {
+                "active": len(active),
+                "active_by_kind": {kind: sum(1 for t in active if t.kind == kind) for kind in {t.kind for t in active}},
+                "cancelling": sum(1 for t in active if t.cancelled),
+                **self._stats,
+            }
+
+def bind(token: Optional[CancelToken]) -> None:
+    """Make token the current run's token (inherited by tasks and to_thread workers started afterwards)"""
+    _current_token.set(token)
+
+def current_token() -> Optional[CancelToken]:
+    return _current_token.get()
+
+def current_cancelled() -> bool:
+    token = _current_token.get()
+    return bool(token and token.cancelled)
+
+def check_cancelled() -> None:
+    """Raise OperationCancelled if the run this code executes for was cancelled"""
+    token = _current_token.get()
+    if token is not None:
+        token.raise_if_cancelled()
+
+cancel_registry = CancellationRegistry()
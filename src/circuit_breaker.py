@@ -0,0 +1,199 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Circuit breaker around the LLM backend.
+
+closed    -> calls go through; outcomes are kept in a sliding window
+open      -> calls fail fast with CircuitOpenError until the cooldown ends
+half_open -> a limited number of probe calls decide between closed and open
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SIZE = int(os.environ.get("LLM_CB_WINDOW", "20") or 20)
+WINDOW_SECONDS = float(os.environ.get("LLM_CB_WINDOW_SECONDS", "120") or 120)
+MIN_CALLS = int(os.environ.get("LLM_CB_MIN_CALLS", "5") or 5)
+ERROR_RATE_THRESHOLD = float(os.environ.get("LLM_CB_ERROR_RATE", "0.5") or 0.5)
+CONSECUTIVE_TIMEOUTS = int(os.environ.get("LLM_CB_CONSECUTIVE_TIMEOUTS", "3") or 3)
+OPEN_SECONDS = float(os.environ.get("LLM_CB_OPEN_SECONDS", "30") or 30)
+MAX_OPEN_SECONDS = float(os.environ.get("LLM_CB_MAX_OPEN_SECONDS", "300") or 300)
+HALF_OPEN_PROBES = int(os.environ.get("LLM_CB_HALF_OPEN_PROBES", "1") or 1)
+
+# Error classes (see llm_limiter.classify_llm_error) that say the backend is unhealthy.
+# 429s are throttling and handled by the rate limiter; 4xx are request problems.
+BACKEND_FAILURES = {"server_error", "timeout", "connection"}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the LLM while the circuit is open"""
+
+    error_type = "circuit_open"
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"AI service circuit is open; retry after {retry_after:.0f}s")
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._outcomes: deque = deque(maxlen=WINDOW_SIZE)  # (monotonic_ts, ok: bool)
+        self._consecutive_timeouts = 0
+        self._opened_at = 0.0
+        self._open_seconds = OPEN_SECONDS
+        self._probes_in_flight = 0
+        self._last_error: Optional[str] = None
+        self._last_state_change = datetime.now()
+        self._stats = {"opened": 0, "rejected": 0, "successes": 0, "failures": 0}
+
+    def _set_state(self, state: str, reason: str = "") -> None:
+        if state == self._state:
+            return
+        logger.warning(f"[circuit:{self.name}] {self._state} -> {state}{f' ({reason})' if reason else ''}")
+        self._state = state
+        self._last_state_change = datetime.now()
+
+    def _refresh(self, now: float) -> None:
+        if self._state == OPEN and now - self._opened_at >= self._open_seconds:
+            self._set_state(HALF_OPEN, "cooldown elapsed")
+            self._probes_in_flight = 0
+
+    def _trip(self, now: float, reason: str) -> None:
+        # Back-to-back trips (failed probe) double the cooldown up to MAX_OPEN_SECONDS
+        if self._state == HALF_OPEN:
+            self._open_seconds = min(self._open_seconds * 2, MAX_OPEN_SECONDS)
+        else:
+            self._open_seconds = OPEN_SECONDS
+        self._opened_at = now
+        self._stats["opened"] += 1
+        self._set_state(OPEN, reason)
+
+    def allow_request(self) -> None:
+        """Raise CircuitOpenError if the call must fail fast; otherwise admit it"""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and self._probes_in_flight < HALF_OPEN_PROBES:
+                self._probes_in_flight += 1
+                return
+            self._stats["rejected"] += 1
+            retry_after = max(0.0, self._open_seconds - (now - self._opened_at)) if self._state == OPEN else 1.0
+        raise CircuitOpenError(retry_after)
+
+    def record_success(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._stats["successes"] += 1
+            self._consecutive_timeouts = 0
+            self._outcomes.append((now, True))
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._outcomes.clear()
+                self._open_seconds = OPEN_SECONDS
+                self._set_state(CLOSED, "probe succeeded")
+
+    def record_failure(self, kind: str, detail: str = "") -> None:
+        """Record a failed call; only backend-health failures count towards tripping"""
+        if kind not in BACKEND_FAILURES:
+            self.record_neutral()
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._stats["failures"] += 1
+            self._last_error = f"{kind}: {detail[:200]}" if detail else kind
+            self._outcomes.append((now, False))
+            self._consecutive_timeouts = self._consecutive_timeouts + 1 if kind == "timeout" else 0
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                self._trip(now, f"probe failed ({kind})")
+                return
+            if self._state != CLOSED:
+                return
+            if self._consecutive_timeouts >= CONSECUTIVE_TIMEOUTS:
+                self._trip(now, f"{self._consecutive_timeouts} consecutive timeouts")
+                return
+            recent = [ok for ts, ok in self._outcomes if now - ts <= WINDOW_SECONDS]
+            if len(recent) >= MIN_CALLS:
+                error_rate = recent.count(False) / len(recent)
+                if error_rate >= ERROR_RATE_THRESHOLD:
+                    self._trip(now, f"error rate {error_rate:.0%} over last {len(recent)} calls")
+
+    def record_neutral(self) -> None:
+        """Call finished without telling us anything about backend health (e.g. 429, 4xx)"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def seconds_until_retry(self) -> float:
+        """0 when calls are admitted now, otherwise the remaining open cooldown"""
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self._open_seconds - (now - self._opened_at))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._outcomes.clear()
+            self._consecutive_timeouts = 0
+            self._probes_in_flight = 0
+            self._open_seconds = OPEN_SECONDS
+            self._set_state(CLOSED, "manual reset")
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            self._refresh(now)
+            recent = [ok for ts, ok in self._outcomes if now - ts <= WINDOW_SECONDS]
+            return {
+                "name": self.name,
+                "state": self._state,
+                "since": self._last_state_change.isoformat(),
+                "retry_after_seconds": round(max(0.0, self._open_seconds - (now - self._opened_at)), 1) if self._state == OPEN else 0.0,
+                "window_calls": len(recent),
+                "window_error_rate": round(recent.count(False) / len(recent), 3) if recent else 0.0,
+                "consecutive_timeouts": self._consecutive_timeouts,
+                "last_error": self._last_error,
+                **self._stats,
+            }
+
+# Shared breaker for the MAX_AI endpoint
+llm_breaker = CircuitBreaker("llm")
@@ -0,0 +1,173 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Clause-number index built at ingestion time.
+
+Standards PDFs (FSSC22000, BRCGS, ...) label their sections "2.5.4 Title". While the
+chunks are created, every clause heading is mapped to the chunks that belong to it,
+so a checklist row whose Element/Criteria names a clause resolves to its chunks
+with a dict lookup instead of an embedding + ANN search.
+"""
+
+import os
+import re
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CLAUSE_INDEX_ENABLED = str(os.environ.get("CLAUSE_INDEX_ENABLED", "true")).lower() in ("1", "true", "yes")
+# Short ids such as "1.1" are too ambiguous to trust without vector search
+MIN_CLAUSE_DEPTH = int(os.environ.get("CLAUSE_INDEX_MIN_DEPTH", "3") or 3)
+# Template prefixes whose numbers belong to another protocol (comma separated, e.g. "QMPv3,MQM")
+IGNORE_PREFIXES = [p.strip() for p in os.environ.get("CLAUSE_INDEX_IGNORE_PREFIXES", "").split(",") if p.strip()]
+
+# "2.5.4 Title" / "2.5.4. Title" / "Clause 2.5.4 Title" at the start of a line
+# (the title must start with a letter so "12.5 kg" style lines are not taken as headings)
+_HEADING_RE = re.compile(r"^\s*(?:clause|section|条款)?\s*(\d{1,2}(?:\.\d{1,3}){1,4})\.?\s+[A-Za-z\u4e00-\u9fff]", re.IGNORECASE | re.MULTILINE)
+# Clause ids anywhere in an Element/Criteria cell, optionally preceded by a prefix word
+_REFERENCE_RE = re.compile(r"(?:(?P<prefix>[A-Za-z][\w\-]*)\s+)?(?<![\d.])(?P<clause>\d{1,2}(?:\.\d{1,3}){1,4})(?![\d])")
+
+def _depth(clause_id: str) -> int:
+    return clause_id.count(".") + 1
+
+def _normalize(clause_id: str) -> str:
+    return ".".join(str(int(p)) for p in clause_id.strip(".").split("."))
+
+def extract_clause_refs(text: str) -> List[str]:
+    """Clause ids referenced by a template cell, in order of appearance"""
+    refs: List[str] = []
+    ignored = {p.lower() for p in IGNORE_PREFIXES}
+    for m in _REFERENCE_RE.finditer(str(text or "")):
+        prefix = (m.group("prefix") or "").lower()
+        if prefix and prefix in ignored:
+            continue
+        clause = _normalize(m.group("clause"))
+        if _depth(clause) >= MIN_CLAUSE_DEPTH and clause not in refs:
+            refs.append(clause)
+    return refs
+
+def row_clause_text(row: Dict[str, Any]) -> str:
+    """Template cells that may name a clause (Element, Criteria)"""
+    parts = []
+    for key in ("Element", "Criteria"):
+        val = row.get(key)
+        if val is not None and str(val).strip() and str(val).strip().lower() != "nan":
+            parts.append(str(val))
+    return "\n".join(parts)
+
+class ClauseIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clauses: Dict[str, List[str]] = {}  # clause id -> chunk ids (document order)
+        self._pages: Dict[str, List[int]] = {}  # clause id -> pages
+        self._built_at: Optional[datetime] = None
+        self._stats = {"lookups": 0, "hits": 0}
+
+    def build(self, documents) -> int:
+        """
+        Rebuild from the ingested LangChain Documents (chunk order = document order).
+        A chunk belongs to the clause active at its start and to every clause heading inside it.
+        """
+        clauses: Dict[str, List[str]] = {}
+        pages: Dict[str, List[int]] = {}
+        current: Optional[str] = None
+        current_source = None
+        for doc in documents:
+            meta = doc.metadata or {}
+            if meta.get("source") != current_source:
+                current, current_source = None, meta.get("source")
+            chunk_id = meta.get("chunk_id")
+            owners = [current] if current else []
+            for m in _HEADING_RE.finditer(doc.page_content or ""):
+                clause = _normalize(m.group(1))
+                if _depth(clause) < 2:
+                    continue
+                owners.append(clause)
+                current = clause
+            for clause in owners:
+                ids = clauses.setdefault(clause, [])
+                if chunk_id not in ids:
+                    ids.append(chunk_id)
+                page_list = pages.setdefault(clause, [])
+                if meta.get("page") not in page_list:
+                    page_list.append(meta.get("page"))
+        with self._lock:
+            self._clauses = clauses
+            self._pages = pages
+            self._built_at = datetime.now()
+        logger.info(f"Clause index built: {len(clauses)} clauses over {len(documents)} chunks")
+        return len(clauses)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clauses = {}
+            self._pages = {}
+            self._built_at = None
+
+    def lookup(self, text: str, limit: int = 5) -> List[str]:
+        """
+        Chunk ids for the clauses referenced in `text` (exact clause first, then its sub-clauses).
+        Empty when nothing is referenced or the referenced clauses are not in the PDF.
+        """
+        if not CLAUSE_INDEX_ENABLED:
+            return []
+        refs = extract_clause_refs(text)
+        if not refs:
+            return []
+        with self._lock:
+            if not self._clauses:
+                return []
+            self._stats["lookups"] += 1
+            chunk_ids: List[str] = []
+            for ref in refs:
+                matched = self._clauses.get(ref)
+                if matched is None:
+                    children = sorted(k for k in self._clauses if k.startswith(ref + "."))
+                    matched = [cid for k in children for cid in self._clauses[k]]
+                for cid in matched:
+                    if cid not in chunk_ids:
+                        chunk_ids.append(cid)
+            if chunk_ids:
+                self._stats["hits"] += 1
+        return chunk_ids[:limit]
+
+    def pages_for(self, clause_id: str) -> List[int]:
+        with self._lock:
+            return list(self._pages.get(_normalize(clause_id), []))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": CLAUSE_INDEX_ENABLED,
+                "clauses": len(self._clauses),
+                "built_at": self._built_at.isoformat() if self._built_at else None,
+                **self._stats,
+            }
+
+clause_index = ClauseIndex()
@@ -0,0 +1,213 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Server-side storage of uploaded checklists.
+
+/upload/ stores the parsed template once and returns a dataset id; batch, retry and
+job requests then send {"dataset_id": ..., "rows": [...]} instead of posting every row
+back. A dataset is kept columnar (column names once, one value list per column),
+orjson-encoded and zstd-compressed on disk, with a few recently used datasets decoded
+in memory. The id is a content hash, so uploading the same file again reuses it.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Iterable
+
+import orjson
+import zstandard
+
+from config import AUTH_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+DATASET_DIR = os.getenv("DATASET_DIR", os.path.join(os.path.dirname(os.path.abspath(AUTH_DB_PATH)), "datasets"))
+DATASET_TTL_HOURS = float(os.environ.get("DATASET_TTL_HOURS", "24") or 24)
+DATASET_CACHE_ENTRIES = int(os.environ.get("DATASET_CACHE_ENTRIES", "8") or 8)
+_ZSTD_LEVEL = 3
+# Reads push a dataset's expiry forward at most this often (one utime per dataset, not per request)
+_TOUCH_INTERVAL_SECONDS = 300
+
+class DatasetNotFound(KeyError):
+    pass
+
+def _to_columnar(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    columns: List[str] = []
+    seen = set()
+    for rec in records:
+        for key in rec:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+    values = {str(col): [rec.get(col) for rec in records] for col in columns}
+    return {"columns": [str(c) for c in columns], "rows": len(records), "values": values}
+
+def _encode(table: Dict[str, Any]) -> bytes:
+    # NaN cells become null; timestamps and other cell types are stringified
+    return orjson.dumps(table, default=str)
+
+class DatasetStore:
+    def __init__(self, directory: str = DATASET_DIR):
+        self._dir = directory
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._stats = {"stored": 0, "reused": 0, "loads": 0, "memory_hits": 0, "expired": 0}
+
+    def _path(self, dataset_id: str) -> str:
+        # ids are hex digests; anything else cannot name a file
+        if not dataset_id or not all(c in "0123456789abcdef" for c in dataset_id):
+            raise DatasetNotFound(dataset_id)
+        return os.path.join(self._dir, f"{dataset_id}.json.zst")
+
+    def _remember(self, dataset_id: str, table: Dict[str, Any]) -> None:
+        with self._lock:
+            self._cache[dataset_id] = table
+            self._cache.move_to_end(dataset_id)
+            while len(self._cache) > DATASET_CACHE_ENTRIES:
+                self._cache.popitem(last=False)
+
+    def _touch(self, dataset_id: str) -> None:
+        """Refresh the file mtime so the TTL counts from the last use, not the upload"""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(dataset_id, 0.0) < _TOUCH_INTERVAL_SECONDS:
+                return
+            self._touched[dataset_id] = now
+        try:
+            os.utime(self._path(dataset_id), None)
+        except OSError:
+            pass
+
+    def put(self, records: List[Dict[str, Any]], filename: Optional[str] = None) -> str:
+        """Store parsed template rows; returns the dataset id"""
+        table = _to_columnar(records)
+        table["filename"] = filename
+        raw = _encode({k: v for k, v in table.items() if k != "filename"})
+        dataset_id = hashlib.sha256(raw).hexdigest()[:24]
+        path = self._path(dataset_id)
+        os.makedirs(self._dir, exist_ok=True)
+        if os.path.exists(path):
+            # Same content uploaded again: refresh its expiry
+            os.utime(path, None)
+            with self._lock:
+                self._touched[dataset_id] = time.time()
+                self._stats["reused"] += 1
+        else:
+            compressed = zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(_encode(table))
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp, path)
+            with self._lock:
+                self._touched[dataset_id] = time.time()
+                self._stats["stored"] += 1
+            logger.info(f"Stored dataset {dataset_id} ({table['rows']} rows, {len(table['columns'])} columns, "
+                        f"{len(raw)} -> {len(compressed)} bytes)")
+        self._remember(dataset_id, orjson.loads(_encode(table)))
+        self.sweep()
+        return dataset_id
+
+    def _load(self, dataset_id: str) -> Dict[str, Any]:
+        with self._lock:
+            table = self._cache.get(dataset_id)
+            if table is not None:
+                self._cache.move_to_end(dataset_id)
+                self._stats["memory_hits"] += 1
+        if table is not None:
+            self._touch(dataset_id)
+            return table
+        path = self._path(dataset_id)
+        try:
+            with open(path, "rb") as f:
+                compressed = f.read()
+        except FileNotFoundError:
+            raise DatasetNotFound(dataset_id)
+        table = orjson.loads(zstandard.ZstdDecompressor().decompress(compressed))
+        with self._lock:
+            self._stats["loads"] += 1
+        self._remember(dataset_id, table)
+        self._touch(dataset_id)
+        return table
+
+    def get_rows(self, dataset_id: str, indices: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+        """Rows of a dataset as dicts (only the selected ones when indices is given)"""
+        table = self._load(dataset_id)
+        total = table["rows"]
+        selected = range(total) if indices is None else list(indices)
+        for i in selected:
+            if not 0 <= i < total:
+                raise IndexError(f"Row {i} out of range for dataset {dataset_id} ({total} rows)")
+        columns = table["columns"]
+        values = table["values"]
+        return [{col: values[col][i] for col in columns} for i in selected]
+
+    def info(self, dataset_id: str) -> Dict[str, Any]:
+        table = self._load(dataset_id)
+        return {"dataset_id": dataset_id, "rows": table["rows"], "columns": table["columns"],
+                "filename": table.get("filename")}
+
+    def sweep(self) -> int:
+        """Delete datasets not used for DATASET_TTL_HOURS"""
+        if not os.path.isdir(self._dir):
+            return 0
+        cutoff = time.time() - DATASET_TTL_HOURS * 3600
+        removed = 0
+        for name in os.listdir(self._dir):
+            path = os.path.join(self._dir, name)
+            try:
+                if name.endswith(".json.zst") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    with self._lock:
+                        self._cache.pop(name[:-len(".json.zst")], None)
+                        self._touched.pop(name[:-len(".json.zst")], None)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            with self._lock:
+                self._stats["expired"] += removed
+            logger.info(f"Removed {removed} expired dataset(s)")
+        return removed
+
+    def snapshot(self) -> Dict[str, Any]:
+        files = [n for n in os.listdir(self._dir) if n.endswith(".json.zst")] if os.path.isdir(self._dir) else []
+        disk_bytes = sum(os.path.getsize(os.path.join(self._dir, n)) for n in files)
+        with self._lock:
+            return {
+                "directory": self._dir,
+                "datasets": len(files),
+                "disk_bytes": disk_bytes,
+                "in_memory": len(self._cache),
+                "ttl_hours": DATASET_TTL_HOURS,
+                **self._stats,
+            }
+
+dataset_store = DatasetStore()
@@ -0,0 +1,495 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Embedding model, in-process or shared by all API workers through an embedding server.
+
+EMBEDDING_SERVICE=local (default) -> every process loads the sentence-transformers model
+                                     itself (one copy of torch + model per worker)
+EMBEDDING_SERVICE=remote          -> processes send texts over a local socket (Unix socket,
+                                     or host:port; loopback TCP on Windows) to one embedding
+                                     server that holds the only model instance
+
+The server merges concurrent requests from all workers and ingestion runs into batches of
+up to EMBEDDING_BATCH_SIZE texts, waiting at most EMBEDDING_BATCH_WAIT_MS for more to
+arrive. Start it with `python embedding_service.py`; main.py starts it automatically in
+remote mode when nothing is listening yet.
+
+Messages are length-prefixed orjson frames (never pickle). Each connection starts with
+a mutual HMAC challenge on a shared key: EMBEDDING_SERVICE_AUTHKEY, or else a random key
+the server writes to EMBEDDING_SERVICE_KEY_FILE (mode 0600) for the clients on the same
+host. The default Unix socket lives in a private (0700) per-user directory and is 0600
+itself.
+"""
+
+import os
+import sys
+import hmac
+import stat
+import time
+import queue
+import socket
+import struct
+import hashlib
+import logging
+import secrets
+import tempfile
+import threading
+from typing import Dict, Any, List, Optional, Union, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    # Standalone server: read .env before the settings below
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"), override=False)
+    except Exception:
+        pass
+
+# Define the embedding models (provider + fallback to local)
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "local").lower()
+EMBEDDING_HF_ID = os.environ.get("EMBEDDING_HF_ID", "BAAI/bge-small-en-v1.5")
+EMBEDDING_MS_ID = os.environ.get("EMBEDDING_MS_ID", "AI-ModelScope/bge-small-en-v1.5")
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_LOCAL_DIR = os.environ.get(
+    "EMBEDDING_LOCAL_DIR",
+    os.path.join(project_root, "models", "AI-ModelScope", "bge-small-en-v1___5"),
+)
+
+EMBEDDING_SERVICE = (os.environ.get("EMBEDDING_SERVICE", "local") or "local").strip().lower()
+# Per-user directory for the socket and generated key; nobody else may list or enter it
+_RUNTIME_DIR = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+                            f"cbi-embeddings-{os.getuid()}" if hasattr(os, "getuid") else "cbi-embeddings")
+# No Unix sockets on Windows: loopback TCP (still authenticated)
+_DEFAULT_ADDRESS = "127.0.0.1:47821" if sys.platform == "win32" else os.path.join(_RUNTIME_DIR, "embeddings.sock")
+EMBEDDING_SERVICE_ADDRESS = os.environ.get("EMBEDDING_SERVICE_ADDRESS") or _DEFAULT_ADDRESS
+EMBEDDING_SERVICE_KEY_FILE = os.environ.get("EMBEDDING_SERVICE_KEY_FILE") or os.path.join(_RUNTIME_DIR, "embeddings.key")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64") or 64)
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", "5") or 5)
+
+def resolve_embedding_model() -> str:
+    try:
+        if EMBEDDING_PROVIDER == "local":
+            if os.path.isdir(EMBEDDING_LOCAL_DIR):
+                logger.info(f"Using local embedding model: {EMBEDDING_LOCAL_DIR}")
+                return EMBEDDING_LOCAL_DIR
+            raise FileNotFoundError(f"Local embedding dir not found: {EMBEDDING_LOCAL_DIR}")
+
+        if EMBEDDING_PROVIDER == "modelscope":
+            try:
+                from modelscope.hub.snapshot_download import snapshot_download
+            except Exception as e:
+                logger.warning(f"ModelScope not available: {e}. Falling back to local/HF.")
+            else:
+                cache_dir = os.path.join(project_root, "models")
+                os.makedirs(cache_dir, exist_ok=True)
+                model_dir = snapshot_download(EMBEDDING_MS_ID, cache_dir=cache_dir)
+                logger.info(f"ModelScope model ready at: {model_dir}")
+                return model_dir
+
+        logger.info(f"Using HF embedding model id: {EMBEDDING_HF_ID}")
+        return EMBEDDING_HF_ID
+    except Exception as e:
+        logger.error(f"Resolve embedding model failed: {e}", exc_info=True)
+        if os.path.isdir(EMBEDDING_LOCAL_DIR):
+            logger.info(f"Falling back to local embedding at {EMBEDDING_LOCAL_DIR}")
+            return EMBEDDING_LOCAL_DIR
+        return EMBEDDING_HF_ID
+
+def _parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """host:port for TCP; anything else is a Unix socket path"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and host and "/" not in host and "\\" not in host:
+        return host, int(port)
+    return address
+
+def _ensure_private_dir(path: str) -> None:
+    """Create path as 0700, or check that an existing one is ours and closed to others"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name != "posix":
+        return
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by this user with mode 0700")
+
+def _read_key_file(path: str) -> bytes:
+    if os.name == "posix":
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise RuntimeError(f"Embedding key file {path} must be a file owned by this user with mode 0600")
+    with open(path, "rb") as f:
+        key = f.read().strip()
+    if not key:
+        raise RuntimeError(f"Embedding key file {path} is empty")
+    return key
+
+def _load_authkey(create: bool = False) -> bytes:
+    """
+    EMBEDDING_SERVICE_AUTHKEY, else the key file. The server (create=True) generates a
+    random key into the file on first start; clients only read it. Without either there
+    is no key and nothing connects.
+    """
+    env_key = os.environ.get("EMBEDDING_SERVICE_AUTHKEY")
+    if env_key:
+        return env_key.encode()
+    path = EMBEDDING_SERVICE_KEY_FILE
+    if create:
+        if path.startswith(_RUNTIME_DIR + os.sep):
+            _ensure_private_dir(_RUNTIME_DIR)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_hex(32).encode())
+            logger.info(f"Generated embedding server key in {path}")
+    try:
+        return _read_key_file(path)
+    except FileNotFoundError:
+        raise RuntimeError("No embedding server key: set EMBEDDING_SERVICE_AUTHKEY or start the embedding "
+                           f"server first (it writes {path})") from None
+
+# ---------- wire protocol ----------
+# Every message is a 4-byte big-endian length followed by an orjson document
+
+_HEADER = struct.Struct("!I")
+_HANDSHAKE_MAX_BYTES = 1024
+_FRAME_MAX_BYTES = 512 * 1024 * 1024
+_HANDSHAKE_TIMEOUT = 10.0
+
+def _send(sock: socket.socket, msg: Dict[str, Any]) -> None:
+    body = orjson.dumps(msg, option=orjson.OPT_SERIALIZE_NUMPY)
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Embedding connection closed")
+        buf += chunk
+    return bytes(buf)
+
+def _recv(sock: socket.socket, limit: int = _FRAME_MAX_BYTES) -> Dict[str, Any]:
+    (size,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if size > limit:
+        raise ConnectionError(f"Embedding frame of {size} bytes exceeds the {limit} byte limit")
+    msg = orjson.loads(_recv_exact(sock, size))
+    if not isinstance(msg, dict):
+        raise ConnectionError("Malformed embedding message")
+    return msg
+
+def _digest(key: bytes, label: bytes, challenge: str) -> str:
+    # Distinct labels per direction, so one side's answer cannot be replayed as the other's
+    return hmac.new(key, label + challenge.encode(), hashlib.sha256).hexdigest()
+
+def _server_handshake(sock: socket.socket, key: bytes) -> None:
+    challenge = secrets.token_hex(32)
+    _send(sock, {"challenge": challenge})
+    reply = _recv(sock, _HANDSHAKE_MAX_BYTES)
+    if not hmac.compare_digest(str(reply.get("response", "")), _digest(key, b"client", challenge)):
+        _send(sock, {"ok": False, "error": "authentication failed"})
+        raise PermissionError("Embedding client failed authentication")
+    _send(sock, {"ok": True, "response": _digest(key, b"server", str(reply.get("challenge", "")))})
+
+def _client_handshake(sock: socket.socket, key: bytes) -> None:
+    challenge = secrets.token_hex(32)
+    hello = _recv(sock, _HANDSHAKE_MAX_BYTES)
+    _send(sock, {"response": _digest(key, b"client", str(hello.get("challenge", ""))), "challenge": challenge})
+    reply = _recv(sock, _HANDSHAKE_MAX_BYTES)
+    if not reply.get("ok"):
+        raise PermissionError(f"Embedding server refused the connection: {reply.get('error')} (different key?)")
+    if not hmac.compare_digest(str(reply.get("response", "")), _digest(key, b"server", challenge)):
+        raise PermissionError("Embedding server failed authentication (different key?)")
+
+def _connect(address: Union[str, Tuple[str, int]], key: bytes) -> socket.socket:
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(_HANDSHAKE_TIMEOUT)
+        sock.connect(address)
+        _client_handshake(sock, key)
+        sock.settimeout(None)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+# ---------- server ----------
+
+class _Pending:
+    __slots__ = ("texts", "done", "result", "error")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[str] = None
+
+class EmbeddingServer:
+    def __init__(self, address: str = EMBEDDING_SERVICE_ADDRESS, model_name: Optional[str] = None):
+        self._address = _parse_address(address)
+        self._key = _load_authkey(create=True)
+        self._model_name = model_name or resolve_embedding_model()
+        self._model = None
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "max_batch": 0, "errors": 0,
+                       "encode_seconds": 0.0, "connections": 0}
+
+    def _load_model(self) -> None:
+        from sentence_transformers import SentenceTransformer
+        started = time.monotonic()
+        self._model = SentenceTransformer(self._model_name)
+        logger.info(f"Embedding model {self._model_name} loaded in {time.monotonic() - started:.1f}s")
+
+    def _batch_loop(self) -> None:
+        wait = EMBEDDING_BATCH_WAIT_MS / 1000.0
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0].texts)
+            deadline = time.monotonic() + wait
+            while count < EMBEDDING_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item.texts)
+
+            texts = [t for item in batch for t in item.texts]
+            started = time.monotonic()
+            try:
+                # Same call as chromadb's SentenceTransformerEmbeddingFunction
+                vectors = self._model.encode(texts, convert_to_numpy=True, normalize_embeddings=False)
+                offset = 0
+                for item in batch:
+                    item.result = vectors[offset:offset + len(item.texts)]
+                    offset += len(item.texts)
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(texts)} texts failed: {e}", exc_info=True)
+                for item in batch:
+                    item.error = str(e)
+                with self._lock:
+                    self._stats["errors"] += 1
+            with self._lock:
+                self._stats["batches"] += 1
+                self._stats["texts"] += len(texts)
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(texts))
+                self._stats["encode_seconds"] += time.monotonic() - started
+            for item in batch:
+                item.done.set()
+
+    def _serve(self, conn: socket.socket) -> None:
+        try:
+            conn.settimeout(_HANDSHAKE_TIMEOUT)
+            try:
+                _server_handshake(conn, self._key)
+            except (PermissionError, ValueError) as e:
+                logger.warning(f"Embedding server rejected a connection: {e}")
+                return
+            conn.settimeout(None)
+            with self._lock:
+                self._stats["connections"] += 1
+            while True:
+                msg = _recv(conn)
+                op = msg.get("op")
+                if op == "embed":
+                    texts = msg.get("texts") or []
+                    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                        _send(conn, {"ok": False, "error": "texts must be a list of strings"})
+                        continue
+                    pending = _Pending(texts)
+                    with self._lock:
+                        self._stats["requests"] += 1
+                    if pending.texts:
+                        self._queue.put(pending)
+                        pending.done.wait()
+                    if pending.error:
+                        _send(conn, {"ok": False, "error": pending.error})
+                    else:
+                        _send(conn, {"ok": True, "embeddings": pending.result if pending.texts else []})
+                elif op == "ping":
+                    _send(conn, {"ok": True, "model": self._model_name, "pid": os.getpid(), "stats": self.snapshot()})
+                else:
+                    _send(conn, {"ok": False, "error": f"Unknown op: {op}"})
+        except (OSError, ValueError) as e:
+            # ConnectionError is an OSError; a malformed frame fails orjson with a ValueError
+            logger.debug(f"Embedding client disconnected: {e}")
+        finally:
+            conn.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            batches = self._stats["batches"]
+            return {**self._stats, "queued": self._queue.qsize(),
+                    "avg_batch": round(self._stats["texts"] / batches, 2) if batches else 0.0}
+
+    def _bind(self) -> socket.socket:
+        if not isinstance(self._address, str):
+            sock = socket.socket(socket.AF_INET6 if ":" in self._address[0] else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self._address)
+            return sock
+        path = self._address
+        directory = os.path.dirname(path) or "."
+        if directory == _RUNTIME_DIR:
+            _ensure_private_dir(directory)
+        else:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            pass
+        else:
+            # Only remove our own leftover socket, and only if no server answers on it
+            if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+                raise RuntimeError(f"{path} exists and is not a socket owned by this user; not removing it")
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+                logger.info(f"Removed stale embedding socket {path}")
+            else:
+                raise RuntimeError(f"Another embedding server is already listening on {path}")
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, 0o600)
+        return sock
+
+    def serve_forever(self) -> None:
+        self._load_model()
+        threading.Thread(target=self._batch_loop, name="embedding-batcher", daemon=True).start()
+        with self._bind() as listener:
+            listener.listen(64)
+            logger.info(f"Embedding server listening on {self._address}")
+            while True:
+                try:
+                    conn, _peer = listener.accept()
+                except OSError as e:
+                    logger.warning(f"Embedding server accept failed: {e}")
+                    continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+# ---------- client ----------
+
+class RemoteEmbeddingFunction:
+    """
+    Client of the embedding server. Plain callable so main.py and /admin/embeddings can
+    use it without importing chromadb; create_embedding_function wraps it for chromadb.
+    """
+
+    def __init__(self, address: str = EMBEDDING_SERVICE_ADDRESS):
+        self._address = _parse_address(address)
+        # Refuses to run without a key (set, or written by the server)
+        self._key = _load_authkey()
+        # One connection per concurrent caller; connections are reused
+        self._pool: "queue.LifoQueue" = queue.LifoQueue()
+
+    def _connect(self) -> socket.socket:
+        return _connect(self._address, self._key)
+
+    def _request(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            _send(conn, msg)
+            reply = _recv(conn)
+        except OSError:
+            # The server restarted since this connection was opened; retry once on a new one
+            conn.close()
+            conn = self._connect()
+            _send(conn, msg)
+            reply = _recv(conn)
+        self._pool.put(conn)
+        if not reply.get("ok"):
+            raise RuntimeError(f"Embedding server error: {reply.get('error')}")
+        return reply
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return list(self._request({"op": "embed", "texts": list(input)})["embeddings"])
+
+    def ping(self) -> Dict[str, Any]:
+        return self._request({"op": "ping"})
+
+def server_available(address: str = EMBEDDING_SERVICE_ADDRESS) -> bool:
+    try:
+        RemoteEmbeddingFunction(address).ping()
+        return True
+    except Exception:
+        return False
+
+def start_server_process(timeout: float = 120.0):
+    """Launch `python embedding_service.py` and wait until it answers; returns the Popen handle"""
+    import subprocess
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Embedding server exited with code {proc.returncode}")
+        if server_available():
+            return proc
+        time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError(f"Embedding server did not come up within {timeout:.0f}s")
+
+def create_embedding_function():
+    if EMBEDDING_SERVICE == "remote":
+        from chromadb.api.types import EmbeddingFunction, Documents, Embeddings
+
+        class ChromaRemoteEmbeddingFunction(RemoteEmbeddingFunction, EmbeddingFunction[Documents]):
+            def __call__(self, input: Documents) -> Embeddings:
+                return RemoteEmbeddingFunction.__call__(self, input)
+
+        logger.info(f"Using the embedding server at {EMBEDDING_SERVICE_ADDRESS}")
+        return ChromaRemoteEmbeddingFunction()
+    from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+    return SentenceTransformerEmbeddingFunction(model_name=resolve_embedding_model())
+
+if __name__ == "__main__":
+    from config import setup_logging
+    setup_logging()
+    EmbeddingServer().serve_forever()
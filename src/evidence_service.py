@@ -0,0 +1,190 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Evidence text built straight from retrieved chunks, without an LLM call.
+
+Used by the retrieval-only ("evidence") query mode: the best matching sentences of
+each passage are highlighted and, optionally, a short extractive summary is put on
+top. Everything is lexical scoring on the CPU, so a whole template fills in seconds.
+"""
+
+import os
+import re
+import math
+from collections import Counter
+from typing import List, Dict, Any, Tuple
+
+HIGHLIGHT_MARK = os.environ.get("EVIDENCE_HIGHLIGHT_MARK", "**")
+MAX_PASSAGES = int(os.environ.get("EVIDENCE_MAX_PASSAGES", "3") or 3)
+MAX_PASSAGE_CHARS = int(os.environ.get("EVIDENCE_MAX_PASSAGE_CHARS", "600") or 600)
+HIGHLIGHTS_PER_PASSAGE = int(os.environ.get("EVIDENCE_HIGHLIGHTS_PER_PASSAGE", "2") or 2)
+SUMMARY_SENTENCES = int(os.environ.get("EVIDENCE_SUMMARY_SENTENCES", "3") or 3)
+
+# Wording added by the batch flows around the Hint/AET text; it says nothing about the evidence
+_QUERY_BOILERPLATE = re.compile(
+    r"(find relevant evidence based on the following hint information:|find evidence related to the following aet:"
+    r"|background information:|hint information:|aet information:)",
+    re.IGNORECASE,
+)
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "at", "from", "as", "is", "are",
+    "be", "been", "was", "were", "that", "this", "these", "those", "it", "its", "there", "their", "which", "who",
+    "what", "how", "all", "any", "each", "has", "have", "had", "not", "no", "shall", "should", "must", "may",
+    "can", "will", "do", "does", "provide", "please", "evidence", "relevant", "following", "ensure", "e.g", "etc",
+}
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;。！？；])\s+|\n{1,}")
+_TOKEN = re.compile(r"[a-z0-9][a-z0-9\-\.]*[a-z0-9]|[a-z0-9]|[一-鿿]", re.IGNORECASE)
+
+def split_sentences(text: str) -> List[str]:
+    parts = _SENTENCE_SPLIT.split(str(text or ""))
+    return [p.strip() for p in parts if p and p.strip()]
+
+def _tokens(text: str) -> List[str]:
+    return [t.lower() for t in _TOKEN.findall(str(text or ""))]
+
+def query_terms(query: str) -> List[str]:
+    """Content words of a query, with the batch boilerplate and stopwords removed"""
+    cleaned = _QUERY_BOILERPLATE.sub(" ", str(query or ""))
+    seen, terms = set(), []
+    for t in _tokens(cleaned):
+        if t in _STOPWORDS or len(t) < 2 and not ("一" <= t <= "鿿"):
+            continue
+        if t not in seen:
+            seen.add(t)
+            terms.append(t)
+    return terms
+
+def _sentence_score(terms: List[str], idf: Dict[str, float], sentence: str) -> float:
+    toks = _tokens(sentence)
+    if not toks or not terms:
+        return 0.0
+    counts = Counter(toks)
+    matched = sum(idf.get(t, 1.0) for t in terms if counts.get(t))
+    # Mild length normalisation so long run-on sentences do not win by size alone
+    return matched / math.sqrt(len(toks))
+
+def _idf(terms: List[str], sentences: List[str]) -> Dict[str, float]:
+    n = max(len(sentences), 1)
+    sets = [set(_tokens(s)) for s in sentences]
+    return {t: math.log(1 + n / (1 + sum(1 for s in sets if t in s))) for t in terms}
+
+def _mark(sentence: str) -> str:
+    return f"{HIGHLIGHT_MARK}{sentence}{HIGHLIGHT_MARK}" if HIGHLIGHT_MARK else sentence
+
+def highlight_passage(query: str, text: str,
+                      max_highlights: int = HIGHLIGHTS_PER_PASSAGE,
+                      max_chars: int = MAX_PASSAGE_CHARS) -> Tuple[str, int]:
+    """
+    Return (excerpt, highlight_count): the best matching sentences of `text` marked with
+    HIGHLIGHT_MARK, with neighbouring sentences kept for context up to max_chars.
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return "", 0
+    terms = query_terms(query)
+    idf = _idf(terms, sentences)
+    scored = sorted(((_sentence_score(terms, idf, s), i) for i, s in enumerate(sentences)), reverse=True)
+    best = [i for score, i in scored[:max_highlights] if score > 0]
+    if not best:
+        excerpt = " ".join(sentences)
+        return (excerpt[:max_chars].rstrip() + ("…" if len(excerpt) > max_chars else "")), 0
+
+    # Grow a window around the highlighted sentences while it fits
+    keep = set(best)
+    budget = sum(len(sentences[i]) for i in keep)
+    radius = 1
+    while budget < max_chars and radius < len(sentences):
+        grew = False
+        for i in best:
+            for j in (i - radius, i + radius):
+                if 0 <= j < len(sentences) and j not in keep and budget + len(sentences[j]) <= max_chars:
+                    keep.add(j)
+                    budget += len(sentences[j])
+                    grew = True
+        if not grew:
+            break
+        radius += 1
+
+    ordered = sorted(keep)
+    out = []
+    for pos, i in enumerate(ordered):
+        if pos == 0 and i > 0 or pos > 0 and i != ordered[pos - 1] + 1:
+            out.append("…")
+        out.append(_mark(sentences[i]) if i in best else sentences[i])
+    if ordered[-1] < len(sentences) - 1:
+        out.append("…")
+    return " ".join(out), len(best)
+
+def extractive_summary(query: str, context_docs: List[Dict[str, Any]],
+                       max_sentences: int = SUMMARY_SENTENCES) -> str:
+    """Top query-matching sentences across the retrieved passages, in document order"""
+    candidates: List[Tuple[int, int, str]] = []
+    for d_idx, doc in enumerate(context_docs):
+        for s_idx, s in enumerate(split_sentences(doc.get("content", ""))):
+            if 20 <= len(s) <= 400:
+                candidates.append((d_idx, s_idx, s))
+    if not candidates:
+        return ""
+    terms = query_terms(query)
+    idf = _idf(terms, [c[2] for c in candidates])
+    scored = []
+    for d_idx, s_idx, s in candidates:
+        score = _sentence_score(terms, idf, s)
+        if score > 0:
+            # Prefer higher-ranked passages on ties
+            scored.append((score / (1 + 0.1 * d_idx), d_idx, s_idx, s))
+    scored.sort(reverse=True)
+    chosen, seen = [], set()
+    for _, d_idx, s_idx, s in scored:
+        key = s.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        chosen.append((d_idx, s_idx, s))
+        if len(chosen) >= max_sentences:
+            break
+    return " ".join(s for _, _, s in sorted(chosen))
+
+def build_evidence_answer(query: str, context_docs: List[Dict[str, Any]], summarize: bool = False,
+                          max_passages: int = MAX_PASSAGES) -> str:
+    """Answer text for retrieval-only mode: optional summary plus highlighted top passages"""
+    blocks = []
+    if summarize:
+        summary = extractive_summary(query, context_docs)
+        if summary:
+            blocks.append(f"Summary (extractive): {summary}")
+    for n, doc in enumerate(context_docs[:max_passages], start=1):
+        meta = doc.get("metadata") or {}
+        excerpt, _ = highlight_passage(query, doc.get("content", ""))
+        if not excerpt:
+            continue
+        header = f"[{n}] {meta.get('source', 'Unknown')}, page {meta.get('page', '?')}"
+        try:
+            header += f" (similarity {float(doc.get('similarity_score')) * 100:.0f}%)"
+        except (TypeError, ValueError):
+            pass
+        blocks.append(f"{header}\n{excerpt}")
+    return "\n\n".join(blocks)
@@ -23,7 +23,6 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import pandas as pd
 import io
 import logging
 import tempfile
@@ -31,11 +30,8 @@ from datetime import datetime
 from fastapi import UploadFile, HTTPException
 from typing import Dict, Any, List
 from models import ExcelData, PDFUploadResponse
-from rag_service import process_pdf
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.styles.differential import DifferentialStyle
-from openpyxl.formatting.rule import Rule
-from openpyxl.styles.colors import Color
+from dataset_store import dataset_store
+from fastapi.concurrency import run_in_threadpool
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +39,7 @@ class FileService:
     @staticmethod
     async def process_excel_file(file: UploadFile) -> ExcelData:
         """Process uploaded Excel file"""
+        import pandas as pd  # deferred: pandas is only needed once a checklist is uploaded
         logger.info(f"Received file upload request: {file.filename}")
         
         if not file.filename.endswith(('.xlsx', '.xls')):
@@ -77,9 +74,11 @@ class FileService:
             
             logger.debug("Start converting DataFrame to dictionary list")
             data = df.to_dict(orient='records')
-            logger.info(f"Data processing completed, {len(data)} records returned")
+            # Keep a server-side copy so batch/retry requests can reference it by id
+            dataset_id = await run_in_threadpool(dataset_store.put, data, file.filename)
+            logger.info(f"Data processing completed, {len(data)} records returned, dataset {dataset_id}")
             
-            return ExcelData(data=data)
+            return ExcelData(data=data, dataset_id=dataset_id)
         
         except Exception as e:
             logger.error(f"Failed to process file: {str(e)}", exc_info=True)
@@ -88,6 +87,9 @@ class FileService:
     @staticmethod
     def generate_excel_from_cache(data: List[Dict[str, Any]], filename: str = None, statistics: Dict = None) -> str:
         """Generate Excel file from cached data (optimized version)"""
+        import pandas as pd
+        from openpyxl.styles import Font, PatternFill, Alignment
+        from openpyxl.styles.colors import Color
         try:
             if not filename:
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -261,6 +263,7 @@ class FileService:
     @staticmethod
     async def process_pdf_file(file: UploadFile) -> PDFUploadResponse:
         """Process uploaded PDF file"""
+        from rag_service import process_pdf
         logger.info(f"Received PDF file upload request: {file.filename}")
         
         if not file.filename.lower().endswith('.pdf'):
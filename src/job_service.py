@@ -0,0 +1,560 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Durable background jobs for batch and retry runs.
+
+A job and its input rows are written to a SQLite queue when submitted. Worker tasks
+started with the app claim queued jobs, process up to BATCH_ROW_CONCURRENCY rows at a
+time and checkpoint each finished row, so closing the browser or restarting the server
+loses at most the rows in flight. Running jobs carry a lease renewed by their worker
+process; jobs whose lease expired (the process died) are re-queued, at startup or by
+any live worker, and continue with the rows that have no checkpoint. Progress is read
+back through /jobs/{id} and the /jobs/{id}/events SSE subscription.
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from config import AUTH_DB_PATH
+from request_coalescer import BatchDeduplicator
+from circuit_breaker import llm_breaker
+from cancellation import cancel_registry, bind
+from warmup import model_warmup
+from streaming_service import (
+    BATCH_ROW_CONCURRENCY,
+    StreamingService,
+    process_batch_row,
+    failed_subqueries,
+    row_succeeded,
+    summarize_results,
+    generate_batch_summary,
+)
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(AUTH_DB_PATH)), "jobs.db"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2") or 2)
+# A job that keeps taking the server down is failed instead of being resumed forever
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3") or 3)
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "2") or 2)
+# A running job belongs to the worker process holding its lease; the owner renews it every
+# third of JOB_LEASE_SECONDS, and only jobs whose lease ran out are taken over
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60") or 60)
+
+JOB_KINDS = ("batch", "retry")
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+def _get_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def _job_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["params"] = json.loads(job.get("params") or "{}")
+    job["statistics"] = json.loads(job["statistics"]) if job.get("statistics") else None
+    job["percentage"] = round(job["completed"] / job["total"] * 100, 2) if job.get("total") else 100.0
+    return job
+
+class JobQueue:
+    def __init__(self):
+        self._workers: List[asyncio.Task] = []
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Lease owner id of this process (several uvicorn workers share the jobs DB)
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Loop the workers run on; submit/cancel/_notify are also called from threadpool
+        # threads, and asyncio.Event may only be touched from its own loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Swapped on every checkpoint; subscribers wait on the current one
+        self._changed: Optional[asyncio.Event] = None
+
+    # ---------- storage ----------
+
+    def init_db(self) -> None:
+        os.makedirs(os.path.dirname(JOBS_DB_PATH) or ".", exist_ok=True)
+        with _get_db() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL CHECK(kind IN ('batch','retry')),
+                    status TEXT NOT NULL CHECK(status IN ('queued','running','completed','failed','cancelled')),
+                    params TEXT NOT NULL DEFAULT '{}',
+                    total INTEGER NOT NULL DEFAULT 0,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    statistics TEXT,
+                    summary TEXT,
+                    error TEXT,
+                    owner TEXT,
+                    lease_until REAL,
+                    created_at TEXT DEFAULT (datetime('now', 'localtime')),
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+                """
+            )
+            # One row per template row; rows a retry job does not touch are stored as 'skipped'
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_rows (
+                    job_id TEXT NOT NULL,
+                    row_index INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    result TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','done','skipped')),
+                    done_seq INTEGER,
+                    input_tokens INTEGER NOT NULL DEFAULT 0,
+                    output_tokens INTEGER NOT NULL DEFAULT 0,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job_id, row_index)
+                )
+                """
+            )
+            # Job DBs created before leases existed
+            columns = {r["name"] for r in conn.execute("PRAGMA table_info(jobs)").fetchall()}
+            for column, sql_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {sql_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_rows_seq ON job_rows(job_id, done_seq)")
+            conn.commit()
+        logger.info(f"Job DB initialized at {JOBS_DB_PATH}")
+
+    def _recover(self) -> int:
+        """Re-queue running jobs whose owner stopped renewing the lease (crashed or killed)"""
+        with _get_db() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL "
+                "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+                (time.time(),),
+            )
+            conn.commit()
+            return cur.rowcount
+
+    def _renew_leases(self) -> int:
+        with _get_db() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                (time.time() + JOB_LEASE_SECONDS, self._owner),
+            )
+            conn.commit()
+            return cur.rowcount
+
+    def submit(self, kind: str, data: List[Dict[str, Any]], params: Dict[str, Any],
+               targets: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Persist a job; targets limits processing to those row indices (retry jobs)"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = str(uuid.uuid4())
+        selected = set(range(len(data))) if targets is None else {i for i in targets if 0 <= i < len(data)}
+        rows = [
+            (job_id, i, json.dumps(row, ensure_ascii=False, default=str),
+             None if i in selected else json.dumps(row, ensure_ascii=False, default=str),
+             "pending" if i in selected else "skipped")
+            for i, row in enumerate(data)
+        ]
+        with _get_db() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, total) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(params, ensure_ascii=False), len(selected)),
+            )
+            conn.executemany(
+                "INSERT INTO job_rows (job_id, row_index, data, result, status) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+        logger.info(f"Queued {kind} job {job_id}: {len(selected)} of {len(data)} rows to process")
+        self._call_on_loop(self._wake)
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with _get_db() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+
+    def list_jobs(self, limit: int = 20, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM jobs"
+        args: list = []
+        if status:
+            sql += " WHERE status = ?"
+            args.append(status)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        args.append(int(limit))
+        with _get_db() as conn:
+            return [_job_dict(r) for r in conn.execute(sql, args).fetchall()]
+
+    def rows_since(self, job_id: str, after_seq: int = 0, limit: int = 200) -> List[Dict[str, Any]]:
+        """Rows checkpointed after after_seq, in completion order"""
+        with _get_db() as conn:
+            rows = conn.execute(
+                "SELECT row_index, result, done_seq FROM job_rows WHERE job_id = ? AND done_seq > ? "
+                "ORDER BY done_seq LIMIT ?",
+                (job_id, int(after_seq), int(limit)),
+            ).fetchall()
+        return [{"seq": r["done_seq"], "index": r["row_index"], "row": json.loads(r["result"])} for r in rows]
+
+    def results(self, job_id: str) -> List[Dict[str, Any]]:
+        """All rows of a job in template order (processed rows carry their results)"""
+        with _get_db() as conn:
+            rows = conn.execute(
+                "SELECT data, result FROM job_rows WHERE job_id = ? ORDER BY row_index", (job_id,)
+            ).fetchall()
+        return [json.loads(r["result"] or r["data"]) for r in rows]
+
+    def restore_session(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Put a finished job's results back into the download cache (e.g. after a restart)"""
+        job = self.get(job_id)
+        if not job or job["status"] not in ("completed", "cancelled"):
+            return None
+        StreamingService._store_processed_data(job_id, self.results(job_id), job.get("statistics") or {})
+        return StreamingService.get_cached_data(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with _get_db() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (_now(), job_id),
+            )
+            conn.commit()
+        job = self.get(job_id)
+        if job and job["status"] == "running":
+            # Queued rows are skipped and LLM calls of the row in flight stop at their next check
+            report = cancel_registry.cancel(job_id)
+            if report is not None:
+                job["cancellation"] = report
+        self._notify()
+        return job
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        with _get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            if row["attempts"] >= JOB_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (f"Gave up after {row['attempts']} attempts", _now(), row["id"]),
+                )
+                conn.commit()
+                logger.error(f"Job {row['id']} failed: gave up after {row['attempts']} attempts")
+                return self._claim()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease_until = ?, "
+                "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (self._owner, time.time() + JOB_LEASE_SECONDS, _now(), row["id"]),
+            )
+            conn.commit()
+        return self.get(row["id"])
+
+    def _pending_rows(self, job_id: str) -> List[Dict[str, Any]]:
+        with _get_db() as conn:
+            rows = conn.execute(
+                "SELECT row_index, data FROM job_rows WHERE job_id = ? AND status = 'pending' ORDER BY row_index",
+                (job_id,),
+            ).fetchall()
+        return [{"index": r["row_index"], "data": json.loads(r["data"])} for r in rows]
+
+    def _checkpoint(self, job_id: str, row_index: int, result_row: Dict[str, Any], tokens: Dict[str, int]) -> None:
+        with _get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(done_seq), 0) + 1 FROM job_rows WHERE job_id = ?", (job_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "UPDATE job_rows SET result = ?, status = 'done', done_seq = ?, input_tokens = ?, "
+                "output_tokens = ?, cached_tokens = ? WHERE job_id = ? AND row_index = ?",
+                (json.dumps(result_row, ensure_ascii=False, default=str), seq, tokens["input"], tokens["output"],
+                 tokens["cached"], job_id, row_index),
+            )
+            conn.execute("UPDATE jobs SET completed = completed + 1 WHERE id = ?", (job_id,))
+            conn.commit()
+
+    def _token_totals(self, job_id: str) -> Dict[str, int]:
+        with _get_db() as conn:
+            row = conn.execute(
+                "SELECT COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0), "
+                "COALESCE(SUM(cached_tokens), 0) FROM job_rows WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+        return {"input": row[0], "output": row[1], "cached": row[2]}
+
+    def _finish(self, job_id: str, status: str, statistics: Optional[Dict[str, Any]] = None,
+                summary: Optional[str] = None, error: Optional[str] = None) -> None:
+        with _get_db() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, statistics = ?, summary = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(statistics, ensure_ascii=False) if statistics is not None else None,
+                 summary, error, _now(), job_id),
+            )
+            conn.commit()
+
+    def _requeue(self, job_id: str) -> None:
+        # Interrupted by shutdown, not by the job itself: do not count the attempt
+        with _get_db() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), owner = NULL, lease_until = NULL "
+                "WHERE id = ? AND status = 'running' AND owner = ?",
+                (job_id, self._owner),
+            )
+            conn.commit()
+
+    # ---------- workers ----------
+
+    def _call_on_loop(self, callback) -> None:
+        """Run callback on the workers' loop: directly when already on it, else thread-safely"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            callback()
+        else:
+            loop.call_soon_threadsafe(callback)
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _swap_changed(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._call_on_loop(self._swap_changed)
+
+    async def wait_for_change(self, timeout: float) -> bool:
+        """Wait until any job checkpoints a row or changes status; False on timeout"""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _is_cancelled(self, job_id: str) -> bool:
+        if cancel_registry.is_cancelled(job_id):
+            return True
+        # The stored status covers cancels that did not go through this process's registry
+        job = await asyncio.to_thread(self.get, job_id)
+        return bool(job and job["status"] == "cancelled")
+
+    async def start(self, workers: int = JOB_WORKERS) -> None:
+        await asyncio.to_thread(self.init_db)
+        recovered = await asyncio.to_thread(self._recover)
+        if recovered:
+            logger.info(f"Resuming {recovered} interrupted job(s)")
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(n)) for n in range(max(workers, 1))]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f"Started {len(self._workers)} job worker(s) as {self._owner}")
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Stopped after the workers, so leases stay valid until their jobs are re-queued
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        self._loop = None
+
+    async def _heartbeat(self) -> None:
+        """Renew this process's leases; take over jobs of workers that stopped renewing theirs"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await asyncio.to_thread(self._renew_leases)
+                recovered = await asyncio.to_thread(self._recover)
+                if recovered:
+                    logger.warning(f"Re-queued {recovered} job(s) whose worker stopped renewing its lease")
+                    self._wake()
+            except Exception as e:
+                logger.warning(f"Job lease renewal failed: {e}")
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info(f"[worker {n}] running {job['kind']} job {job['id']} (attempt {job['attempts']})")
+            try:
+                # Jobs resumed at startup wait for the models instead of failing
+                while not model_warmup.failed and not await asyncio.to_thread(model_warmup.wait, JOB_POLL_SECONDS):
+                    pass
+                await self._run(job)
+            except asyncio.CancelledError:
+                await asyncio.to_thread(self._requeue, job["id"])
+                logger.info(f"[worker {n}] job {job['id']} interrupted, re-queued")
+                raise
+            except Exception as e:
+                logger.error(f"[worker {n}] job {job['id']} failed: {e}", exc_info=True)
+                await asyncio.to_thread(self._finish, job["id"], "failed", None, None, str(e))
+            finally:
+                token = cancel_registry.get(job["id"])
+                if token is not None:
+                    cancel_registry.finish(token)
+                self._notify()
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        params = job["params"]
+        retrieval_only = params.get("mode") == "retrieval"
+        max_attempts = max(int(params.get("max_retry_rounds") or 1), 1) if job["kind"] == "retry" else 1
+        if job["kind"] == "retry" and params.get("auto_retry") is False:
+            max_attempts = 1
+        dedup = BatchDeduplicator()
+
+        def run_query(query_text: str, query_type: str, clause_text: str):
+            from rag_service import query_existing_knowledge_base, query_evidence_only, query_identity
+
+            def compute():
+                if retrieval_only:
+                    return query_evidence_only(query_text, query_type=query_type,
+                                               summarize=bool(params.get("summarize")), clause_text=clause_text)
+                return query_existing_knowledge_base(query_text, query_type=query_type, clause_text=clause_text)
+            return dedup.run(query_identity(query_text, query_type, clause_text), compute)
+
+        pending = await asyncio.to_thread(self._pending_rows, job_id)
+        if len(pending) < job["total"]:
+            logger.info(f"Job {job_id}: resuming, {job['total'] - len(pending)} row(s) already checkpointed")
+        token = cancel_registry.register(job_id, f"{job['kind']}_job", total_units=len(pending))
+        # Worker threads of this job inherit the token (the worker task re-binds it per job)
+        bind(token)
+        # Rows run concurrently like the streaming batch (LLM concurrency itself is still
+        # bounded by llm_limiter); each row is checkpointed as soon as it finishes
+        semaphore = asyncio.Semaphore(BATCH_ROW_CONCURRENCY)
+
+        async def run_row(item: Dict[str, Any]) -> None:
+            async with semaphore:
+                if await self._is_cancelled(job_id):
+                    return
+                label = f"Job {job_id[:8]} row {item['index'] + 1}"
+                tokens = {"input": 0, "output": 0, "cached": 0}
+                result_row = item["data"]
+                for attempt in range(1, max_attempts + 1):
+                    if attempt > 1:
+                        # Same backoff as the streaming retry, plus waiting out an open LLM circuit
+                        await asyncio.sleep(min(2 ** (attempt - 2), 10))
+                        wait_seconds = llm_breaker.seconds_until_retry()
+                        while wait_seconds > 0 and not await self._is_cancelled(job_id):
+                            await asyncio.sleep(min(wait_seconds, 5))
+                            wait_seconds = llm_breaker.seconds_until_retry()
+                    # Retry jobs only re-run the sub-queries that have no evidence yet
+                    only = (failed_subqueries(result_row) or None) if job["kind"] == "retry" else None
+                    result_row, row_tokens = await process_batch_row(result_row, run_query, label=label, only=only)
+                    for k in tokens:
+                        tokens[k] += row_tokens[k]
+                    # Retries stop once no sub-query is left without evidence, the same target
+                    # as retry_failed_stream (a row can succeed overall with a failed AET query)
+                    done = not failed_subqueries(result_row) if job["kind"] == "retry" else row_succeeded(result_row)
+                    if done or await self._is_cancelled(job_id):
+                        break
+                await asyncio.to_thread(self._checkpoint, job_id, item["index"], result_row, tokens)
+                token.record(tokens)
+                self._notify()
+
+        tasks = [asyncio.create_task(run_row(item)) for item in pending]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # A failing row (or shutdown) stops the rest; finished rows stay checkpointed
+            for task in tasks:
+                task.cancel()
+
+        cancelled = await self._is_cancelled(job_id)
+        results = await asyncio.to_thread(self.results, job_id)
+        success_count, failed_indices = summarize_results(results)
+        totals = await asyncio.to_thread(self._token_totals, job_id)
+        summary = None
+        if job["kind"] == "batch" and not cancelled:
+            summary, summary_tokens = await generate_batch_summary(len(results), success_count, len(failed_indices),
+                                                                   retrieval_only)
+            for k in totals:
+                totals[k] += summary_tokens[k]
+        statistics = {
+            "total": len(results),
+            "processed": job["total"],
+            "success": success_count,
+            "failed": len(failed_indices),
+            "failed_indices": failed_indices,
+            "mode": "retrieval" if retrieval_only else "llm",
+            "deduplicated_queries": dedup.reused,
+            "token_usage": {
+                "total_input_tokens": totals["input"],
+                "total_output_tokens": totals["output"],
+                "total_cached_tokens": totals["cached"],
+            },
+        }
+        status = "cancelled" if cancelled else "completed"
+        await asyncio.to_thread(self._finish, job_id, status, statistics, summary, None)
+        # The job id doubles as the download session id
+        await asyncio.to_thread(StreamingService._store_processed_data, job_id, results, statistics)
+        if params.get("session_id"):
+            # Retry of a cached batch session: merge back so its download includes the retried rows
+            await asyncio.to_thread(StreamingService._store_processed_data, params["session_id"], results, statistics)
+
+        if not retrieval_only:
+            try:
+                from token_utils import log_token_usage
+                from rag_service import get_current_model
+                log_token_usage(get_current_model(), totals["input"], totals["output"], f"{job['kind']}_job TOTAL",
+                                session_id=job_id, cached_input_tokens=totals["cached"])
+            except Exception:
+                pass
+        logger.info(f"Job {job_id} {status}: {success_count} of {len(results)} rows successful")
+
+job_queue = JobQueue()
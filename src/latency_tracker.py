@@ -0,0 +1,168 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Per-model LLM latency tracking (rolling p50/p95/p99), adaptive request timeouts
+and the budget for hedged (duplicate) requests.
+"""
+
+import os
+import time
+import math
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT", "90") or 90)
+MIN_TIMEOUT_SECONDS = float(os.environ.get("LLM_MIN_TIMEOUT", "20") or 20)
+# Adaptive timeout = TIMEOUT_P99_MULTIPLIER x p99, clamped to [MIN_TIMEOUT, LLM_TIMEOUT]
+TIMEOUT_P99_MULTIPLIER = float(os.environ.get("LLM_TIMEOUT_P99_MULTIPLIER", "2.0") or 2.0)
+WINDOW_SIZE = int(os.environ.get("LLM_LATENCY_WINDOW", "200") or 200)
+WINDOW_SECONDS = float(os.environ.get("LLM_LATENCY_WINDOW_SECONDS", "3600") or 3600)
+MIN_SAMPLES = int(os.environ.get("LLM_LATENCY_MIN_SAMPLES", "20") or 20)
+
+# Hedging is off by default; when on, a duplicate request fires once a call runs past p95
+HEDGE_ENABLED = str(os.environ.get("LLM_HEDGE_ENABLED", "false")).lower() in ("1", "true", "yes")
+# Extra spend cap: hedges may be at most this share of all requests
+HEDGE_MAX_RATIO = float(os.environ.get("LLM_HEDGE_MAX_RATIO", "0.05") or 0.05)
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "5") or 5)
+
+def _percentile(sorted_values, pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct
+    lo = math.floor(k)
+    hi = math.ceil(k)
+    if lo == hi:
+        return sorted_values[int(k)]
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+class _ModelLatency:
+    def __init__(self):
+        self.samples: deque = deque(maxlen=WINDOW_SIZE)  # (monotonic_ts, seconds)
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedge_extra_input_tokens = 0
+
+    def recent(self, now: float):
+        return sorted(v for ts, v in self.samples if now - ts <= WINDOW_SECONDS)
+
+class LatencyTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, _ModelLatency] = {}
+
+    def _get(self, model: str) -> _ModelLatency:
+        key = (model or "default").strip().lower()
+        m = self._models.get(key)
+        if m is None:
+            m = _ModelLatency()
+            self._models[key] = m
+        return m
+
+    def record(self, model: str, seconds: float) -> None:
+        """Record the wall-clock duration of one successful LLM call"""
+        with self._lock:
+            m = self._get(model)
+            m.samples.append((time.monotonic(), float(seconds)))
+
+    def count_request(self, model: str) -> None:
+        with self._lock:
+            self._get(model).requests += 1
+
+    def percentiles(self, model: str) -> Dict[str, Optional[float]]:
+        with self._lock:
+            values = self._get(model).recent(time.monotonic())
+        return {
+            "samples": len(values),
+            "p50": _percentile(values, 0.50),
+            "p95": _percentile(values, 0.95),
+            "p99": _percentile(values, 0.99),
+        }
+
+    def timeout_for(self, model: str) -> float:
+        """Request timeout derived from observed p99; the static default until enough samples exist"""
+        stats = self.percentiles(model)
+        if stats["samples"] < MIN_SAMPLES or stats["p99"] is None:
+            return DEFAULT_TIMEOUT_SECONDS
+        return max(MIN_TIMEOUT_SECONDS, min(DEFAULT_TIMEOUT_SECONDS, stats["p99"] * TIMEOUT_P99_MULTIPLIER))
+
+    def hedge_delay_for(self, model: str) -> Optional[float]:
+        """Seconds after which to fire a hedge (p95), or None if hedging should not be used"""
+        if not HEDGE_ENABLED:
+            return None
+        stats = self.percentiles(model)
+        if stats["samples"] < MIN_SAMPLES or stats["p95"] is None:
+            return None
+        return max(HEDGE_MIN_DELAY_SECONDS, stats["p95"])
+
+    def try_reserve_hedge(self, model: str, extra_input_tokens: int) -> bool:
+        """Take one hedge from the spend budget; False when the cap is reached"""
+        with self._lock:
+            m = self._get(model)
+            if m.hedges_fired + 1 > HEDGE_MAX_RATIO * max(m.requests, 1):
+                return False
+            m.hedges_fired += 1
+            m.hedge_extra_input_tokens += max(0, int(extra_input_tokens or 0))
+            return True
+
+    def record_hedge_win(self, model: str) -> None:
+        with self._lock:
+            self._get(model).hedges_won += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            items = list(self._models.items())
+        models = []
+        for name, m in items:
+            with self._lock:
+                values = m.recent(now)
+                requests, fired, won, extra = m.requests, m.hedges_fired, m.hedges_won, m.hedge_extra_input_tokens
+            p = lambda pct: round(_percentile(values, pct), 3) if values else None
+            models.append({
+                "model": name,
+                "samples": len(values),
+                "p50_seconds": p(0.50),
+                "p95_seconds": p(0.95),
+                "p99_seconds": p(0.99),
+                "timeout_seconds": round(self.timeout_for(name), 1),
+                "requests": requests,
+                "hedges_fired": fired,
+                "hedges_won": won,
+                "hedge_extra_input_tokens": extra,
+            })
+        return {
+            "hedging_enabled": HEDGE_ENABLED,
+            "hedge_max_ratio": HEDGE_MAX_RATIO,
+            "default_timeout_seconds": DEFAULT_TIMEOUT_SECONDS,
+            "models": models,
+        }
+
+latency_tracker = LatencyTracker()
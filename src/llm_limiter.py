@@ -0,0 +1,367 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Process-wide LLM rate limiter: per-model RPM/TPM token buckets plus an AIMD
+(additive-increase / multiplicative-decrease) concurrency limit.
+
+Every LLM call (single query, streaming query, batch, retry) goes through
+llm_limiter.acquire(), so concurrent endpoints share one budget per model.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from cancellation import check_cancelled
+
+logger = logging.getLogger(__name__)
+
+# Defaults apply to every model; LLM_RATE_LIMITS can override per model, e.g.
+# LLM_RATE_LIMITS={"GPT-4o-mini": {"rpm": 600, "tpm": 1000000, "max_concurrency": 16}}
+DEFAULT_RPM = int(os.environ.get("LLM_RPM_LIMIT", "300") or 300)
+DEFAULT_TPM = int(os.environ.get("LLM_TPM_LIMIT", "300000") or 300000)
+MIN_CONCURRENCY = int(os.environ.get("LLM_MIN_CONCURRENCY", "1") or 1)
+MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8") or 8)
+INITIAL_CONCURRENCY = int(os.environ.get("LLM_INITIAL_CONCURRENCY", "4") or 4)
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("LLM_QUEUE_TIMEOUT", "300") or 300)
+# A call slower than LATENCY_SPIKE_FACTOR x the smoothed latency counts as congestion
+LATENCY_SPIKE_FACTOR = float(os.environ.get("LLM_LATENCY_SPIKE_FACTOR", "3.0") or 3.0)
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN_SECONDS = 5.0
+
+def _load_overrides() -> Dict[str, Dict[str, Any]]:
+    raw = os.environ.get("LLM_RATE_LIMITS", "").strip()
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+        return {str(k).lower(): v for k, v in (data or {}).items() if isinstance(v, dict)}
+    except Exception as e:
+        logger.warning(f"Invalid LLM_RATE_LIMITS, ignoring: {e}")
+        return {}
+
+_OVERRIDES = _load_overrides()
+
+class LLMQueueTimeout(Exception):
+    """Raised when a call waited longer than LLM_QUEUE_TIMEOUT for a rate-limit slot"""
+
+def classify_llm_error(exc: BaseException) -> str:
+    """
+    Map an exception from the OpenAI/LangChain client to a coarse class:
+    "rate_limit" (429), "server_error" (5xx), "timeout", "connection", "client_error" (other 4xx) or "other".
+    Uses duck typing so the openai package does not have to be imported here.
+    """
+    name = type(exc).__name__
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    try:
+        status = int(status) if status is not None else None
+    except Exception:
+        status = None
+    lname = name.lower()
+
+    # The HTTP status decides when there is one: a 400 whose message mentions "4290 tokens"
+    # or "connection" is still a client error and must not trigger back-off
+    if status is not None:
+        if status == 429:
+            return "rate_limit"
+        if status >= 500:
+            return "server_error"
+        if status == 408:
+            return "timeout"
+        if 400 <= status < 500:
+            return "client_error"
+        return "other"
+    if name == "RateLimitError":
+        return "rate_limit"
+    if "timeout" in lname:
+        return "timeout"
+    if name in ("APIConnectionError", "ConnectError", "ConnectionError") or isinstance(exc, ConnectionError):
+        return "connection"
+    # No status and no known exception type: fall back to the message
+    text = str(exc).lower()
+    if "rate limit" in text or "429" in text:
+        return "rate_limit"
+    if "timed out" in text or "timeout" in text:
+        return "timeout"
+    if "connection" in text:
+        return "connection"
+    return "other"
+
+def retry_delay_seconds(exc: BaseException, attempt: int) -> float:
+    """
+    Back-off before retrying a failed call. Honors Retry-After on 429 responses,
+    otherwise uses capped exponential back-off for throttling/server errors and 1s for the rest.
+    """
+    kind = classify_llm_error(exc)
+    if kind == "rate_limit":
+        try:
+            headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+            retry_after = headers.get("retry-after") or headers.get("Retry-After")
+            if retry_after:
+                return max(1.0, min(float(retry_after), 60.0))
+        except Exception:
+            pass
+        return float(min(2 ** attempt, 30))
+    if kind in ("server_error", "timeout", "connection"):
+        return float(min(2 ** (attempt - 1), 10))
+    return 1.0
+
+class _TokenBucket:
+    """Continuous-refill bucket sized for one minute of budget"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.tokens = self.capacity
+        self.refill_per_second = self.capacity / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+            self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken (0 if available now)"""
+        self._refill(now)
+        # A single request larger than the whole bucket is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class _ModelLimiter:
+    """Limits and AIMD state for one model"""
+
+    def __init__(self, model: str):
+        cfg = _OVERRIDES.get(model.lower(), {})
+        self.model = model
+        self.rpm = int(cfg.get("rpm", DEFAULT_RPM))
+        self.tpm = int(cfg.get("tpm", DEFAULT_TPM))
+        self.min_concurrency = max(1, int(cfg.get("min_concurrency", MIN_CONCURRENCY)))
+        self.max_concurrency = max(self.min_concurrency, int(cfg.get("max_concurrency", MAX_CONCURRENCY)))
+        initial = int(cfg.get("initial_concurrency", INITIAL_CONCURRENCY))
+        self.limit = float(max(self.min_concurrency, min(self.max_concurrency, initial)))
+        self.request_bucket = _TokenBucket(self.rpm)
+        self.token_bucket = _TokenBucket(self.tpm)
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency_ewma: Optional[float] = None
+        self.last_decrease = 0.0
+        self.stats = {
+            "requests": 0,
+            "successes": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "latency_spikes": 0,
+            "decreases": 0,
+            "queue_waits": 0,
+            "queue_wait_total_seconds": 0.0,
+            "queue_wait_max_seconds": 0.0,
+            "queue_timeouts": 0,
+        }
+
+    def on_success(self, latency: float) -> None:
+        spike = (
+            self.latency_ewma is not None
+            and latency > LATENCY_SPIKE_FACTOR * self.latency_ewma
+            and latency > 5.0
+        )
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        self.stats["successes"] += 1
+        if spike:
+            self.stats["latency_spikes"] += 1
+            self._decrease(f"latency spike {latency:.1f}s")
+        else:
+            # Additive increase: roughly +1 per `limit` successful calls
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / max(self.limit, 1.0))
+
+    def on_error(self, kind: str) -> None:
+        self.stats["errors"] += 1
+        if kind == "rate_limit":
+            self.stats["rate_limited"] += 1
+            self._decrease("HTTP 429")
+        elif kind in ("server_error", "timeout"):
+            self.stats["server_errors"] += 1
+            self._decrease(kind)
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        # One back-off per cooldown window, so a burst of failures from the same
+        # overload does not collapse the limit to the minimum at once
+        if now - self.last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        self.last_decrease = now
+        old = self.limit
+        self.limit = max(float(self.min_concurrency), self.limit * DECREASE_FACTOR)
+        self.stats["decreases"] += 1
+        logger.warning(f"[llm_limiter] {self.model}: concurrency {old:.2f} -> {self.limit:.2f} ({reason})")
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self.request_bucket._refill(now)
+        self.token_bucket._refill(now)
+        waits = self.stats["queue_waits"]
+        return {
+            "model": self.model,
+            "concurrency_limit": round(self.limit, 2),
+            "min_concurrency": self.min_concurrency,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rpm_limit": self.rpm,
+            "rpm_available": int(self.request_bucket.tokens),
+            "tpm_limit": self.tpm,
+            "tpm_available": int(self.token_bucket.tokens),
+            "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "avg_queue_wait_seconds": round(self.stats["queue_wait_total_seconds"] / waits, 3) if waits else 0.0,
+            **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in self.stats.items()},
+        }
+
+class LLMSlot:
+    """Handle for one admitted call; lets the caller reconcile the token estimate"""
+
+    def __init__(self, limiter: "_ModelLimiter", reserved_tokens: int):
+        self._limiter = limiter
+        self.reserved_tokens = reserved_tokens
+        self.actual_tokens: Optional[int] = None
+
+    def set_actual_tokens(self, tokens: int) -> None:
+        self.actual_tokens = int(tokens or 0)
+
+class LLMRateLimiter:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._models: Dict[str, _ModelLimiter] = {}
+
+    def _get(self, model: str) -> _ModelLimiter:
+        key = (model or "default").strip()
+        lim = self._models.get(key.lower())
+        if lim is None:
+            lim = _ModelLimiter(key)
+            self._models[key.lower()] = lim
+        return lim
+
+    @contextmanager
+    def acquire(self, model: str, estimated_tokens: int = 0, timeout: Optional[float] = None):
+        """
+        Block until the model has a free concurrency slot and RPM/TPM budget, then run the body.
+        Errors raised by the body are classified and fed back into the AIMD controller.
+        Raises OperationCancelled when the waiting caller's session is cancelled.
+        """
+        timeout = QUEUE_TIMEOUT_SECONDS if timeout is None else timeout
+        estimated_tokens = max(0, int(estimated_tokens or 0))
+        start = time.monotonic()
+        with self._cond:
+            lim = self._get(model)
+            lim.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = 0.0
+                    if lim.in_flight >= int(lim.limit):
+                        wait = 0.5
+                    else:
+                        wait = max(lim.request_bucket.wait_time(1, now),
+                                   lim.token_bucket.wait_time(estimated_tokens, now))
+                    if wait <= 0:
+                        break
+                    # Stop queueing for a session that was cancelled meanwhile
+                    check_cancelled()
+                    if now - start + min(wait, 0.5) > timeout:
+                        # timeout=0 is a non-blocking attempt (hedges), not a queue timeout
+                        if timeout > 0:
+                            lim.stats["queue_timeouts"] += 1
+                        raise LLMQueueTimeout(f"Timed out after {timeout:.0f}s waiting for an LLM slot ({lim.model})")
+                    self._cond.wait(min(wait, 0.5))
+            finally:
+                lim.waiting -= 1
+            lim.request_bucket.take(1)
+            lim.token_bucket.take(estimated_tokens)
+            lim.in_flight += 1
+            lim.stats["requests"] += 1
+            waited = time.monotonic() - start
+            if waited > 0.01:
+                lim.stats["queue_waits"] += 1
+                lim.stats["queue_wait_total_seconds"] += waited
+                lim.stats["queue_wait_max_seconds"] = max(lim.stats["queue_wait_max_seconds"], waited)
+
+        slot = LLMSlot(lim, estimated_tokens)
+        call_start = time.monotonic()
+        outcome: Optional[str] = None
+        try:
+            yield slot
+            outcome = "success"
+        except GeneratorExit:
+            # Streaming consumer went away: release without judging the backend
+            raise
+        except Exception as e:
+            outcome = classify_llm_error(e)
+            raise
+        finally:
+            latency = time.monotonic() - call_start
+            with self._cond:
+                lim.in_flight -= 1
+                if slot.actual_tokens is not None:
+                    diff = slot.actual_tokens - slot.reserved_tokens
+                    if diff > 0:
+                        lim.token_bucket.take(diff)
+                    elif diff < 0:
+                        lim.token_bucket.give_back(-diff)
+                if outcome == "success":
+                    lim.on_success(latency)
+                elif outcome is not None:
+                    lim.on_error(outcome)
+                self._cond.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "defaults": {
+                    "rpm": DEFAULT_RPM,
+                    "tpm": DEFAULT_TPM,
+                    "min_concurrency": MIN_CONCURRENCY,
+                    "max_concurrency": MAX_CONCURRENCY,
+                    "queue_timeout_seconds": QUEUE_TIMEOUT_SECONDS,
+                },
+                "models": [lim.snapshot() for lim in self._models.values()],
+            }
+
+# Process-wide instance shared by all endpoints
+llm_limiter = LLMRateLimiter()
@@ -23,13 +23,23 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+# First, so that STARTUP_PROFILE=1 times every import below
+from startup_profiler import startup_profiler, step as startup_step
+startup_profiler.install()
+
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import time
 import uvicorn
 from config import setup_logging
-from routes import router
+with startup_step("import_routes"):
+    from routes import router
+from job_service import job_queue
+from session_store import session_store
+from token_ledger import token_ledger
 import auth
+import atexit
+from warmup import model_warmup, WARMUP_ON_STARTUP
 import os
 import shutil
 import csv
@@ -123,8 +133,9 @@ def ensure_pricing_csv(resolved_path: str, project_root: str, pricing_model: str
 
 @app.on_event("startup")
 def _init_auth():
-    auth.init_auth_db()
-    auth.create_initial_admin()
+    with startup_step("auth_db"):
+        auth.init_auth_db()
+        auth.create_initial_admin()
     # Restore PRICING_FILE from DB (persists across restarts)
     try:
         cfg = auth.get_config()
@@ -148,11 +159,53 @@ def _init_auth():
     except Exception as e:
         logger.warning(f"[startup] Failed to restore PRICING_FILE: {e}")
 
+@app.on_event("startup")
+async def _start_job_workers():
+    # Resumes jobs interrupted by the previous shutdown
+    with startup_step("job_queue"):
+        await job_queue.start()
+
+@app.on_event("shutdown")
+async def _stop_job_workers():
+    await job_queue.stop()
+
+@app.on_event("startup")
+async def _start_model_warmup():
+    # Models load in the background; login, admin and static routes are served meanwhile
+    if WARMUP_ON_STARTUP:
+        model_warmup.start()
+
+@app.on_event("startup")
+async def _start_session_sweeper():
+    session_store.start_sweeper()
+
+@app.on_event("startup")
+async def _import_token_logs():
+    # Text logs of earlier versions; files already imported are skipped line-exactly
+    threading.Thread(target=token_ledger.import_text_logs, name="token-log-import", daemon=True).start()
+
+@app.on_event("shutdown")
+async def _stop_token_ledger():
+    # Writes the usage records still queued
+    token_ledger.stop()
+
+@app.on_event("startup")
+async def _startup_complete():
+    # Registered last: every other startup hook has run
+    startup_profiler.mark_started()
+    if not WARMUP_ON_STARTUP:
+        startup_profiler.write_report()
+
+@app.on_event("shutdown")
+async def _stop_session_sweeper():
+    await session_store.stop_sweeper()
+
 # Add static file service
 frontend_build_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "frontend", "build"))
 if os.path.isdir(frontend_build_dir):
-    app.mount("/static", StaticFiles(directory=os.path.join(frontend_build_dir, "static")), name="static")
-    app.mount("/", StaticFiles(directory=frontend_build_dir, html=True), name="frontend")
+    with startup_step("static_mounts"):
+        app.mount("/static", StaticFiles(directory=os.path.join(frontend_build_dir, "static")), name="static")
+        app.mount("/", StaticFiles(directory=frontend_build_dir, html=True), name="frontend")
 else:
     logger.warning(f"[startup] Frontend build not found at {frontend_build_dir}; serving API only.")
 # Add the following code before uvicorn.run()
@@ -190,4 +243,28 @@ if __name__ == "__main__":
             logger.warning(f"Failed to log route info for {route}: {e}")
     
     logger.info("Server will be available at: http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Several workers share sessions, the KB registry and cancel flags through state_backend
+    # (STATE_BACKEND); the bundled executable always runs a single process
+    workers = int(os.environ.get("UVICORN_WORKERS", "1") or 1)
+    # Remote embedding mode: one server process holds the model for all workers
+    # (checked before importing embedding_service, which local mode never needs here;
+    # .env is otherwise only read once rag_service loads)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"), override=False)
+    except Exception:
+        pass
+    if (os.environ.get("EMBEDDING_SERVICE", "local") or "local").strip().lower() == "remote":
+        import embedding_service
+        if not embedding_service.server_available():
+            if getattr(sys, 'frozen', False):
+                logger.warning("EMBEDDING_SERVICE=remote but no embedding server is running; start embedding_service separately")
+            else:
+                logger.info("Starting embedding server process")
+                embedding_proc = embedding_service.start_server_process()
+                atexit.register(embedding_proc.terminate)
+    if workers > 1 and not getattr(sys, 'frozen', False):
+        logger.info(f"Starting {workers} worker processes")
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Cheap-first model cascade for checklist rows.
+
+A row is first answered by a cheap model from the pricing catalog; the answer is
+escalated to the admin-configured (strong) model when confidence signals say the
+cheap answer is not good enough.
+"""
+
+import os
+import re
+import logging
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CASCADE_ENABLED = str(os.environ.get("LLM_CASCADE_ENABLED", "false")).lower() in ("1", "true", "yes")
+# Explicit cheap model; empty = cheapest priced model in the pricing catalog
+CASCADE_CHEAP_MODEL = os.environ.get("LLM_CASCADE_CHEAP_MODEL", "").strip()
+# Query types that go through the cascade (batch summary etc. always use the strong model)
+CASCADE_QUERY_TYPES = {
+    t.strip().lower() for t in os.environ.get("LLM_CASCADE_QUERY_TYPES", "hint,aet").split(",") if t.strip()
+}
+# A refusal or a very short answer is only trusted when retrieval also looked weak
+ESCALATE_MIN_SIMILARITY = float(os.environ.get("LLM_CASCADE_ESCALATE_SIMILARITY", "0.5") or 0.5)
+MIN_ANSWER_CHARS = int(os.environ.get("LLM_CASCADE_MIN_ANSWER_CHARS", "120") or 120)
+
+REFUSAL_RE = re.compile(
+    r"(no relevant (information|evidence|content)|not (mentioned|found|provided|specified|addressed)"
+    r"|does not (contain|mention|provide|include)|no (information|evidence) (is |was )?(available|found|provided)"
+    r"|cannot be determined|unable to (find|determine|locate)|insufficient (information|evidence)"
+    r"|未提及|没有相关|无相关|未找到|无法确定)",
+    re.IGNORECASE,
+)
+
+TIER_CHEAP = "cheap"
+TIER_STRONG = "strong"
+
+def _cheapest_priced_model(exclude: str) -> Optional[str]:
+    try:
+        from token_utils import _get_pricing_table, normalize_model_name
+        _, table = _get_pricing_table()
+    except Exception as e:
+        logger.debug(f"Pricing catalog unavailable for cascade: {e}")
+        return None
+    strong = normalize_model_name(exclude, table)
+    strong_price = table.get(strong)
+    best_name, best_price = None, None
+    for name, prices in table.items():
+        in_cost, out_cost = prices[0], prices[1]
+        if name == strong or in_cost <= 0 or out_cost <= 0:
+            continue
+        # Blend assuming answers are ~1/4 of the prompt size
+        price = in_cost + out_cost / 4.0
+        if best_price is None or price < best_price:
+            best_name, best_price = name, price
+    if best_name and strong_price:
+        strong_blend = strong_price[0] + strong_price[1] / 4.0
+        if best_price >= strong_blend:
+            return None
+    return best_name
+
+def pick_cheap_model(strong_model: str, querytype: str) -> Optional[str]:
+    """Cheap model to try first for this call, or None to go straight to the strong model"""
+    if not CASCADE_ENABLED:
+        return None
+    if str(querytype or "").lower() not in CASCADE_QUERY_TYPES:
+        return None
+    cheap = CASCADE_CHEAP_MODEL or _cheapest_priced_model(strong_model)
+    if not cheap or cheap.strip().lower() == str(strong_model or "").strip().lower():
+        return None
+    return cheap
+
+def escalation_reason(cheap_result: Dict[str, Any], context_docs: List[Dict[str, Any]]) -> Optional[str]:
+    """Why the cheap answer should be redone by the strong model; None to accept it"""
+    if cheap_result.get("error_type"):
+        return f"cheap tier failed ({cheap_result['error_type']})"
+    answer = str(cheap_result.get("answer") or "").strip()
+    top_similarity = max((float(d.get("similarity_score") or 0.0) for d in context_docs), default=0.0)
+    strong_context = top_similarity >= ESCALATE_MIN_SIMILARITY
+    if REFUSAL_RE.search(answer[:400]) and strong_context:
+        return f"refusal despite relevant context (top similarity {top_similarity:.2f})"
+    if len(answer) < MIN_ANSWER_CHARS and strong_context:
+        return f"short answer ({len(answer)} chars) with relevant context"
+    return None
+
+def merge_tokens(*token_dicts: Optional[Dict[str, int]]) -> Dict[str, int]:
+    merged = {"input": 0, "output": 0, "cached": 0}
+    for t in token_dicts:
+        for k in merged:
+            merged[k] += int((t or {}).get(k, 0) or 0)
+    return merged
@@ -23,11 +23,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Literal
 from pydantic import BaseModel
 
 class ExcelData(BaseModel):
     data: List[Dict[str, Any]]
+    dataset_id: Optional[str] = None  # server-side copy; reference it instead of posting the rows back
 
 class PDFUploadResponse(BaseModel):
     success: bool
@@ -42,6 +43,8 @@ class QueryRequest(BaseModel):
     query: str
     hint: Optional[str] = None
     aet: Optional[str] = None
+    mode: Optional[Literal["llm", "retrieval"]] = "llm"  # "retrieval": evidence passages only, no LLM call
+    summarize: Optional[bool] = False  # retrieval mode: add an extractive summary
 
 class QueryResponse(BaseModel):
     success: bool
@@ -51,7 +54,11 @@ class QueryResponse(BaseModel):
     error: Optional[str] = None
 
 class BatchQueryRequest(BaseModel):
-    data: List[Dict[str, Any]]
+    data: Optional[List[Dict[str, Any]]] = None
+    dataset_id: Optional[str] = None  # alternative to data: an uploaded dataset
+    rows: Optional[List[int]] = None  # row selection within the dataset (default: all rows)
+    mode: Optional[Literal["llm", "retrieval"]] = "llm"  # "retrieval": pre-fill evidence without the LLM
+    summarize: Optional[bool] = False
 
 class BatchQueryResponse(BaseModel):
     success: bool
@@ -60,7 +67,9 @@ class BatchQueryResponse(BaseModel):
     error: Optional[str] = None
 
 class RetryFailedRequest(BaseModel):
-    data: List[Dict[str, Any]]  # Complete Excel Data Rows
-    failed_indices: List[int]  # Row indices requiring reprocessing
+    data: Optional[List[Dict[str, Any]]] = None  # Complete Excel Data Rows
+    dataset_id: Optional[str] = None  # alternative to data: an uploaded dataset
+    session_id: Optional[str] = None  # alternative to data: retry in place on a cached batch session
+    failed_indices: Optional[List[int]] = None  # Row indices requiring reprocessing (default: all failed rows)
     max_retry_rounds: Optional[int] = 5  # Maximum retry rounds
     auto_retry: Optional[bool] = True  # Whether to automatically retry until successful
\ No newline at end of file
@@ -23,17 +23,39 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import json
 import logging
 from models import QueryRequest, QueryResponse, BatchQueryRequest, BatchQueryResponse
-from rag_service import query_existing_knowledge_base
+from request_coalescer import BatchDeduplicator
+from evidence_service import build_evidence_answer
+from clause_index import row_clause_text
+from streaming_service import resolve_rows
 from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
 
 logger = logging.getLogger(__name__)
 
 class QueryService:
+    @staticmethod
+    def _build_full_query(request: QueryRequest) -> str:
+        """Append hint/AET background information to the user query"""
+        full_query = request.query
+        
+        # If a hint or AET is provided, add it to the query.
+        context_parts = []
+        if request.hint and request.hint.strip():
+            context_parts.append(f"Hint information: {request.hint}")
+        if request.aet and request.aet.strip():
+            context_parts.append(f"AET information: {request.aet}")
+        
+        if context_parts:
+            full_query = f"{request.query}\n\nbackground information:\n" + "\n".join(context_parts)
+        return full_query
+
     @staticmethod
     def single_query(request: QueryRequest) -> QueryResponse:
         """Single knowledge base query"""
+        from rag_service import query_existing_knowledge_base, query_evidence_only
         logger.info(f"Received knowledge base query request: {request.query[:100]}...")
         
         if not request.query.strip():
@@ -41,20 +63,13 @@ class QueryService:
             raise HTTPException(status_code=400, detail="Please provide query content")
         
         try:
-            full_query = request.query
-            
-            # If a hint or AET is provided, add it to the query.
-            context_parts = []
-            if request.hint and request.hint.strip():
-                context_parts.append(f"Hint information: {request.hint}")
-            if request.aet and request.aet.strip():
-                context_parts.append(f"AET information: {request.aet}")
+            full_query = QueryService._build_full_query(request)
             
-            if context_parts:
-                full_query = f"{request.query}\n\nbackground information:\n" + "\n".join(context_parts)
-            
-            logger.info(f"Start querying knowledge base: {full_query[:100]}...")
-            result = query_existing_knowledge_base(full_query)
+            logger.info(f"Start querying knowledge base ({request.mode or 'llm'}): {full_query[:100]}...")
+            if request.mode == "retrieval":
+                result = query_evidence_only(full_query, summarize=bool(request.summarize))
+            else:
+                result = query_existing_knowledge_base(full_query)
             
             if result["success"]:
                 logger.info(f"Knowledge base query completed successfully")
@@ -74,16 +89,109 @@ class QueryService:
         except Exception as e:
             logger.error(f"Knowledge base query error: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Knowledge base query error: {str(e)}")
+
+    @staticmethod
+    def single_query_stream(request: QueryRequest) -> StreamingResponse:
+        """
+        Streaming single knowledge base query (SSE).
+        Events: "retrieval" (referenced pages, sent before the LLM call), "token" (answer deltas),
+        then "complete" (sanitized answer, referenced pages, token usage) or "error".
+        """
+        logger.info(f"Received streaming knowledge base query request: {request.query[:100]}...")
+        
+        if not request.query.strip():
+            logger.warning("Query content is empty")
+            raise HTTPException(status_code=400, detail="Please provide query content")
+        
+        full_query = QueryService._build_full_query(request)
+
+        # Sync generator: Starlette iterates it in a worker thread, so the blocking
+        # retrieval/LLM calls do not stall the event loop.
+        def generate_answer():
+            from rag_service import retrieve_relevant_docs, stream_ai_response, collect_referenced_pages
+            try:
+                retrieval = retrieve_relevant_docs(full_query)
+                if not retrieval["success"]:
+                    logger.error(f"Knowledge base query failed: {retrieval['error']}")
+                    yield f"data: {json.dumps({'type': 'error', 'success': False, 'error': retrieval['error']}, ensure_ascii=False)}\n\n"
+                    return
+                relevant_docs = retrieval["docs"]
+                retrieval_event = {
+                    "type": "retrieval",
+                    "relevant_docs_found": len(relevant_docs),
+                    "referenced_pages": collect_referenced_pages(relevant_docs)
+                }
+                yield f"data: {json.dumps(retrieval_event, ensure_ascii=False)}\n\n"
+
+                if request.mode == "retrieval":
+                    complete_event = {
+                        "type": "complete",
+                        "success": True,
+                        "answer": build_evidence_answer(full_query, relevant_docs, summarize=bool(request.summarize)),
+                        "referenced_pages": retrieval_event["referenced_pages"],
+                        "relevant_docs_found": len(relevant_docs),
+                        "tokens": {"input": 0, "output": 0, "cached": 0},
+                        "mode": "retrieval"
+                    }
+                    yield f"data: {json.dumps(complete_event, ensure_ascii=False)}\n\n"
+                    return
+
+                for event in stream_ai_response(full_query, "general", relevant_docs):
+                    if event["type"] == "complete":
+                        event = {
+                            "type": "complete",
+                            "success": True,
+                            "answer": event["answer"],
+                            "referenced_pages": event["referenced_pages"],
+                            "relevant_docs_found": len(relevant_docs),
+                            "tokens": event["tokens"]
+                        }
+                        logger.info("Streaming knowledge base query completed successfully")
+                    elif event["type"] == "error":
+                        event = {"type": "error", "success": False, "error": event["error"]}
+                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            except Exception as e:
+                logger.error(f"Streaming knowledge base query error: {str(e)}", exc_info=True)
+                error_result = {
+                    "type": "error",
+                    "success": False,
+                    "error": f"Knowledge base query error: {str(e)}"
+                }
+                yield f"data: {json.dumps(error_result, ensure_ascii=False)}\n\n"
+
+        return StreamingResponse(
+            generate_answer(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no"
+            }
+        )
     
     @staticmethod
     def batch_query(request: BatchQueryRequest) -> BatchQueryResponse:
         """Batch query knowledge base"""
-        logger.info(f"Received batch query request, data rows: {len(request.data)}")
+        from rag_service import query_existing_knowledge_base, query_evidence_only, query_identity
+        data = resolve_rows(request.data, request.dataset_id, request.rows)
+        logger.info(f"Received batch query request, data rows: {len(data)}, mode: {request.mode or 'llm'}")
+        
+        if request.mode == "retrieval":
+            query_fn = lambda q, query_type, clause_text: query_evidence_only(q, query_type=query_type, summarize=bool(request.summarize), clause_text=clause_text)
+        else:
+            query_fn = query_existing_knowledge_base
+        
+        # Repeated Hint/AET texts are answered once per batch
+        dedup = BatchDeduplicator()
+        run_query = lambda q, query_type, clause_text: dedup.run(
+            query_identity(q, query_type, clause_text),
+            lambda: query_fn(q, query_type=query_type, clause_text=clause_text)
+        )
         
         try:
             results = []
-            for i, row in enumerate(request.data):
-                logger.info(f"Processing row {i+1}/{len(request.data)} data")
+            for i, row in enumerate(data):
+                logger.info(f"Processing row {i+1}/{len(data)} data")
                 
                 # Copy original row data
                 result_row = row.copy()
@@ -91,7 +199,7 @@ class QueryService:
                 # Query Hint data separately
                 if "Hint" in row and row["Hint"] and str(row["Hint"]).strip() and str(row["Hint"]).strip().lower() != 'nan':
                     hint_query = f"Find relevant evidence based on the following hint information: {row['Hint']}"
-                    hint_result = query_existing_knowledge_base(hint_query, query_type="hint")
+                    hint_result = run_query(hint_query, query_type="hint", clause_text=row_clause_text(row))
                     if hint_result["success"]:
                         result_row["Evidence Collected by AI"] = hint_result["answer"]
                         
@@ -115,7 +223,7 @@ class QueryService:
                 # Query AET data separately
                 if "AET" in row and row["AET"] and str(row["AET"]).strip() and str(row["AET"]).strip().lower() != 'nan':
                     aet_query = f"Find evidence related to the following AET: {row['AET']}"
-                    aet_result = query_existing_knowledge_base(aet_query, query_type="aet")
+                    aet_result = run_query(aet_query, query_type="aet", clause_text=row_clause_text(row))
                     if aet_result["success"]:
                         result_row["AET Evidence Collected by AI"] = aet_result["answer"]
                         
@@ -138,7 +246,7 @@ class QueryService:
                 
                 results.append(result_row)
             
-            logger.info(f"Batch query completed, processed {len(results)} rows of data")
+            logger.info(f"Batch query completed, processed {len(results)} rows of data, {dedup.reused} duplicate queries reused")
             
             # Add column count statistics log
             if results:
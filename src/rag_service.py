@@ -29,13 +29,31 @@ import pymupdf as fitz
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 from chromadb.api.models.Collection import Collection
 from langchain_openai import ChatOpenAI
 from langchain.schema import SystemMessage, HumanMessage
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 import re
+import time
+import asyncio
+import hashlib
+from contextlib import ExitStack
+from llm_limiter import llm_limiter, LLMQueueTimeout, retry_delay_seconds, classify_llm_error
+from circuit_breaker import llm_breaker, CircuitOpenError
+from cancellation import OperationCancelled, check_cancelled, current_cancelled
+from state_backend import state_backend
+import orjson
+import zstandard
+import threading
+from latency_tracker import latency_tracker
+from backend_pool import backend_pool, BackendEndpoint
+from evidence_service import build_evidence_answer
+from clause_index import clause_index, extract_clause_refs
+from semantic_cache import semantic_cache, normalize_query
+from request_coalescer import query_coalescer
+from model_router import pick_cheap_model, escalation_reason, merge_tokens, TIER_CHEAP, TIER_STRONG
+from embedding_service import create_embedding_function
+from startup_profiler import step as startup_step
 
 # Disable telemetry
 os.environ['DISABLE_TELEMETRY'] = 'true'
@@ -49,48 +67,9 @@ except Exception:
     pass
 logger = logging.getLogger(__name__)
 
-# Define the embedding models (provider + fallback to local)
-EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "local").lower()
-EMBEDDING_HF_ID = os.environ.get("EMBEDDING_HF_ID", "BAAI/bge-small-en-v1.5")
-EMBEDDING_MS_ID = os.environ.get("EMBEDDING_MS_ID", "AI-ModelScope/bge-small-en-v1.5")
-
-project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-EMBEDDING_LOCAL_DIR = os.environ.get(
-    "EMBEDDING_LOCAL_DIR",
-    os.path.join(project_root, "models", "AI-ModelScope", "bge-small-en-v1___5"),
-)
-
-def resolve_embedding_model() -> str:
-    try:
-        if EMBEDDING_PROVIDER == "local":
-            if os.path.isdir(EMBEDDING_LOCAL_DIR):
-                logger.info(f"Using local embedding model: {EMBEDDING_LOCAL_DIR}")
-                return EMBEDDING_LOCAL_DIR
-            raise FileNotFoundError(f"Local embedding dir not found: {EMBEDDING_LOCAL_DIR}")
-
-        if EMBEDDING_PROVIDER == "modelscope":
-            try:
-                from modelscope.hub.snapshot_download import snapshot_download
-            except Exception as e:
-                logger.warning(f"ModelScope not available: {e}. Falling back to local/HF.")
-            else:
-                cache_dir = os.path.join(project_root, "models")
-                os.makedirs(cache_dir, exist_ok=True)
-                model_dir = snapshot_download(EMBEDDING_MS_ID, cache_dir=cache_dir)
-                logger.info(f"ModelScope model ready at: {model_dir}")
-                return model_dir
-
-        logger.info(f"Using HF embedding model id: {EMBEDDING_HF_ID}")
-        return EMBEDDING_HF_ID
-    except Exception as e:
-        logger.error(f"Resolve embedding model failed: {e}", exc_info=True)
-        if os.path.isdir(EMBEDDING_LOCAL_DIR):
-            logger.info(f"Falling back to local embedding at {EMBEDDING_LOCAL_DIR}")
-            return EMBEDDING_LOCAL_DIR
-        return EMBEDDING_HF_ID
-
-EMBEDDING_MODEL = resolve_embedding_model()
 BATCH_SIZE = 100  # Batch insert size for improved write performance
+# Output budget reserved in the TPM bucket before the real usage is known
+EXPECTED_OUTPUT_TOKENS = int(os.environ.get("LLM_EXPECTED_OUTPUT_TOKENS", "800") or 800)
 
 # LLM configuration
 MAX_AI_URL = os.environ.get("MAX_AI_URL", "")
@@ -171,30 +150,53 @@ llm_client = ChatOpenAI(
 # Log LLM initialization configuration
 logger.info(f"LLM client initialized - Model: {MAX_AI_MODEL}, Temperature: {TEMPERATURE}")
 
-def get_llm_client() -> ChatOpenAI:
+def get_llm_client(model: Optional[str] = None, endpoint: Optional[BackendEndpoint] = None) -> ChatOpenAI:
     """
     Create a ChatOpenAI client using the latest Admin configuration (model/temperature).
+    model overrides the configured model (used by the cheap-first cascade).
+    endpoint is the backend leased from backend_pool; MAX_AI_URL/MAX_API_KEY when omitted.
+    The timeout follows the model's observed latency (see latency_tracker), capped at LLM_TIMEOUT.
     Falls back to the static llm_client if dynamic initialization fails.
     """
-    model = get_current_model()
+    model = model or get_current_model()
     temperature = get_current_temperature()
+    timeout = latency_tracker.timeout_for(model)
     try:
         return ChatOpenAI(
-            base_url=MAX_AI_URL,
-            api_key=MAX_API_KEY,
+            base_url=endpoint.url if endpoint else MAX_AI_URL,
+            api_key=endpoint.api_key if endpoint else MAX_API_KEY,
             model=model,
             temperature=temperature,
-            default_headers=MAX_AI_HEADERS,
-            timeout=90,
-            request_timeout=90,
+            default_headers=endpoint.headers if endpoint else MAX_AI_HEADERS,
+            timeout=timeout,
+            request_timeout=timeout,
         )
     except Exception as e:
         logger.warning(f"Dynamic LLM client initialization failed, falling back to static client: {e}")
         return llm_client
 
 # Initialize ChromaDB (in-memory, non-persistent)
-chroma_client = chromadb.Client()
-embedding_function = SentenceTransformerEmbeddingFunction(model_name=EMBEDDING_MODEL)
+with startup_step("chroma_client"):
+    chroma_client = chromadb.Client()
+# In-process model, or a client of the shared embedding server (EMBEDDING_SERVICE=remote)
+with startup_step("embedding_function"):
+    embedding_function = create_embedding_function()
+
+# Content hash of the chunks currently in the knowledge base; caches key on it
+_kb_state: Dict[str, Any] = {"version": None, "next_sync": 0.0}
+_kb_sync_lock = threading.Lock()
+# How often a worker checks the shared KB registry for a knowledge base loaded by another worker
+KB_SYNC_SECONDS = float(os.environ.get("KB_SYNC_SECONDS", "2") or 2)
+
+def get_kb_version() -> Optional[str]:
+    return _kb_state["version"]
+
+def _compute_kb_version(documents: List[Document]) -> str:
+    h = hashlib.sha1()
+    for doc in documents:
+        h.update(str(doc.metadata.get("chunk_id", "")).encode("utf-8"))
+        h.update(doc.page_content.encode("utf-8", errors="ignore"))
+    return h.hexdigest()[:16]
 
 def collection_exists(client, collection_name):
     """Check if a collection exists in ChromaDB"""
@@ -276,13 +278,53 @@ def load_pdf_from_bytes(pdf_bytes: bytes, filename: str) -> List[Document]:
         logger.error(f"Error processing PDF {filename}: {str(e)}")
         return []
 
-def store_documents_in_chromadb(documents: List[Document], collection_name: str = "pdf_knowledge_base"):
-    """Store documents in ChromaDB (temporary, in-memory)"""
+def _publish_kb(documents: List[Document], version: str) -> None:
+    """Register the knowledge base in the shared state backend so other workers load the same chunks"""
+    try:
+        payload = orjson.dumps([{"text": d.page_content, "metadata": d.metadata} for d in documents])
+        state_backend.set("kb", "chunks", zstandard.ZstdCompressor(level=3).compress(payload))
+        # Written last: a worker that sees the new version finds its chunks already there
+        state_backend.set("kb", "version", version.encode())
+    except Exception as e:
+        logger.warning(f"Failed to publish knowledge base to the shared state backend: {e}")
+
+def sync_knowledge_base() -> None:
+    """
+    Load the knowledge base another worker registered, if it differs from this worker's.
+    Each worker has its own in-memory Chroma, so the chunks are re-embedded locally.
+    """
+    now = time.monotonic()
+    if now < _kb_state["next_sync"]:
+        return
+    with _kb_sync_lock:
+        if time.monotonic() < _kb_state["next_sync"]:
+            return
+        try:
+            remote = state_backend.get("kb", "version")
+            if remote is None or remote.decode() == _kb_state["version"]:
+                return
+            compressed = state_backend.get("kb", "chunks")
+            if compressed is None:
+                return
+            chunks = orjson.loads(zstandard.ZstdDecompressor().decompress(compressed))
+            documents = [Document(page_content=c["text"], metadata=c["metadata"]) for c in chunks]
+            logger.info(f"Loading knowledge base {remote.decode()} registered by another worker ({len(documents)} chunks)")
+            store_documents_in_chromadb(documents, publish=False)
+        except Exception as e:
+            logger.warning(f"Knowledge base sync failed: {e}")
+        finally:
+            _kb_state["next_sync"] = time.monotonic() + KB_SYNC_SECONDS
+
+def store_documents_in_chromadb(documents: List[Document], collection_name: str = "pdf_knowledge_base",
+                                publish: bool = True):
+    """Store documents in ChromaDB (temporary, in-memory); publish registers them for the other workers"""
     try:
         # Delete existing collection if it exists (as per user requirement)
         if collection_exists(chroma_client, collection_name):
             logger.debug(f"Recreating collection '{collection_name}'")
             chroma_client.delete_collection(collection_name)
+        clause_index.clear()
+        _kb_state["version"] = None
         
         # Create a new collection (will be deleted after use)
         collection = chroma_client.create_collection(
@@ -308,6 +350,10 @@ def store_documents_in_chromadb(documents: List[Document], collection_name: str
             )
         
         logger.info(f"Documents stored in collection '{collection_name}': {len(documents)} chunks")
+        clause_index.build(documents)
+        _kb_state["version"] = _compute_kb_version(documents)
+        if publish:
+            _publish_kb(documents, _kb_state["version"])
         return collection
         
     except Exception as e:
@@ -382,60 +428,59 @@ def _load_prompt_config_safely():
     except Exception:
         return {}
 
-def generate_ai_response(query: str, querytype: str, context_docs: List[Dict[str, Any]]) -> Dict[str, Any]:
-    """Generate AI response based on query and context documents"""
-    try:
-        # Prepare context from retrieved documents
-        context_text = "\n\n".join([
-            f"[Page {doc['metadata']['page']} from {doc['metadata']['source']}]\n{doc['content']}"
-            for doc in context_docs
-        ])
-        
-        # ==== Admin Prompt: choose system prompt based on config ====
-        prompt_cfg = _load_prompt_config_safely() or {}
-        mode = str(prompt_cfg.get("prompt_mode", "type_specific")).strip()
-
-        # Default built-in fallback to avoid degradation when config is empty
-        default_hint = (
-            "You are a professional document analysis assistant.\n"
-            "Query Type: Hint Analysis.\n"
-            "For each evidence item, provide separate analysis with 'Evidence' and 'Analysis' sections.\n"
-            "Answer only based on provided documents."
-        )
-        default_aet = (
-            "You are a professional document analysis assistant.\n"
-            "Focus on AET-related evidence from provided documents.\n"
-            "Answer only based on provided documents."
-        )
-        default_general = (
-            "You are a professional document analysis assistant.\n"
-            "Answer only based on provided documents."
-        )
+def _build_prompt_messages(query: str, querytype: str, context_docs: List[Dict[str, Any]]):
+    """Build the (system, human) message pair for an evidence query."""
+    # Prepare context from retrieved documents
+    context_text = "\n\n".join([
+        f"[Page {doc['metadata']['page']} from {doc['metadata']['source']}]\n{doc['content']}"
+        for doc in context_docs
+    ])
+    
+    # ==== Admin Prompt: choose system prompt based on config ====
+    prompt_cfg = _load_prompt_config_safely() or {}
+    mode = str(prompt_cfg.get("prompt_mode", "type_specific")).strip()
 
-        hint_prompt = (prompt_cfg.get("prompt_hint") or "").strip() or default_hint
-        aet_prompt = (prompt_cfg.get("prompt_aet") or "").strip() or default_aet
-        general_prompt = (prompt_cfg.get("prompt_general") or "").strip() or default_general
+    # Default built-in fallback to avoid degradation when config is empty
+    default_hint = (
+        "You are a professional document analysis assistant.\n"
+        "Query Type: Hint Analysis.\n"
+        "For each evidence item, provide separate analysis with 'Evidence' and 'Analysis' sections.\n"
+        "Answer only based on provided documents."
+    )
+    default_aet = (
+        "You are a professional document analysis assistant.\n"
+        "Focus on AET-related evidence from provided documents.\n"
+        "Answer only based on provided documents."
+    )
+    default_general = (
+        "You are a professional document analysis assistant.\n"
+        "Answer only based on provided documents."
+    )
 
-        qt = str(querytype or "").lower()
-        if mode == "general_only":
+    hint_prompt = (prompt_cfg.get("prompt_hint") or "").strip() or default_hint
+    aet_prompt = (prompt_cfg.get("prompt_aet") or "").strip() or default_aet
+    general_prompt = (prompt_cfg.get("prompt_general") or "").strip() or default_general
+
+    qt = str(querytype or "").lower()
+    if mode == "general_only":
+        chosen_prompt = general_prompt
+    elif mode == "fallback_general":
+        if qt == "hint":
+            chosen_prompt = hint_prompt or general_prompt
+        elif qt == "aet":
+            chosen_prompt = aet_prompt or general_prompt
+        else:
+            chosen_prompt = general_prompt
+    else:  # type_specific
+        if qt == "hint":
+            chosen_prompt = hint_prompt
+        elif qt == "aet":
+            chosen_prompt = aet_prompt
+        else:
             chosen_prompt = general_prompt
-        elif mode == "fallback_general":
-            if qt == "hint":
-                chosen_prompt = hint_prompt or general_prompt
-            elif qt == "aet":
-                chosen_prompt = aet_prompt or general_prompt
-            else:
-                chosen_prompt = general_prompt
-        else:  # type_specific
-            if qt == "hint":
-                chosen_prompt = hint_prompt
-            elif qt == "aet":
-                chosen_prompt = aet_prompt
-            else:
-                chosen_prompt = general_prompt
 
-        # Hard constraints and tone: always append; ensure no inline references
-        base_policy = """
+    # Hard constraints and tone: always append; ensure no inline references
+    base_policy = """
 General Requirements:
 1. Answer questions based only on the provided document content.
 2. If there is no relevant information, state this clearly.
@@ -449,62 +494,259 @@ Tone and Style Policy:
 4. Prefer neutral, impersonal phrasing; avoid first/second-person.
 5. Maintain consistent terminology and structured layout (headings or bullets if needed).
 6. Language: match the user's input language. If Chinese, use formal business Chinese.
+
+Answer Format:
+Provide a detailed answer only. Do NOT include any inline references or page numbers in the answer (no "Reference:" sections).
+Use a formal, objectivetype_specific, compliance-oriented tone suitable for audit reports. Start directly with the findings.
+Avoid any conversational openers (e.g., "Certainly", "Sure", "Of course", "好的", "当然") and do not include greetings or exclamation marks.
 """
-        system_message = SystemMessage(content=f"{chosen_prompt}\n\n{base_policy}")
-        # ==== End Admin Prompt ====
-        
-        human_message = HumanMessage(content=f"""
+    system_message = SystemMessage(content=f"{chosen_prompt}\n\n{base_policy}")
+    # ==== End Admin Prompt ====
+
+    # Prompt layout for provider prefix caching: static parts first (system prompt, policy),
+    # then the document context shared by rows hitting the same chunks, and only then the
+    # per-call variable parts (query type, question).
+    human_message = HumanMessage(content=f"""
 Answer the question based on the following document content:
-Query Type:
-{querytype}
 
-Document Content:   
+Document Content:
 {context_text}
 
-Question: {query}
+Query Type:
+{querytype}
 
-Provide a detailed answer only. Do NOT include any inline references or page numbers in the answer (no "Reference:" sections). 
-Use a formal, objectivetype_specific, compliance-oriented tone suitable for audit reports. Start directly with the findings.
-Avoid any conversational openers (e.g., "Certainly", "Sure", "Of course", "好的", "当然") and do not include greetings or exclamation marks.
+Question: {query}
 """)
+    return system_message, human_message
+
+def collect_referenced_pages(context_docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Unique (source, page, similarity) entries of the retrieved chunks, in rank order"""
+    referenced_pages = []
+    for doc in context_docs:
+        page_info = {
+            "source": doc['metadata']['source'],
+            "page": doc['metadata']['page'],
+            "similarity_score": doc['similarity_score']
+        }
+        if page_info not in referenced_pages:
+            referenced_pages.append(page_info)
+    return referenced_pages
+
+def _record_token_usage(client, input_tokens: int, answer_text: str, response, caller_method: str,
+                        tier: Optional[str] = None, latency_seconds: Optional[float] = None) -> Dict[str, int]:
+    """
+    Work out the token usage of one LLM call and write it to the token log.
+    Provider-reported usage (including prompt-cache hits) wins over local tiktoken estimates.
+    """
+    try:
+        from token_utils import log_token_usage, extract_usage_from_response
+        import tiktoken
+    except Exception as _:
+        tiktoken = None
+        log_token_usage = None
+        extract_usage_from_response = None
+
+    output_tokens = 0
+    if tiktoken:
+        try:
+            encoder = tiktoken.get_encoding("cl100k_base")
+            output_tokens = len(encoder.encode(str(answer_text)))
+        except Exception as _:
+            output_tokens = 0
+
+    cached_tokens = 0
+    if extract_usage_from_response:
+        usage = extract_usage_from_response(response)
+        input_tokens = usage["input"] or input_tokens
+        output_tokens = usage["output"] or output_tokens
+        cached_tokens = usage["cached"]
+
+    used_model = getattr(client, "model_name", None) or get_current_model()
+    if log_token_usage:
+        try:
+            log_token_usage(used_model, input_tokens, output_tokens, caller_method,
+                            cached_input_tokens=cached_tokens, tier=tier,
+                            latency_seconds=latency_seconds)
+        except Exception as _:
+            pass
+    return {"input": input_tokens, "output": output_tokens, "cached": cached_tokens}
+
+def _settle_slot_tokens(slot, response, input_tokens: int) -> None:
+    """Replace the limiter's TPM reservation with the tokens the call actually used"""
+    try:
+        from token_utils import extract_usage_from_response
+        usage = extract_usage_from_response(response)
+    except Exception:
+        return
+    if usage["output"]:
+        slot.set_actual_tokens((usage["input"] or input_tokens) + usage["output"])
+
+def _invoke_llm(client, messages, model_name: str, input_tokens: int,
+                endpoint: Optional[BackendEndpoint] = None):
+    """
+    Blocking LLM call that feeds the latency tracker. With hedging enabled, a duplicate
+    request fires once the call runs past the model's p95, on another backend than the
+    primary's (endpoint) when one is healthy; the first good answer wins and the other
+    request is cancelled.
+    """
+    hedge_after = latency_tracker.hedge_delay_for(model_name)
+    latency_tracker.count_request(model_name)
+    start = time.monotonic()
+    if hedge_after is None:
+        response = client.invoke(messages)
+    else:
+        # Runs in a worker thread (to_thread/threadpool), so there is no running loop here
+        response = asyncio.run(_invoke_hedged(client, messages, model_name, input_tokens, hedge_after, endpoint))
+    latency_tracker.record(model_name, time.monotonic() - start)
+    return response
+
+async def _invoke_hedged(client, messages, model_name: str, input_tokens: int, hedge_after: float,
+                         endpoint: Optional[BackendEndpoint] = None):
+    primary = asyncio.ensure_future(client.ainvoke(messages))
+    done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+    if done:
+        return primary.result()
+    # A cancelled run never pays for a second request
+    if current_cancelled():
+        return await primary
+    # The backup is a request of its own: it needs a free limiter slot right now (RPM, TPM,
+    # concurrency) and is skipped otherwise; at most LLM_HEDGE_MAX_RATIO of requests are hedged
+    with ExitStack() as stack:
+        try:
+            hedge_slot = stack.enter_context(llm_limiter.acquire(model_name, input_tokens + EXPECTED_OUTPUT_TOKENS,
+                                                                 timeout=0))
+        except LLMQueueTimeout:
+            return await primary
+        if not latency_tracker.try_reserve_hedge(model_name, input_tokens):
+            return await primary
+
+        # Its own backend lease: counted in the pool's outstanding requests, and sent away from
+        # the primary's (slow) endpoint. A backup cancelled as the loser is released as neutral.
+        hedge_endpoint = backend_pool.acquire(exclude=endpoint)
+        hedge_started = time.monotonic()
+        hedge_outcome = {"error": None, "neutral": True}
+        stack.callback(lambda: backend_pool.release(hedge_endpoint, hedge_outcome["error"],
+                                                    time.monotonic() - hedge_started, hedge_outcome["neutral"]))
+        hedge_client = get_llm_client(model_name, hedge_endpoint) if hedge_endpoint is not endpoint else client
+
+        logger.info(f"Hedging LLM call for {model_name} after {hedge_after:.1f}s (p95) on {hedge_endpoint.name}")
+        backup = asyncio.ensure_future(hedge_client.ainvoke(messages))
+        pending = {primary, backup}
+        first_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is backup:
+                    hedge_outcome.update(error=task.exception(), neutral=False)
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if task is backup:
+                        latency_tracker.record_hedge_win(model_name)
+                    response = task.result()
+                    if pending:
+                        hedge_slot.set_actual_tokens(_log_hedge_loser(model_name, input_tokens, response))
+                    return response
+                first_error = first_error or task.exception()
+        raise first_error
+
+def _log_hedge_loser(model_name: str, input_tokens: int, winner_response) -> int:
+    """
+    The cancelled request of a hedged pair may already be billed. Its usage is unknown, so
+    the ledger gets an estimate: the full prompt plus as much output as the winner produced.
+    """
+    output_tokens = 0
+    try:
+        from token_utils import log_token_usage, extract_usage_from_response
+        output_tokens = extract_usage_from_response(winner_response)["output"]
+        log_token_usage(model_name, input_tokens, output_tokens, "hedged duplicate (estimated)")
+    except Exception as e:
+        logger.debug(f"Failed to record hedged duplicate usage: {e}")
+    return input_tokens + output_tokens
+
+def _count_input_tokens(messages) -> int:
+    try:
+        from token_utils import num_tokens_from_messages
+    except Exception as _:
+        return 0
+    return num_tokens_from_messages(messages, "cl100k_base")
+
+def generate_ai_response(query: str, querytype: str, context_docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Generate AI response based on query and context documents.
+    With LLM_CASCADE_ENABLED, checklist rows are answered by a cheap model first and only
+    escalated to the configured model when the cheap answer looks unreliable (see model_router).
+    """
+    strong_model = get_current_model()
+    cheap_model = pick_cheap_model(strong_model, querytype)
+    if not cheap_model:
+        return _generate_with_model(query, querytype, context_docs)
+
+    cheap_result = _generate_with_model(query, querytype, context_docs, model=cheap_model, tier=TIER_CHEAP)
+    reason = escalation_reason(cheap_result, context_docs)
+    if reason is None:
+        cheap_result["tier"] = TIER_CHEAP
+        cheap_result["model"] = cheap_model
+        return cheap_result
+
+    logger.info(f"Escalating {querytype} row from {cheap_model} to {strong_model}: {reason}")
+    strong_result = _generate_with_model(query, querytype, context_docs, tier=TIER_STRONG)
+    # The row pays for both tiers
+    strong_result["tokens"] = merge_tokens(cheap_result.get("tokens"), strong_result.get("tokens"))
+    strong_result["tier"] = TIER_STRONG
+    strong_result["model"] = strong_model
+    strong_result["escalation_reason"] = reason
+    return strong_result
+
+def _generate_with_model(query: str, querytype: str, context_docs: List[Dict[str, Any]],
+                         model: Optional[str] = None, tier: Optional[str] = None) -> Dict[str, Any]:
+    """One generation with a given model (default: the configured one) and its retry loop"""
+    try:
+        system_message, human_message = _build_prompt_messages(query, querytype, context_docs)
         
         logger.info(f"AI query processing started: {query[:100]}{'...' if len(query) > 100 else ''}")
         logger.debug(f"Context documents: {len(context_docs)}")
 
-        # Create dynamic LLM client based on current configuration
-        client = get_llm_client()
+        model_name = model or get_current_model()
         # Log actual model and temperature used for troubleshooting
-        try:
-            # ChatOpenAI object attribute names and implementation may differ, this is for logging display only
-            logger.info(f"Calling AI - Model: {client.model_name if hasattr(client, 'model_name') else 'N/A'}, Temperature: {get_current_temperature()}, QueryType: {querytype}")
-        except Exception:
-            pass
+        logger.info(f"Calling AI - Model: {model_name}, Temperature: {get_current_temperature()}, QueryType: {querytype}")
         
-        # ===== Token Stats: calculate input tokens before API call =====
-        try:
-            from token_utils import num_tokens_from_messages, log_token_usage
-            import tiktoken
-        except Exception as _:
-            num_tokens_from_messages = None
-            tiktoken = None
-            log_token_usage = None
-    
-        input_tokens = 0
-        if num_tokens_from_messages:
-            input_tokens = num_tokens_from_messages([system_message, human_message], "cl100k_base")
-        # ===== End: input token statistics =====
+        # Token Stats: calculate input tokens before API call
+        input_tokens = _count_input_tokens([system_message, human_message])
         
         # Generate response using invoke method with retry mechanism
         max_retries = 6
         retry_count = 0
         last_exception = None
+        started = time.monotonic()
         
         while retry_count < max_retries:
+            # The session this call runs for may have been cancelled meanwhile (raises OperationCancelled)
+            check_cancelled()
+            # Fail fast while the backend is known to be down (raises CircuitOpenError)
+            llm_breaker.allow_request()
             try:
-                response = client.invoke([system_message, human_message])
+                # Every attempt takes a slot from the process-wide limiter shared by all endpoints
+                with llm_limiter.acquire(model_name, input_tokens + EXPECTED_OUTPUT_TOKENS) as slot:
+                    # Each attempt goes to the least-loaded healthy backend, so retries move away from a failing one
+                    with backend_pool.lease() as endpoint:
+                        client = get_llm_client(model_name, endpoint)
+                        response = _invoke_llm(client, [system_message, human_message], model_name, input_tokens,
+                                               endpoint)
+                    _settle_slot_tokens(slot, response, input_tokens)
+                llm_breaker.record_success()
                 break  # Success, exit retry loop
+            except LLMQueueTimeout:
+                llm_breaker.record_neutral()
+                raise
+            except OperationCancelled:
+                # Raised while waiting for a slot; says nothing about the backend, but a
+                # half-open probe admitted above must give its slot back
+                llm_breaker.record_neutral()
+                raise
             except Exception as e:
                 error_str = str(e)
+                llm_breaker.record_failure(classify_llm_error(e), error_str)
                 
                 # Check for specific API server errors that shouldn't be retried
                 if "violations" in error_str and "KeyError" in error_str:
@@ -512,7 +754,8 @@ Avoid any conversational openers (e.g., "Certainly", "Sure", "Of course", "好
                     return {
                         "answer": "Sorry, AI service is temporarily unavailable. Please try again later. If the problem persists, please contact technical support.",
                         "referenced_pages": [],
-                        "context_used": False
+                        "context_used": False,
+                        "error_type": "llm_config_error"
                     }
                 
                 retry_count += 1
@@ -520,98 +763,272 @@ Avoid any conversational openers (e.g., "Certainly", "Sure", "Of course", "好
                 logger.warning(f"AI API call failed (retry {retry_count}/{max_retries}): {error_str}")
                 
                 if retry_count < max_retries:
-                    import time
-                    time.sleep(1)  # Wait 1 second before retry
+                    # Longer back-off (or Retry-After) for 429/5xx, 1 second otherwise
+                    time.sleep(retry_delay_seconds(e, retry_count))
                 else:
                     raise last_exception
         
-        # Extract referenced pages
-        referenced_pages = []
-        for doc in context_docs:
-            page_info = {
-                "source": doc['metadata']['source'],
-                "page": doc['metadata']['page'],
-                "similarity_score": doc['similarity_score']
-            }
-            if page_info not in referenced_pages:
-                referenced_pages.append(page_info)
+        referenced_pages = collect_referenced_pages(context_docs)
         
         # Sanitize output
         answer_text = sanitize_ai_output(response.content)
-    
-        # ===== Token Stats: calculate output tokens after API call and write logs =====
-        output_tokens = 0
-        if tiktoken:
-            try:
-                encoder = tiktoken.get_encoding("cl100k_base")
-                output_tokens = len(encoder.encode(str(answer_text)))
-            except Exception as _:
-                output_tokens = 0
-    
-        if log_token_usage:
-            try:
-                log_token_usage(MAX_AI_MODEL, input_tokens, output_tokens, "generate_ai_response")
-            except Exception as _:
-                pass
-        # ===== End: output token statistics and logging =====
+        tokens = _record_token_usage(client, input_tokens, answer_text, response, "generate_ai_response",
+                                     tier=tier, latency_seconds=time.monotonic() - started)
     
         result = {
             "answer": answer_text,
             "referenced_pages": referenced_pages,
             "context_used": len(context_docs) > 0,
-            "tokens": {
-                "input": input_tokens,
-                "output": output_tokens
-            }
+            "tokens": tokens
         }
         
         logger.info(f"AI response generated successfully (length: {len(answer_text)} chars, pages: {len(referenced_pages)})")
         return result
 
+    except OperationCancelled:
+        logger.info("AI call skipped, session cancelled")
+        return {
+            "answer": "Query cancelled",
+            "referenced_pages": [],
+            "context_used": False,
+            "error_type": OperationCancelled.error_type
+        }
+    except CircuitOpenError as e:
+        logger.warning(f"AI call skipped, circuit open (retry after {e.retry_after:.0f}s)")
+        return {
+            "answer": "Sorry, AI service is temporarily unavailable. Please try again later.",
+            "referenced_pages": [],
+            "context_used": False,
+            "error_type": CircuitOpenError.error_type,
+            "retry_after": round(e.retry_after, 1)
+        }
     except Exception as e:
         logger.error(f"Error generating AI response: {str(e)}")
         return {
             "answer": "Error generating response. Please try again later.",
             "referenced_pages": [],
-            "context_used": False
+            "context_used": False,
+            "error_type": "llm_error"
         }
 
-def query_existing_knowledge_base(query: str, query_type: str = "general") -> Dict[str, Any]:
-    """Query existing knowledge base without uploading new PDF"""
+def stream_ai_response(query: str, querytype: str, context_docs: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of generate_ai_response.
+    Yields {"type": "token", "content": str} events as the model produces them, then one
+    {"type": "complete", ...} event carrying the sanitized answer, referenced pages and token usage.
+    On failure a {"type": "error", "error": str} event is yielded instead of "complete".
+    """
+    system_message, human_message = _build_prompt_messages(query, querytype, context_docs)
+    messages = [system_message, human_message]
+    logger.info(f"Streaming AI query started: {query[:100]}{'...' if len(query) > 100 else ''}")
+    input_tokens = _count_input_tokens(messages)
+
+    # Retry only while nothing has been sent to the caller yet; once tokens are out a retry
+    # would duplicate text, so mid-stream failures are reported as an error event.
+    max_retries = 6
+    retry_count = 0
+    model_name = get_current_model()
+    client = None
+    while True:
+        full = None
+        emitted = False
+        try:
+            llm_breaker.allow_request()
+        except CircuitOpenError as e:
+            logger.warning(f"Streaming AI call skipped, circuit open (retry after {e.retry_after:.0f}s)")
+            yield {"type": "error", "error": "Sorry, AI service is temporarily unavailable. Please try again later.",
+                   "error_type": CircuitOpenError.error_type, "retry_after": round(e.retry_after, 1)}
+            return
+        try:
+            latency_tracker.count_request(model_name)
+            with llm_limiter.acquire(model_name, input_tokens + EXPECTED_OUTPUT_TOKENS) as slot:
+                with backend_pool.lease() as endpoint:
+                    # Timed from here: queueing for a slot must not inflate the p95/p99
+                    # that drive timeouts and hedging
+                    call_start = time.monotonic()
+                    client = get_llm_client(model_name, endpoint)
+                    for chunk in client.stream(messages, stream_usage=True):
+                        full = chunk if full is None else full + chunk
+                        text = chunk.content if isinstance(chunk.content, str) else ""
+                        if text:
+                            emitted = True
+                            yield {"type": "token", "content": text}
+                _settle_slot_tokens(slot, full, input_tokens)
+            latency_tracker.record(model_name, time.monotonic() - call_start)
+            llm_breaker.record_success()
+            break
+        except GeneratorExit:
+            llm_breaker.record_neutral()
+            raise
+        except Exception as e:
+            if isinstance(e, LLMQueueTimeout):
+                llm_breaker.record_neutral()
+            else:
+                llm_breaker.record_failure(classify_llm_error(e), str(e))
+            retry_count += 1
+            logger.warning(f"Streaming AI call failed (retry {retry_count}/{max_retries}): {e}")
+            if emitted or retry_count >= max_retries or isinstance(e, LLMQueueTimeout):
+                logger.error(f"Error streaming AI response: {e}")
+                yield {"type": "error", "error": "Error generating response. Please try again later."}
+                return
+            time.sleep(retry_delay_seconds(e, retry_count))
+
+    raw_text = (full.content if full is not None and isinstance(full.content, str) else "")
+    answer_text = sanitize_ai_output(raw_text)
+    tokens = _record_token_usage(client, input_tokens, answer_text, full, "stream_ai_response")
+    yield {
+        "type": "complete",
+        "answer": answer_text,
+        "referenced_pages": collect_referenced_pages(context_docs),
+        "context_used": len(context_docs) > 0,
+        "tokens": tokens
+    }
+
+def lookup_clause_docs(collection, clause_text: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    """
+    Chunks of the clauses referenced in clause_text (template Element/Criteria), via the
+    ingestion-time clause index. Same shape as search_knowledge_base results; empty if no clause matches.
+    """
+    chunk_ids = clause_index.lookup(clause_text, limit=top_k)
+    if not chunk_ids:
+        return []
     try:
-        # Check if collection exists
-        collection_name = "pdf_knowledge_base"
-        if not collection_exists(chroma_client, collection_name):
-            return {
-                "success": False,
-                "error": "Knowledge base does not exist, please upload PDF file first"
-            }
-        
-        # Get the existing collection
-        collection = chroma_client.get_collection(
-            name=collection_name,
-            embedding_function=embedding_function
-        )
-        
+        found = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+    except Exception as e:
+        logger.warning(f"Clause lookup failed, falling back to vector search: {e}")
+        return []
+    by_id = {cid: (doc, meta) for cid, doc, meta in zip(found["ids"], found["documents"], found["metadatas"])}
+    results = []
+    for cid in chunk_ids:
+        if cid in by_id:
+            doc, meta = by_id[cid]
+            results.append({
+                "content": doc,
+                "metadata": meta,
+                "similarity_score": 1.0,  # exact clause match
+                "rank": len(results) + 1,
+                "match": "clause"
+            })
+    return results
+
+def retrieve_relevant_docs(query: str, clause_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Retrieval half of query_existing_knowledge_base.
+    clause_text (the row's Element/Criteria) is checked against the clause index first;
+    rows that name a clause found in the PDF skip the vector search.
+    Returns {"success": True, "docs": [...]} or {"success": False, "error": str}.
+    """
+    # Pick up a PDF uploaded through another worker process
+    sync_knowledge_base()
+    # Check if collection exists
+    collection_name = "pdf_knowledge_base"
+    if not collection_exists(chroma_client, collection_name):
+        return {
+            "success": False,
+            "error": "Knowledge base does not exist, please upload PDF file first"
+        }
+    
+    # Get the existing collection
+    collection = chroma_client.get_collection(
+        name=collection_name,
+        embedding_function=embedding_function
+    )
+    
+    relevant_docs = lookup_clause_docs(collection, clause_text) if clause_text else []
+    if relevant_docs:
+        logger.info(f"Clause index hit: {len(relevant_docs)} chunks, vector search skipped")
+    else:
         # Search for relevant documents
         relevant_docs = search_knowledge_base(query, collection)
-        if not relevant_docs:
-            return {
-                "success": False,
-                "error": "No relevant document content found"
-            }
+    if not relevant_docs:
+        return {
+            "success": False,
+            "error": "No relevant document content found"
+        }
+    return {"success": True, "docs": relevant_docs}
+
+def _estimate_cost(model_name: str, tokens: Dict[str, int]) -> float:
+    try:
+        from token_utils import calculate_token_cost
+        in_cost, out_cost = calculate_token_cost(model_name, tokens.get("input", 0), tokens.get("output", 0),
+                                                 tokens.get("cached", 0))
+        return in_cost + out_cost
+    except Exception:
+        return 0.0
+
+def _answer_config_fingerprint() -> str:
+    """Hash of everything besides the KB that shapes an answer (PUT /admin/prompts, /admin/config)"""
+    config = {
+        "model": get_current_model(),
+        "temperature": get_current_temperature(),
+        "prompts": _load_prompt_config_safely() or {},
+    }
+    return hashlib.sha256(orjson.dumps(config, default=str, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+def query_identity(query: str, query_type: str, clause_text: Optional[str] = None) -> tuple:
+    """Key under which identical knowledge-base queries are coalesced / deduplicated"""
+    return (get_kb_version(), query_type, normalize_query(query), tuple(extract_clause_refs(clause_text or "")))
+
+def query_existing_knowledge_base(query: str, query_type: str = "general", clause_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Query existing knowledge base without uploading new PDF.
+    Identical queries in flight at the same time (any session) share one retrieval + LLM call;
+    the callers that waited get the result with zero tokens and "coalesced": True.
+    """
+    result, shared = query_coalescer.do(
+        query_identity(query, query_type, clause_text),
+        lambda: _query_knowledge_base(query, query_type, clause_text)
+    )
+    if shared and result.get("error_type") == OperationCancelled.error_type:
+        # The session that ran the shared call was cancelled, not ours
+        return _query_knowledge_base(query, query_type, clause_text)
+    if shared:
+        result = {**result, "coalesced": True}
+        if result.get("success"):
+            result["tokens"] = {"input": 0, "output": 0, "cached": 0}
+    return result
+
+def _query_knowledge_base(query: str, query_type: str, clause_text: Optional[str]) -> Dict[str, Any]:
+    try:
+        retrieval = retrieve_relevant_docs(query, clause_text)
+        if not retrieval["success"]:
+            return retrieval
+        relevant_docs = retrieval["docs"]
+        
+        # Near-duplicate question over the same chunks of the same KB, answered with the
+        # current prompts/model/temperature: reuse the earlier answer
+        kb_version = get_kb_version()
+        cache_version = f"{kb_version}:{_answer_config_fingerprint()}" if kb_version else None
+        chunk_ids = [d["metadata"].get("chunk_id") for d in relevant_docs]
+        cached = semantic_cache.lookup(query, query_type, cache_version, chunk_ids, embedding_function)
+        if cached is not None:
+            logger.info(f"Semantic cache hit ({query_type}, similarity {cached['cache']['similarity']})")
+            return cached
         
         # Generate AI response
         logger.info(f"Knowledge base query started ({query_type}): {len(relevant_docs)} relevant documents found")
         ai_response = generate_ai_response(query, query_type, relevant_docs)    
         
-        return {
+        # LLM failures are reported as failed queries so batch/retry flows can pick the row up later
+        if ai_response.get("error_type"):
+            return {
+                "success": False,
+                "error": ai_response["answer"],
+                "error_type": ai_response["error_type"],
+                "retry_after": ai_response.get("retry_after")
+            }
+        
+        result = {
             "success": True,
             "answer": ai_response["answer"],
             "referenced_pages": ai_response["referenced_pages"],
             "relevant_docs_found": len(relevant_docs),
-            "tokens": ai_response.get("tokens", {"input": 0, "output": 0})
+            "tokens": ai_response.get("tokens", {"input": 0, "output": 0, "cached": 0}),
+            "tier": ai_response.get("tier")
         }
+        semantic_cache.store(query, query_type, cache_version, chunk_ids, result, embedding_function,
+                             cost=_estimate_cost(ai_response.get("model") or get_current_model(), result["tokens"]))
+        return result
     except Exception as e:
         logger.error(f"Knowledge base query failed: {str(e)}")
         return {
@@ -619,6 +1036,34 @@ def query_existing_knowledge_base(query: str, query_type: str = "general") -> Di
             "error": f"Error occurred during query process: {str(e)}"
         }
 
+def query_evidence_only(query: str, query_type: str = "general", summarize: bool = False,
+                        clause_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Retrieval-only variant of query_existing_knowledge_base: the top passages with their
+    best matching sentences highlighted (and an optional extractive summary), no LLM call.
+    Same result shape, with zero token usage and mode "retrieval".
+    """
+    try:
+        retrieval = retrieve_relevant_docs(query, clause_text)
+        if not retrieval["success"]:
+            return retrieval
+        relevant_docs = retrieval["docs"]
+        logger.info(f"Evidence-only query ({query_type}): {len(relevant_docs)} relevant documents found")
+        return {
+            "success": True,
+            "answer": build_evidence_answer(query, relevant_docs, summarize=summarize),
+            "referenced_pages": collect_referenced_pages(relevant_docs),
+            "relevant_docs_found": len(relevant_docs),
+            "tokens": {"input": 0, "output": 0, "cached": 0},
+            "mode": "retrieval"
+        }
+    except Exception as e:
+        logger.error(f"Evidence-only query failed: {str(e)}")
+        return {
+            "success": False,
+            "error": f"Error occurred during query process: {str(e)}"
+        }
+
 def process_pdf(pdf_bytes: bytes, filename: str) -> Dict[str, Any]:
     """Process PDF file and store in knowledge base without querying"""
     try:
@@ -0,0 +1,126 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Singleflight-style request coalescing.
+
+Identical queries (same KB version, query type and normalized query) that arrive
+while one is already being computed wait for that computation instead of running
+their own retrieval + LLM call. Callers run in worker threads, so waiting is a
+plain threading.Event.
+"""
+
+import logging
+import threading
+from typing import Dict, Any, Callable, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class RequestCoalescer:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, _Call] = {}
+        self._stats = {"calls": 0, "executions": 0, "collapsed": 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run fn() once per key at a time. Returns (result, shared); shared is True when the
+        result came from another caller's in-flight computation. Exceptions are shared too.
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._in_flight[key] = call
+                self._stats["executions"] += 1
+            else:
+                call.waiters += 1
+                self._stats["collapsed"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call.done.set()
+            if call.waiters:
+                logger.info(f"[coalesce:{self.name}] {call.waiters} duplicate call(s) served by one computation")
+        return call.result, False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            in_flight = len(self._in_flight)
+        return {
+            "name": self.name,
+            "in_flight": in_flight,
+            "collapse_ratio": round(stats["collapsed"] / stats["calls"], 4) if stats["calls"] else 0.0,
+            **stats,
+        }
+
+class BatchDeduplicator:
+    """
+    Per-batch memo: rows repeating an already answered query reuse that answer.
+    Only successful results are reused, so a failed duplicate is retried on its own.
+    """
+
+    def __init__(self):
+        self._results: Dict[Hashable, Dict[str, Any]] = {}
+        self.reused = 0
+
+    def run(self, key: Hashable, fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        hit = self._results.get(key)
+        if hit is not None:
+            self.reused += 1
+            # Tokens were already counted for the first copy
+            return {**hit, "tokens": {"input": 0, "output": 0, "cached": 0}, "deduplicated": True}
+        result = fn()
+        if result.get("success"):
+            self._results[key] = result
+        return result
+
+# Shared by every knowledge-base query path (single, batch, retry)
+query_coalescer = RequestCoalescer("kb_query")
@@ -24,13 +24,14 @@ SOFTWARE.
 """
 
 # Module: routes (add admin APIs)
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Response, UploadFile, File
 from models import *
 from file_service import FileService
 from query_service import QueryService
-from streaming_service import StreamingService
+from streaming_service import StreamingService, resolve_rows, failed_subqueries, row_succeeded
 import logging
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 import os
 import csv 
 from datetime import datetime, date
@@ -61,7 +62,31 @@ from auth import (
     get_keyword_configs as auth_get_keyword_configs,
     update_keyword_configs as auth_update_keyword_configs,
 )
-from token_utils import normalize_model_name
+from token_ledger import token_ledger
+from llm_limiter import llm_limiter
+from circuit_breaker import llm_breaker
+from latency_tracker import latency_tracker
+from backend_pool import backend_pool
+from clause_index import clause_index
+from semantic_cache import semantic_cache
+from request_coalescer import query_coalescer
+from job_service import job_queue, JOB_POLL_SECONDS
+from cancellation import cancel_registry
+from session_store import session_store
+from state_backend import state_backend
+from warmup import model_warmup
+from startup_profiler import startup_profiler
+from dataset_store import dataset_store, DatasetNotFound
+from sse_utils import (
+    stream_registry,
+    sse_response,
+    format_event,
+    heartbeat,
+    last_event_id,
+    SSE_HEADERS,
+    SSE_HEARTBEAT_SECONDS,
+    dumps,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -71,42 +96,192 @@ router = APIRouter()
 async def upload_file(file: UploadFile = File(...)):
     return await FileService.process_excel_file(file)
 
+@router.get("/datasets/{dataset_id}")
+async def get_dataset_info(dataset_id: str):
+    """Row count and columns of an uploaded checklist (checks that the handle is still valid)"""
+    try:
+        return await run_in_threadpool(dataset_store.info, dataset_id)
+    except DatasetNotFound:
+        raise HTTPException(status_code=404, detail="Dataset not found or expired")
+
 @router.post("/upload-pdf/", response_model=PDFUploadResponse)
 async def upload_pdf(file: UploadFile = File(...)):
+    await model_warmup.ensure_ready()
     return await FileService.process_pdf_file(file)
 
 @router.post("/query/", response_model=QueryResponse)
 async def query_knowledge_base(request: QueryRequest):
-    return QueryService.single_query(request)
+    await model_warmup.ensure_ready()
+    return await run_in_threadpool(QueryService.single_query, request)
+
+@router.post("/query-stream/")
+async def query_knowledge_base_stream(request: QueryRequest):
+    await model_warmup.ensure_ready()
+    return QueryService.single_query_stream(request)
 
 @router.post("/batch-query-stream/")
 async def batch_query_stream(request: BatchQueryRequest):
+    await model_warmup.ensure_ready()
     return await StreamingService.batch_query_stream(request)
 
 @router.post("/batch-query/", response_model=BatchQueryResponse)
 async def batch_query_knowledge_base(request: BatchQueryRequest):
-    return QueryService.batch_query(request)
+    await model_warmup.ensure_ready()
+    return await run_in_threadpool(QueryService.batch_query, request)
+
+@router.post("/cancel-batch/{session_id}")
+async def cancel_batch(session_id: str):
+    """Stop a running batch; finished rows are kept and the report estimates the tokens saved"""
+    return StreamingService.cancel(session_id, "batch")
 
-@router.post("/stop-retry/")
-async def stop_retry():
-    return StreamingService.stop_retry()
+@router.post("/cancel-retry/{session_id}")
+async def cancel_retry(session_id: str):
+    """Stop one running retry (the id from its session event); other users' retries continue"""
+    return StreamingService.cancel(session_id, "retry")
 
 @router.post("/retry-failed-stream/")
 async def retry_failed_records_stream(request: RetryFailedRequest):
+    await model_warmup.ensure_ready()
     return await StreamingService.retry_failed_stream(request)
 
+# -------- Background jobs (survive disconnects and restarts) --------
+@router.post("/jobs/batch")
+async def submit_batch_job(request: BatchQueryRequest):
+    """Queue a batch run; progress via /jobs/{job_id} and /jobs/{job_id}/events"""
+    params = {"mode": request.mode or "llm", "summarize": bool(request.summarize)}
+    data = await run_in_threadpool(resolve_rows, request.data, request.dataset_id, request.rows)
+    params["dataset_id"] = request.dataset_id
+    return await run_in_threadpool(job_queue.submit, "batch", data, params)
+
+@router.post("/jobs/retry")
+async def submit_retry_job(request: RetryFailedRequest):
+    """Queue a retry of the given failed rows; the other rows are carried over unchanged"""
+    params = {"max_retry_rounds": request.max_retry_rounds or 5, "auto_retry": request.auto_retry is not False}
+    if request.session_id:
+        cached = await run_in_threadpool(StreamingService.get_cached_data, request.session_id)
+        if not cached:
+            cached = await run_in_threadpool(job_queue.restore_session, request.session_id)
+        if not cached:
+            raise HTTPException(status_code=404, detail="Session data not found or expired")
+        data = cached["data"]
+        params["session_id"] = request.session_id
+    else:
+        data = await run_in_threadpool(resolve_rows, request.data, request.dataset_id)
+        params["dataset_id"] = request.dataset_id
+    targets = request.failed_indices
+    if targets is None:
+        targets = [i for i, row in enumerate(data) if failed_subqueries(row) or not row_succeeded(row)]
+    return await run_in_threadpool(job_queue.submit, "retry", data, params, targets)
+
+@router.get("/jobs")
+async def list_jobs(limit: int = 20, status: Optional[str] = None):
+    return await run_in_threadpool(job_queue.list_jobs, limit, status)
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = await run_in_threadpool(job_queue.cancel, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request, after: int = 0):
+    """
+    SSE subscription: one "row" event per checkpointed row, then a final event once the
+    job has finished. Event ids are row checkpoint sequence numbers, so a reconnect with
+    Last-Event-ID (or ?after=) continues where the client left off.
+    """
+    job = await run_in_threadpool(job_queue.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    resume_from = last_event_id(request)
+
+    async def events():
+        cursor = resume_from if resume_from is not None else after
+        idle = 0.0
+        while True:
+            job = await run_in_threadpool(job_queue.get, job_id)
+            rows = await run_in_threadpool(job_queue.rows_since, job_id, cursor)
+            for item in rows:
+                cursor = item["seq"]
+                event = {"type": "row", "job_id": job_id, "completed": item["seq"], "total": job["total"], **item}
+                yield format_event(event, item["seq"])
+            if rows:
+                idle = 0.0
+                continue
+            if job["status"] in ("completed", "failed", "cancelled"):
+                final = {
+                    "type": "complete" if job["status"] == "completed" else job["status"],
+                    "job_id": job_id,
+                    "session_id": job_id,
+                    "status": job["status"],
+                    "statistics": job["statistics"],
+                    "summary": job["summary"],
+                    "error": job["error"],
+                }
+                yield format_event(final)
+                return
+            # In-process checkpoints wake us at once; jobs run by another worker process
+            # are picked up by polling every JOB_POLL_SECONDS
+            if await job_queue.wait_for_change(JOB_POLL_SECONDS):
+                idle = 0.0
+                continue
+            idle += JOB_POLL_SECONDS
+            if idle >= SSE_HEARTBEAT_SECONDS:
+                idle = 0.0
+                yield heartbeat()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@router.get("/stream/{session_id}")
+async def resume_stream(session_id: str, request: Request):
+    """Reattach to a batch/retry event stream; replays events after Last-Event-ID, then follows live"""
+    stream = stream_registry.get(session_id)
+    if not stream:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    return sse_response(stream, last_event_id(request))
+
 @router.get("/test/")
 async def test_route():
     logger.info("Test route accessed")
     return {"message": "API service is running normally"}
 
+@router.get("/healthz")
+async def healthz():
+    """Liveness plus LLM backend state; "degraded" while the LLM circuit is not closed"""
+    circuit = llm_breaker.snapshot()
+    return {
+        "status": "ok" if circuit["state"] == "closed" else "degraded",
+        "llm_circuit": circuit,
+        "warmup": model_warmup.snapshot()
+    }
+
+@router.get("/readyz")
+async def readyz(response: Response):
+    """Readiness: 200 once the models are loaded, 503 while warming up or after a failed warm-up"""
+    warmup = model_warmup.snapshot()
+    if not warmup["ready"]:
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+    return {"status": "ready" if warmup["ready"] else warmup["state"], "warmup": warmup}
+
 
 @router.get("/download-excel/{session_id}")
 async def download_excel_by_session(session_id: str, background_tasks: BackgroundTasks, filename: str = None):
     """Download the Excel file directly by session ID"""
     try:
         # Get data from cache
-        cached_data = StreamingService.get_cached_data(session_id)
+        cached_data = await run_in_threadpool(StreamingService.get_cached_data, session_id)
+        if not cached_data:
+            # Background job results outlive the in-memory cache
+            cached_data = await run_in_threadpool(job_queue.restore_session, session_id)
         
         if not cached_data:
             raise HTTPException(status_code=404, detail="Session data not found or expired")
@@ -144,7 +319,7 @@ async def download_excel_by_session(session_id: str, background_tasks: Backgroun
 @router.get("/cache-status/{session_id}")
 async def get_cache_status(session_id: str):
     """Check the status of cached data"""
-    cached_data = StreamingService.get_cached_data(session_id)
+    cached_data = await run_in_threadpool(StreamingService.get_cached_data, session_id)
     
     if not cached_data:
         return {"exists": False, "message": "Session data not found or expired"}
@@ -157,10 +332,21 @@ async def get_cache_status(session_id: str):
         "expires_at": cached_data["expires_at"].isoformat()
     }
 
+@router.get("/session-data/{session_id}")
+async def get_session_data(session_id: str):
+    """Processed rows of a finished run, for clients that missed some row events"""
+    cached_data = await run_in_threadpool(StreamingService.get_cached_data, session_id)
+    if not cached_data:
+        cached_data = await run_in_threadpool(job_queue.restore_session, session_id)
+    if not cached_data:
+        raise HTTPException(status_code=404, detail="Session data not found or expired")
+    body = dumps({"session_id": session_id, "data": cached_data["data"], "statistics": cached_data["statistics"]})
+    return Response(content=body, media_type="application/json")
+
 @router.post("/cleanup-cache")
 async def cleanup_expired_cache():
     """Manually clean up expired cache"""
-    cleaned_count = StreamingService.cleanup_expired_cache()
+    cleaned_count = await run_in_threadpool(StreamingService.cleanup_expired_cache)
     return {"message": f"Cleaned {cleaned_count} expired cache entries"}
 
 
@@ -346,99 +532,144 @@ async def admin_model_catalog(request: Request, source: Optional[str] = None):
         raise HTTPException(status_code=500, detail=f"Failed to load model catalog: {e}")
 
 # -------- Admin: Token & Cost Metrics --------
-def _iter_token_usage_lines() -> List[str]:
-    token_dir = os.path.join(os.path.dirname(__file__), "token")
-    if not os.path.isdir(token_dir):
-        return []
-    lines: List[str] = []
-    for name in os.listdir(token_dir):
-        if name.endswith(".txt"):
-            path = os.path.join(token_dir, name)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    lines.extend(f.readlines())
-            except Exception:
-                continue
-    return lines
-
-TOKEN_LINE_RE = re.compile(
-    r"Timestamp:\s*(?P<ts>[\d\-:\s]+),\s*Model:\s*(?P<model>[^,]+),\s*Input Tokens:\s*(?P<input>\d+),\s*Output Tokens:\s*(?P<output>\d+).*Total Cost:\s*\$(?P<total>[0-9.]+)"
-)
-
-def _parse_ts(ts: str) -> Optional[datetime]:
-    try:
-        return datetime.strptime(ts.strip(), "%Y-%m-%d %H:%M:%S")
-    except Exception:
-        return None
-
 @router.get("/admin/metrics/tokens")
 async def admin_metrics_tokens(
     request: Request,
     date_from: Optional[str] = None,  # YYYY-MM-DD
     date_to: Optional[str] = None,    # YYYY-MM-DD
-    group_by: Optional[Literal["date", "model"]] = "date",
+    group_by: Optional[Literal["date", "model", "tier"]] = "date",
 ):
     require_admin(request)
 
     dt_from: Optional[date] = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else None
     dt_to: Optional[date] = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else None
+    return await run_in_threadpool(token_ledger.metrics, dt_from, dt_to, group_by or "date")
 
-    lines = _iter_token_usage_lines()
-    entries: List[Dict[str, Any]] = []
-    for line in lines:
-        m = TOKEN_LINE_RE.search(line)
-        if not m:
-            continue
-        ts = _parse_ts(m.group("ts"))
-        if not ts:
-            continue
-        d = ts.date()
-        if dt_from and d < dt_from:
-            continue
-        if dt_to and d > dt_to:
-            continue
-        model_raw = m.group("model").strip()
-        model = normalize_model_name(model_raw)
-        input_tokens = int(m.group("input"))
-        output_tokens = int(m.group("output"))
-        total_cost = float(m.group("total"))
-        entries.append({
-            "ts": ts,
-            "date": d.isoformat(),
-            "model": model,
-            "input": input_tokens,
-            "output": output_tokens,
-            "cost": total_cost
-        })
-
-    summary = {
-        "total_requests": len(entries),
-        "total_input_tokens": sum(e["input"] for e in entries),
-        "total_output_tokens": sum(e["output"] for e in entries),
-        "total_cost": round(sum(e["cost"] for e in entries), 6),
-    }
+@router.post("/admin/metrics/rollups/rebuild")
+async def admin_rebuild_token_rollups(request: Request):
+    """Recompute the per-day x model rollups from the raw token ledger"""
+    require_admin(request)
+    rows = await run_in_threadpool(token_ledger.rebuild_rollups)
+    return {"success": True, "rollup_rows": rows}
+
+@router.get("/admin/metrics/ledger")
+async def admin_token_ledger(request: Request):
+    """Token ledger size, write batching and text-log import counters"""
+    require_admin(request)
+    return await run_in_threadpool(token_ledger.snapshot)
 
-    if group_by == "model":
-        groups: Dict[str, Dict[str, Any]] = {}
-        for e in entries:
-            k = e["model"]
-            g = groups.setdefault(k, {"model": k, "input_tokens": 0, "output_tokens": 0, "cost": 0.0})
-            g["input_tokens"] += e["input"]
-            g["output_tokens"] += e["output"]
-            g["cost"] += e["cost"]
-        by_model = [{"model": k, "input_tokens": v["input_tokens"], "output_tokens": v["output_tokens"], "cost": round(v["cost"], 6)} for k, v in groups.items()]
-        return {"summary": summary, "by_model": by_model}
-    else:
-        groups: Dict[str, Dict[str, Any]] = {}
-        for e in entries:
-            k = e["date"]
-            g = groups.setdefault(k, {"date": k, "input_tokens": 0, "output_tokens": 0, "cost": 0.0})
-            g["input_tokens"] += e["input"]
-            g["output_tokens"] += e["output"]
-            g["cost"] += e["cost"]
-        by_date = [{"date": k, "input_tokens": v["input_tokens"], "output_tokens": v["output_tokens"], "cost": round(v["cost"], 6)} for k, v in sorted(groups.items())]
-        return {"summary": summary, "by_date": by_date}
 
+# -------- Admin: LLM rate limits --------
+@router.get("/admin/llm/limits")
+async def admin_llm_limits(request: Request):
+    """Current per-model RPM/TPM budgets, AIMD concurrency limits and queue waits"""
+    require_admin(request)
+    return llm_limiter.snapshot()
+
+@router.get("/admin/llm/circuit")
+async def admin_llm_circuit(request: Request):
+    """LLM circuit breaker state, sliding-window error rate and counters"""
+    require_admin(request)
+    return llm_breaker.snapshot()
+
+@router.get("/admin/llm/latency")
+async def admin_llm_latency(request: Request):
+    """Rolling p50/p95/p99 per model, the adaptive timeout in effect and hedging spend"""
+    require_admin(request)
+    return latency_tracker.snapshot()
+
+@router.post("/admin/llm/circuit/reset")
+async def admin_llm_circuit_reset(request: Request):
+    require_admin(request)
+    llm_breaker.reset()
+    return llm_breaker.snapshot()
+
+@router.get("/admin/kb/clauses")
+async def admin_kb_clauses(request: Request):
+    """Clause-number index of the current knowledge base and how often rows resolved through it"""
+    require_admin(request)
+    return clause_index.snapshot()
+
+@router.get("/admin/cache/semantic")
+async def admin_semantic_cache(request: Request):
+    """Semantic answer cache: hits, false hits caught by the chunk-overlap check, tokens/cost saved"""
+    require_admin(request)
+    return semantic_cache.snapshot()
+
+@router.get("/admin/cache/coalescing")
+async def admin_query_coalescing(request: Request):
+    """Identical in-flight knowledge-base queries collapsed onto one computation"""
+    require_admin(request)
+    return query_coalescer.snapshot()
+
+@router.get("/admin/streams")
+async def admin_event_streams(request: Request):
+    """Resumable batch/retry event streams kept for Last-Event-ID replay"""
+    require_admin(request)
+    return stream_registry.snapshot()
+
+@router.get("/admin/sessions")
+async def admin_sessions(request: Request):
+    """Session result cache occupancy: memory used vs budget, spilled sessions, hit rates"""
+    require_admin(request)
+    return await run_in_threadpool(session_store.snapshot)
+
+@router.get("/admin/state")
+async def admin_state_backend(request: Request):
+    """Shared state backend used across worker processes (kind and per-namespace usage)"""
+    require_admin(request)
+    return await run_in_threadpool(state_backend.snapshot)
+
+@router.get("/admin/embeddings")
+async def admin_embeddings(request: Request):
+    """Embedding mode; in remote mode the shared server's batching statistics"""
+    require_admin(request)
+    import embedding_service  # not needed until asked
+    if embedding_service.EMBEDDING_SERVICE != "remote":
+        return {"mode": "local"}
+    try:
+        info = await run_in_threadpool(embedding_service.RemoteEmbeddingFunction().ping)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Embedding server unavailable: {e}")
+    return {"mode": "remote", "address": embedding_service.EMBEDDING_SERVICE_ADDRESS,
+            "model": info["model"], "pid": info["pid"], **info["stats"]}
+
+@router.get("/admin/startup")
+async def admin_startup_profile(request: Request):
+    """Init step timings, warm-up state and (with STARTUP_PROFILE set) the slowest imports"""
+    require_admin(request)
+    return {**startup_profiler.report(), "warmup": model_warmup.snapshot()}
+
+@router.get("/admin/cancellations")
+async def admin_cancellations(request: Request):
+    """Running batch/retry/job sessions and what cancelling them has saved"""
+    require_admin(request)
+    return cancel_registry.snapshot()
+
+@router.get("/admin/datasets")
+async def admin_datasets(request: Request):
+    """Uploaded checklists kept server-side (count, disk usage, reuse)"""
+    require_admin(request)
+    return await run_in_threadpool(dataset_store.snapshot)
+
+@router.post("/admin/cache/semantic/clear")
+async def admin_semantic_cache_clear(request: Request):
+    require_admin(request)
+    semantic_cache.clear()
+    return semantic_cache.snapshot()
+
+@router.get("/admin/llm/backends")
+async def admin_llm_backends(request: Request):
+    """Per-endpoint state of the LLM backend pool: load, failures, ejections, latency"""
+    require_admin(request)
+    return backend_pool.snapshot()
+
+@router.post("/admin/llm/backends/{name}/readmit")
+async def admin_llm_backend_readmit(request: Request, name: str):
+    require_admin(request)
+    if not backend_pool.readmit(name):
+        raise HTTPException(status_code=404, detail=f"Unknown backend: {name}")
+    return backend_pool.snapshot()
 
 def _resolve_pricing_file(pricing_model: Optional[str]) -> Optional[str]:
     """
@@ -0,0 +1,223 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Semantic answer cache in front of query_existing_knowledge_base.
+
+Checklists repeat the same hint with small wording differences. A query is
+normalized and embedded; a previous answer is reused when
+  - it was produced against the same knowledge-base version and query type, with the
+    same prompts, model and temperature (the caller folds a fingerprint of those into
+    the version it passes, so an admin change invalidates answers in every worker),
+  - the normalized queries have cosine similarity >= SEMANTIC_CACHE_THRESHOLD, and
+  - the chunks retrieved now overlap the chunks the answer was built from
+    (Jaccard >= SEMANTIC_CACHE_MIN_OVERLAP).
+A query that passes the similarity test but fails the overlap test is counted as
+a false hit (it would have reused the wrong answer without the check).
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np  # imported on first lookup; only the warmed-up RAG path needs it
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = str(os.environ.get("SEMANTIC_CACHE_ENABLED", "true")).lower() in ("1", "true", "yes")
+SIMILARITY_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95") or 0.95)
+MIN_CHUNK_OVERLAP = float(os.environ.get("SEMANTIC_CACHE_MIN_OVERLAP", "0.6") or 0.6)
+MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "5000") or 5000)
+
+_POLITE_PREFIX = re.compile(
+    r"^(please|kindly|could you|can you)?\s*(provide|show|give|list|describe|confirm|check)?\s*(me)?\s*(with)?\s*(the|a|an)?\s+",
+    re.IGNORECASE,
+)
+_PUNCT = re.compile(r"[^\w\s\.]|(?<!\d)\.|\.(?!\d)")  # keep dots inside numbers like 2.5.4
+
+def normalize_query(query: str) -> str:
+    """Lower-case, drop punctuation (except in clause numbers), polite lead-ins and extra spaces"""
+    s = str(query or "").strip().lower()
+    s = _PUNCT.sub(" ", s)
+    s = re.sub(r"\s+", " ", s).strip()
+    s = _POLITE_PREFIX.sub("", s, count=1)
+    return s.strip()
+
+def _jaccard(a: List[str], b: List[str]) -> float:
+    sa, sb = set(a), set(b)
+    if not sa and not sb:
+        return 1.0
+    return len(sa & sb) / len(sa | sb)
+
+class _Entry:
+    __slots__ = ("key", "normalized", "query_type", "kb_version", "vector", "chunk_ids", "result", "created", "hits")
+
+    def __init__(self, key, normalized, query_type, kb_version, vector, chunk_ids, result):
+        self.key = key
+        self.normalized = normalized
+        self.query_type = query_type
+        self.kb_version = kb_version
+        self.vector = vector
+        self.chunk_ids = chunk_ids
+        self.result = result
+        self.created = time.time()
+        self.hits = 0
+
+class SemanticCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._kb_version: Optional[str] = None
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "exact_hits": 0,
+            "false_hits": 0,
+            "stores": 0,
+            "saved_input_tokens": 0,
+            "saved_output_tokens": 0,
+            "saved_cost": 0.0,
+        }
+
+    def _embed(self, embed: Callable[[List[str]], Any], text: str) -> Optional["np.ndarray"]:
+        import numpy as np
+        try:
+            vec = np.asarray(embed([text])[0], dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Semantic cache embedding failed: {e}")
+            return None
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+
+    def _sync_kb_version(self, kb_version: Optional[str]) -> None:
+        # Answers are only valid for the knowledge base they were built from
+        if kb_version != self._kb_version:
+            if self._entries:
+                logger.info(f"Knowledge base changed, dropping {len(self._entries)} semantic cache entries")
+            self._entries.clear()
+            self._kb_version = kb_version
+
+    def lookup(self, query: str, query_type: str, kb_version: Optional[str], chunk_ids: List[str],
+               embed: Callable[[List[str]], Any]) -> Optional[Dict[str, Any]]:
+        """Cached result for an equivalent query over the same chunks, or None"""
+        if not SEMANTIC_CACHE_ENABLED or not kb_version:
+            return None
+        normalized = normalize_query(query)
+        key = f"{query_type}\x00{normalized}"
+        with self._lock:
+            self._sync_kb_version(kb_version)
+            self._stats["lookups"] += 1
+            if not self._entries:
+                return None
+            exact = self._entries.get(key)
+        if exact is not None and _jaccard(exact.chunk_ids, chunk_ids) >= MIN_CHUNK_OVERLAP:
+            return self._hit(exact, exact=True)
+
+        vector = self._embed(embed, normalized)
+        if vector is None:
+            return None
+        with self._lock:
+            candidates = [e for e in self._entries.values() if e.query_type == query_type]
+        if not candidates:
+            return None
+        import numpy as np
+        sims = np.stack([e.vector for e in candidates]) @ vector
+        order = np.argsort(-sims)
+        rejected = False
+        for idx in order:
+            if sims[idx] < SIMILARITY_THRESHOLD:
+                break
+            entry = candidates[int(idx)]
+            if _jaccard(entry.chunk_ids, chunk_ids) >= MIN_CHUNK_OVERLAP:
+                return self._hit(entry, exact=False, similarity=float(sims[idx]))
+            rejected = True
+        if rejected:
+            with self._lock:
+                self._stats["false_hits"] += 1
+        return None
+
+    def _hit(self, entry: _Entry, exact: bool, similarity: float = 1.0) -> Dict[str, Any]:
+        tokens = entry.result.get("tokens") or {}
+        with self._lock:
+            entry.hits += 1
+            if entry.key in self._entries:
+                self._entries.move_to_end(entry.key)
+            self._stats["hits"] += 1
+            if exact:
+                self._stats["exact_hits"] += 1
+            self._stats["saved_input_tokens"] += int(tokens.get("input", 0) or 0)
+            self._stats["saved_output_tokens"] += int(tokens.get("output", 0) or 0)
+            self._stats["saved_cost"] += float(entry.result.get("_cost", 0.0) or 0.0)
+        result = {k: v for k, v in entry.result.items() if k != "_cost"}
+        # No tokens were spent for this row
+        result["tokens"] = {"input": 0, "output": 0, "cached": 0}
+        result["cache"] = {"hit": True, "similarity": round(similarity, 4), "source_query": entry.normalized}
+        return result
+
+    def store(self, query: str, query_type: str, kb_version: Optional[str], chunk_ids: List[str],
+              result: Dict[str, Any], embed: Callable[[List[str]], Any], cost: float = 0.0) -> None:
+        if not SEMANTIC_CACHE_ENABLED or not kb_version or not result.get("success"):
+            return
+        normalized = normalize_query(query)
+        vector = self._embed(embed, normalized)
+        if vector is None:
+            return
+        key = f"{query_type}\x00{normalized}"
+        entry = _Entry(key, normalized, query_type, kb_version, vector, list(chunk_ids), {**result, "_cost": cost})
+        with self._lock:
+            self._sync_kb_version(kb_version)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._stats["stores"] += 1
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            entries = len(self._entries)
+        lookups = stats["lookups"]
+        return {
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "threshold": SIMILARITY_THRESHOLD,
+            "min_chunk_overlap": MIN_CHUNK_OVERLAP,
+            "kb_version": self._kb_version,
+            "entries": entries,
+            "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+            **stats,
+            "saved_cost": round(stats["saved_cost"], 6),
+        }
+
+semantic_cache = SemanticCache()
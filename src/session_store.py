@@ -0,0 +1,235 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Processed batch/retry results per session, for /download-excel, /session-data and retries.
+
+Every stored session is orjson-encoded, zstd-compressed and written to the shared
+state backend (see state_backend), so any worker process can serve it. Each worker
+keeps recently used sessions decoded in memory up to SESSION_CACHE_MAX_BYTES (measured
+as their encoded size), least recently used first out; sessions not read for
+SESSION_COLD_SECONDS are dropped from memory as well. A memory hit is checked against
+the session's version in the backend, so a retry merged by another worker is never
+served stale. Sessions expire SESSION_TTL_HOURS after they were last stored; a
+background sweeper runs every SESSION_SWEEP_SECONDS.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+import orjson
+import zstandard
+
+from state_backend import state_backend
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_MAX_BYTES = int(os.environ.get("SESSION_CACHE_MAX_MB", "256") or 256) * 1024 * 1024
+SESSION_TTL_HOURS = float(os.environ.get("SESSION_TTL_HOURS", "2") or 2)
+SESSION_COLD_SECONDS = int(os.environ.get("SESSION_COLD_SECONDS", "600") or 600)
+SESSION_SWEEP_SECONDS = int(os.environ.get("SESSION_SWEEP_SECONDS", "60") or 60)
+_ZSTD_LEVEL = 3
+# Backend namespaces: compressed payloads, and their (small) current version tags
+_NS_DATA = "sessions"
+_NS_VERSION = "session_versions"
+
+def _encode(payload: Any) -> bytes:
+    # Same cell handling as the SSE payloads: NaN -> null, other cell types stringified
+    return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+class _Entry:
+    __slots__ = ("data", "statistics", "timestamp", "expires_at", "size", "version", "last_access")
+
+    def __init__(self, data: List[Dict[str, Any]], statistics: Dict[str, Any], timestamp: datetime,
+                 expires_at: datetime, size: int, version: str):
+        self.data = data
+        self.statistics = statistics
+        self.timestamp = timestamp
+        self.expires_at = expires_at
+        self.size = size
+        self.version = version
+        self.last_access = time.monotonic()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"data": self.data, "statistics": self.statistics,
+                "timestamp": self.timestamp, "expires_at": self.expires_at}
+
+class SessionStore:
+    def __init__(self, max_bytes: int = SESSION_CACHE_MAX_BYTES, backend=state_backend):
+        self._max_bytes = max_bytes
+        self._backend = backend
+        self._lock = threading.Lock()
+        self._hot: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._hot_bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        self._stats = {"stored": 0, "memory_hits": 0, "backend_loads": 0, "stale_reloads": 0, "misses": 0,
+                       "evicted": 0, "evicted_cold": 0, "expired": 0, "bytes_written": 0}
+
+    # ---------- shared tier ----------
+
+    def _write(self, session_id: str, entry: _Entry) -> int:
+        """Store the entry in the backend; returns its encoded size"""
+        raw = _encode({"data": entry.data, "statistics": entry.statistics, "version": entry.version,
+                       "timestamp": entry.timestamp.isoformat(), "expires_at": entry.expires_at.isoformat()})
+        compressed = zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(raw)
+        ttl = max((entry.expires_at - datetime.now()).total_seconds(), 1.0)
+        self._backend.set(_NS_DATA, session_id, compressed, ttl)
+        self._backend.set(_NS_VERSION, session_id, entry.version.encode(), ttl)
+        with self._lock:
+            self._stats["bytes_written"] += len(compressed)
+        logger.debug(f"Wrote session {session_id} to the {self._backend.name} state backend "
+                     f"({len(raw)} -> {len(compressed)} bytes)")
+        return len(raw)
+
+    def _read(self, session_id: str) -> Optional[_Entry]:
+        compressed = self._backend.get(_NS_DATA, session_id)
+        if compressed is None:
+            return None
+        raw = zstandard.ZstdDecompressor().decompress(compressed)
+        payload = orjson.loads(raw)
+        return _Entry(payload["data"], payload["statistics"], datetime.fromisoformat(payload["timestamp"]),
+                      datetime.fromisoformat(payload["expires_at"]), len(raw), payload["version"])
+
+    # ---------- memory tier ----------
+
+    def _admit(self, session_id: str, entry: _Entry) -> None:
+        with self._lock:
+            old = self._hot.pop(session_id, None)
+            if old is not None:
+                self._hot_bytes -= old.size
+            self._hot[session_id] = entry
+            self._hot_bytes += entry.size
+            # The newest entry stays even if it alone exceeds the budget; the others
+            # remain readable from the backend
+            while self._hot_bytes > self._max_bytes and len(self._hot) > 1:
+                _sid, victim = self._hot.popitem(last=False)
+                self._hot_bytes -= victim.size
+                self._stats["evicted"] += 1
+
+    def _drop(self, session_id: str) -> None:
+        with self._lock:
+            entry = self._hot.pop(session_id, None)
+            if entry is not None:
+                self._hot_bytes -= entry.size
+
+    def put(self, session_id: str, data: List[Dict[str, Any]], statistics: Dict[str, Any]) -> None:
+        now = datetime.now()
+        entry = _Entry(data, statistics, now, now + timedelta(hours=SESSION_TTL_HOURS), 0, uuid.uuid4().hex)
+        # Sized from the payload _write encodes anyway (the same measure _read uses)
+        entry.size = self._write(session_id, entry)
+        with self._lock:
+            self._stats["stored"] += 1
+        self._admit(session_id, entry)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._hot.get(session_id)
+        if entry is not None:
+            current = self._backend.get(_NS_VERSION, session_id)
+            if current is not None and current.decode() == entry.version and datetime.now() <= entry.expires_at:
+                with self._lock:
+                    if session_id in self._hot:
+                        self._hot.move_to_end(session_id)
+                    entry.last_access = time.monotonic()
+                    self._stats["memory_hits"] += 1
+                return entry.as_dict()
+            # Expired, or replaced by another worker since it was cached here
+            self._drop(session_id)
+            if current is not None:
+                with self._lock:
+                    self._stats["stale_reloads"] += 1
+
+        entry = self._read(session_id)
+        if entry is None or datetime.now() > entry.expires_at:
+            with self._lock:
+                self._stats["misses" if entry is None else "expired"] += 1
+            return None
+        with self._lock:
+            self._stats["backend_loads"] += 1
+        self._admit(session_id, entry)
+        return entry.as_dict()
+
+    def sweep(self) -> int:
+        """Drop expired and cold sessions from memory and purge expired backend keys; returns how many expired"""
+        now = datetime.now()
+        cold_before = time.monotonic() - SESSION_COLD_SECONDS
+        expired = cold = 0
+        with self._lock:
+            for sid, entry in list(self._hot.items()):
+                if now > entry.expires_at:
+                    expired += 1
+                elif entry.last_access < cold_before:
+                    cold += 1
+                else:
+                    continue
+                self._hot.pop(sid)
+                self._hot_bytes -= entry.size
+            self._stats["expired"] += expired
+            self._stats["evicted_cold"] += cold
+        purged = self._backend.purge_expired()
+        if expired or cold or purged:
+            logger.info(f"Session sweep: {expired} expired, {cold} cold session(s) dropped from memory, "
+                        f"{purged} expired backend key(s) purged")
+        return expired
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_SECONDS)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.warning(f"Session sweep failed: {e}")
+
+    def start_sweeper(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop_sweeper(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_sessions": len(self._hot),
+                "memory_bytes": self._hot_bytes,
+                "memory_budget_bytes": self._max_bytes,
+                "memory_utilization": round(self._hot_bytes / self._max_bytes, 4) if self._max_bytes else None,
+                "backend": self._backend.name,
+                "ttl_hours": SESSION_TTL_HOURS,
+                "cold_seconds": SESSION_COLD_SECONDS,
+                **self._stats,
+            }
+
+session_store = SessionStore()
@@ -0,0 +1,190 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Resumable server-sent event streams.
+
+A batch/retry run publishes its events into an EventStream owned by a background task,
+not by the HTTP response. Every event gets an increasing id and is kept in a per-session
+ring buffer, so a client that lost its connection reconnects to /stream/{session_id}
+with the Last-Event-ID header and receives the events it missed followed by the live
+tail. Idle connections get a comment line every SSE_HEARTBEAT_SECONDS so proxies do not
+close them during long LLM calls.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Any, Optional, AsyncIterator
+
+import orjson
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+SSE_BUFFER_EVENTS = int(os.environ.get("SSE_BUFFER_EVENTS", "2000") or 2000)
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15") or 15)
+# How long a finished stream stays available for replay
+SSE_RETENTION_SECONDS = int(os.environ.get("SSE_RETENTION_SECONDS", "600") or 600)
+# Minimum seconds between two progress events of one run
+SSE_PROGRESS_INTERVAL = float(os.environ.get("SSE_PROGRESS_INTERVAL", "0.5") or 0.5)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Content-Type": "text/event-stream",
+    # Disable response buffering in nginx-style proxies
+    "X-Accel-Buffering": "no",
+}
+
+def dumps(payload: Any) -> str:
+    """
+    Compact JSON via orjson. Excel cells may hold NaN (sent as null, which JSON.parse
+    accepts), timestamps and non-string column keys.
+    """
+    return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+def format_event(payload: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    data = dumps(payload)
+    if event_id is None:
+        return f"data: {data}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+def heartbeat() -> str:
+    return ": heartbeat\n\n"
+
+def last_event_id(request: Request) -> Optional[int]:
+    """Last-Event-ID header (or ?last_event_id= for clients that cannot set headers)"""
+    raw = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    try:
+        return int(raw) if raw not in (None, "") else None
+    except ValueError:
+        return None
+
+class EventStream:
+    def __init__(self, session_id: str, kind: str, maxlen: int = SSE_BUFFER_EVENTS):
+        self.session_id = session_id
+        self.kind = kind
+        self._buffer: deque = deque(maxlen=maxlen)  # (event_id, formatted event)
+        self._next_id = 1
+        self._changed = asyncio.Event()
+        self.closed = False
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def last_id(self) -> int:
+        return self._next_id - 1
+
+    def publish(self, payload: Dict[str, Any]) -> int:
+        event_id = self._next_id
+        self._next_id += 1
+        self._buffer.append((event_id, format_event(payload, event_id)))
+        self._wake()
+        return event_id
+
+    def close(self) -> None:
+        self.closed = True
+        self.finished = time.time()
+        self._wake()
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, after: Optional[int] = None) -> AsyncIterator[str]:
+        """Events with id > after (all buffered events when None), then the live tail"""
+        cursor = after or 0
+        while True:
+            # Taken before reading the buffer so an event published while we yield still wakes us
+            changed = self._changed
+            pending = [(i, text) for i, text in list(self._buffer) if i > cursor]
+            if pending and pending[0][0] > cursor + 1 and cursor:
+                # Older events fell out of the ring buffer; the client has to resync
+                yield format_event({"type": "replay_gap", "session_id": self.session_id,
+                                    "missed_from": cursor + 1, "resumed_at": pending[0][0]})
+            for i, text in pending:
+                cursor = i
+                yield text
+            if self.closed and cursor >= self.last_id:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield heartbeat()
+
+class StreamRegistry:
+    def __init__(self):
+        self._streams: Dict[str, EventStream] = {}
+
+    def start(self, session_id: str, kind: str, producer: AsyncIterator[Dict[str, Any]]) -> EventStream:
+        """Run producer (an async generator of event dicts) in the background, publishing into a new stream"""
+        self.sweep()
+        stream = EventStream(session_id, kind)
+        self._streams[session_id] = stream
+
+        async def pump():
+            try:
+                async for payload in producer:
+                    stream.publish(payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Event stream {session_id} producer failed: {e}", exc_info=True)
+                stream.publish({"type": "error", "success": False, "message": "Stream failed", "error": str(e)})
+            finally:
+                stream.close()
+
+        stream.task = asyncio.create_task(pump())
+        return stream
+
+    def get(self, session_id: str) -> Optional[EventStream]:
+        return self._streams.get(session_id)
+
+    def sweep(self) -> int:
+        now = time.time()
+        expired = [sid for sid, s in self._streams.items()
+                   if s.finished is not None and now - s.finished > SSE_RETENTION_SECONDS]
+        for sid in expired:
+            del self._streams[sid]
+        return len(expired)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "streams": len(self._streams),
+            "live": sum(1 for s in self._streams.values() if not s.closed),
+            "buffer_events": SSE_BUFFER_EVENTS,
+            "heartbeat_seconds": SSE_HEARTBEAT_SECONDS,
+        }
+
+def sse_response(stream: EventStream, after: Optional[int] = None) -> StreamingResponse:
+    return StreamingResponse(stream.subscribe(after), media_type="text/event-stream", headers=SSE_HEADERS)
+
+stream_registry = StreamRegistry()
@@ -0,0 +1,205 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Startup profiling and the import-time budget of the API process.
+
+Set STARTUP_PROFILE=1 (or a file path) in the environment to profile a start: the first
+import in main.py installs an import hook that records, per module, the time of its
+first import (cumulative and self, i.e. without the modules it imported in turn) and the
+thread it was imported on. Named init steps (routes import, auth DB, job queue, static
+mounts, and the warm-up steps such as the Chroma client and the embedding model) are
+timed with step() whether or not profiling is on. The report is written as JSON next to
+the application logs once warm-up has finished (or at server start when warm-up is
+disabled) and is also served by GET /admin/startup.
+
+Import budget (checked by test/import_budget.py, which runs `python -X importtime`):
+  - `import main` stays under IMPORT_BUDGET_MS of cumulative import time
+  - none of DEFERRED_MODULES is imported before the server starts; they are loaded by
+    the background warm-up (warmup.py) or by the first request that needs them
+"""
+
+import os
+import sys
+import json
+import time
+import builtins
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PROFILE = (os.environ.get("STARTUP_PROFILE", "") or "").strip()
+STARTUP_PROFILE_TOP = int(os.environ.get("STARTUP_PROFILE_TOP", "40") or 40)
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1500") or 1500)
+# Heavy libraries that must stay out of the import graph of main.py
+DEFERRED_MODULES = [
+    "torch", "sentence_transformers", "transformers", "chromadb", "langchain", "langchain_openai",
+    "sklearn", "pandas", "openpyxl", "pymupdf", "fitz", "numpy", "modelscope",
+]
+
+_T0 = time.perf_counter()
+
+def _default_report_path() -> str:
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+    return os.path.join(log_dir, f"startup_profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+class StartupProfiler:
+    def __init__(self, setting: str = STARTUP_PROFILE):
+        self.enabled = setting.lower() not in ("", "0", "false", "no")
+        self._path = setting if self.enabled and setting.lower() not in ("1", "true", "yes") else None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._modules: Dict[str, Dict[str, Any]] = {}
+        self._steps: List[Dict[str, Any]] = []
+        self._original_import = None
+        self._started_at: Optional[float] = None
+        self._loaded_before_start: List[str] = []
+        self._report_path: Optional[str] = None
+
+    # ---- module imports ----
+    def install(self) -> None:
+        """Hook builtins.__import__ (only when STARTUP_PROFILE is set)"""
+        if not self.enabled or self._original_import is not None:
+            return
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+        logger.info("Startup profiling enabled")
+
+    def uninstall(self) -> None:
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original_import
+        # Relative and repeated imports are attributed to the importing module
+        if level or name in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            with self._lock:
+                self._modules.setdefault(name, {
+                    "cumulative_ms": round(cumulative * 1000, 2),
+                    "self_ms": round((cumulative - children) * 1000, 2),
+                    "at_ms": round((start - _T0) * 1000, 1),
+                    "thread": threading.current_thread().name,
+                    "top_level": len(stack) == 0,
+                })
+
+    # ---- init steps ----
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            self.record_step(name, time.perf_counter() - start, start=start, error=error)
+
+    def record_step(self, name: str, seconds: float, start: Optional[float] = None, error: Optional[str] = None) -> None:
+        entry = {
+            "name": name,
+            "ms": round(seconds * 1000, 2),
+            "at_ms": round(((start if start is not None else time.perf_counter() - seconds) - _T0) * 1000, 1),
+            "thread": threading.current_thread().name,
+        }
+        if error:
+            entry["error"] = error
+        with self._lock:
+            self._steps.append(entry)
+
+    def mark_started(self) -> None:
+        """The server accepts requests from here on; remembers which deferred modules were already loaded"""
+        self._started_at = time.perf_counter()
+        self._loaded_before_start = sorted(m for m in DEFERRED_MODULES if m in sys.modules)
+        if self._loaded_before_start:
+            logger.warning(f"Deferred modules imported before server start: {', '.join(self._loaded_before_start)}")
+        logger.info(f"Server ready to accept requests {self._started_at - _T0:.2f}s after process start")
+
+    # ---- report ----
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            modules = sorted(self._modules.items(), key=lambda kv: kv[1]["cumulative_ms"], reverse=True)
+            steps = list(self._steps)
+        top_level_ms = sum(info["cumulative_ms"] for _, info in modules if info["top_level"])
+        return {
+            "profiling": self.enabled,
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "server_started_ms": round((self._started_at - _T0) * 1000, 1) if self._started_at else None,
+            "steps": steps,
+            "imports": {
+                "modules": len(modules),
+                "top_level_ms": round(top_level_ms, 1),
+                "slowest": [{"module": name, **info} for name, info in modules[:STARTUP_PROFILE_TOP]],
+            },
+            "budget": {
+                "import_budget_ms": IMPORT_BUDGET_MS,
+                "deferred_modules": DEFERRED_MODULES,
+                "loaded_before_start": self._loaded_before_start,
+            },
+            "report_path": self._report_path,
+        }
+
+    def write_report(self) -> Optional[str]:
+        """Write the JSON report (profiling mode only) and stop timing imports"""
+        if not self.enabled or self._report_path:
+            return self._report_path
+        self.uninstall()
+        path = self._path or _default_report_path()
+        self._report_path = path
+        report = self.report()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        except OSError as e:
+            logger.warning(f"Failed to write startup profile to {path}: {e}")
+            return None
+        slowest = ", ".join(f"{m['module']} {m['cumulative_ms']:.0f}ms" for m in report["imports"]["slowest"][:5])
+        steps = ", ".join(f"{s['name']} {s['ms']:.0f}ms" for s in report["steps"])
+        logger.info(f"Startup profile written to {path}; slowest imports: {slowest}; steps: {steps}")
+        return path
+
+startup_profiler = StartupProfiler()
+
+def step(name: str):
+    return startup_profiler.step(name)
@@ -0,0 +1,203 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Key/value state shared by all worker processes (and, with Redis, all nodes).
+
+Session results, the knowledge-base registry and cancellation flags go through
+state_backend instead of process memory, so a download, retry or cancel request can
+land on any uvicorn worker. STATE_BACKEND selects the implementation:
+
+sqlite (default) -> one SQLite file (WAL) next to the auth database; shared by the
+                    workers of one machine
+redis            -> any server speaking the Redis protocol at STATE_REDIS_URL (Redis,
+                    Valkey, KeyDB or a local stand-in); needs the redis package
+
+Values are bytes; callers encode them. Every key lives in a namespace and may carry a
+TTL in seconds.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional
+
+from config import AUTH_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = (os.getenv("STATE_BACKEND", "sqlite") or "sqlite").strip().lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(AUTH_DB_PATH)), "state.db"))
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "cbi")
+
+class StateBackend(ABC):
+    """Interface implemented by the SQLite and Redis backends"""
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def keys(self, namespace: str) -> List[str]:
+        ...
+
+    def purge_expired(self) -> int:
+        """Drop expired keys where the store does not do it by itself"""
+        return 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+class SQLiteStateBackend(StateBackend):
+    name = "sqlite"
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        self._path = path
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def _get_db(self) -> sqlite3.Connection:
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+                    conn = sqlite3.connect(self._path, timeout=30)
+                    with conn:
+                        # WAL: readers in other workers do not block the writer
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS state (
+                                namespace TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                value BLOB NOT NULL,
+                                expires_at REAL,
+                                PRIMARY KEY (namespace, key)
+                            )
+                        """)
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_state_expires ON state(expires_at)")
+                    conn.close()
+                    self._ready = True
+        return sqlite3.connect(self._path, timeout=30)
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        with self._get_db() as conn:
+            row = conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl else None
+        with self._get_db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, sqlite3.Binary(value), expires_at),
+            )
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._get_db() as conn:
+            conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def keys(self, namespace: str) -> List[str]:
+        with self._get_db() as conn:
+            rows = conn.execute(
+                "SELECT key FROM state WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, time.time()),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def purge_expired(self) -> int:
+        with self._get_db() as conn:
+            cur = conn.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+            return cur.rowcount
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._get_db() as conn:
+            rows = conn.execute(
+                "SELECT namespace, COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM state GROUP BY namespace"
+            ).fetchall()
+        return {
+            "backend": self.name,
+            "path": self._path,
+            "namespaces": {ns: {"keys": count, "bytes": size} for ns, count, size in rows},
+        }
+
+class RedisStateBackend(StateBackend):
+    name = "redis"
+
+    def __init__(self, url: str = STATE_REDIS_URL, prefix: str = STATE_KEY_PREFIX):
+        # Only needed for this backend, so imported here
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._url = url
+        self._prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self._prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        return self._client.get(self._key(namespace, key))
+
+    def set(self, namespace: str, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        self._client.set(self._key(namespace, key), value, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._client.delete(self._key(namespace, key))
+
+    def keys(self, namespace: str) -> List[str]:
+        start = len(self._key(namespace, ""))
+        return [k.decode()[start:] if isinstance(k, bytes) else k[start:]
+                for k in self._client.scan_iter(match=self._key(namespace, "*"), count=500)]
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Credentials are not echoed back
+        return {"backend": self.name, "url": self._url.split("@")[-1], "prefix": self._prefix}
+
+def create_state_backend(kind: str = STATE_BACKEND) -> StateBackend:
+    if kind == "redis":
+        backend = RedisStateBackend()
+    elif kind == "sqlite":
+        backend = SQLiteStateBackend()
+    else:
+        raise ValueError(f"Unknown STATE_BACKEND: {kind} (expected sqlite or redis)")
+    logger.info(f"Shared state backend: {backend.name}")
+    return backend
+
+state_backend = create_state_backend()
@@ -23,231 +23,299 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import json
 import logging
 import asyncio
+import os
+import time
 import uuid
-from datetime import datetime, timedelta
+from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
+from sse_utils import stream_registry, sse_response, SSE_PROGRESS_INTERVAL
 from models import BatchQueryRequest, RetryFailedRequest
-from rag_service import query_existing_knowledge_base
+from request_coalescer import BatchDeduplicator
+from circuit_breaker import llm_breaker
+from clause_index import row_clause_text
+from dataset_store import dataset_store, DatasetNotFound
+from cancellation import cancel_registry, bind
+from session_store import session_store
 
 logger = logging.getLogger(__name__)
 
-# Global retry control
-retry_control = {
-    "should_stop": False,
-    "current_session_id": None
+# LLM/retrieval calls are blocking; they run via asyncio.to_thread so one long batch
+# does not stall the event loop for other requests. Actual LLM concurrency across all
+# endpoints is governed by llm_limiter.
+
+# Rows of one batch processed at the same time
+BATCH_ROW_CONCURRENCY = int(os.environ.get("BATCH_ROW_CONCURRENCY", "4") or 4)
+
+FAILED_EVIDENCE_PREFIXES = ("Query failed", "Sorry, AI service is temporarily unavailable")
+
+def _has_value(row: dict, key: str) -> bool:
+    return key in row and row[key] and str(row[key]).strip() and str(row[key]).strip().lower() != 'nan'
+
+def _add_tokens(total: dict, result: dict) -> None:
+    try:
+        t = result.get("tokens") or {}
+        total["input"] += int(t.get("input", 0))
+        total["output"] += int(t.get("output", 0))
+        total["cached"] += int(t.get("cached", 0))
+    except Exception:
+        pass
+
+# query type -> (source column, evidence column, reference column, query template, placeholders when empty)
+SUBQUERIES = {
+    "hint": ("Hint", "Evidence Collected by AI", "Reference",
+             "Find relevant evidence based on the following hint information: {}",
+             "No Hint information available", "No Hint data"),
+    "aet": ("AET", "AET Evidence Collected by AI", "AET Reference",
+            "Find evidence related to the following AET: {}",
+            "No AET information available", "No AET data"),
 }
 
-# Data cache - store processed data
-data_cache = {}
+def _format_reference(pages) -> str:
+    if not pages:
+        return "No reference"
+    parts = []
+    for ref in pages:
+        if isinstance(ref, dict):
+            text = f"{ref.get('source', 'Unknown')} Page {ref.get('page', 'Unknown')}"
+            if ref.get('similarity_score'):
+                text += f" (Similarity: {(ref['similarity_score'] * 100):.1f}%)"
+        else:
+            text = f"Page {ref}"
+        parts.append(text)
+    return "; ".join(parts)
+
+async def _run_subquery(row: dict, query_type: str, run_query, label: str):
+    """Evidence/reference cells for one sub-query of a row; returns (cells, tokens)"""
+    source, evidence_col, reference_col, template, no_info, no_data = SUBQUERIES[query_type]
+    tokens = {"input": 0, "output": 0, "cached": 0}
+    if not _has_value(row, source):
+        return {evidence_col: no_info, reference_col: no_data}, tokens
+    result = await asyncio.to_thread(run_query, template.format(row[source]), query_type, row_clause_text(row))
+    if result["success"]:
+        _add_tokens(tokens, result)
+        logger.info(f"{label} {source} query successful")
+        return {evidence_col: result["answer"], reference_col: _format_reference(result.get("referenced_pages"))}, tokens
+    logger.warning(f"{label} {source} query failed: {result['error']}")
+    return {evidence_col: f"Query failed: {result['error']}", reference_col: "Query failed"}, tokens
+
+async def process_batch_row(row: dict, run_query, label: str = "Row", only=None):
+    """
+    Query Hint and AET of one template row (concurrently) and fill in the evidence/reference
+    columns; `only` limits the run to some sub-queries and keeps the other cells as they are.
+    run_query(query_text, query_type, clause_text) is blocking and runs in a worker thread.
+    Returns (result_row, tokens) where tokens = {"input", "output", "cached"}.
+    """
+    # Copy original row data
+    result_row = row.copy()
+    tokens = {"input": 0, "output": 0, "cached": 0}
+    query_types = [t for t in SUBQUERIES if only is None or t in only]
+    outcomes = await asyncio.gather(*(_run_subquery(row, t, run_query, label) for t in query_types))
+    for cells, sub_tokens in outcomes:
+        result_row.update(cells)
+        for k in tokens:
+            tokens[k] += sub_tokens[k]
+    return result_row, tokens
+
+def _run_kb_query(query_text: str, query_type: str, clause_text: str):
+    from rag_service import query_existing_knowledge_base
+    return query_existing_knowledge_base(query_text, query_type=query_type, clause_text=clause_text)
+
+def failed_subqueries(row: dict) -> list:
+    """Sub-queries of a row that have input but no usable evidence yet"""
+    failed = []
+    for query_type, (source, evidence_col, *_rest) in SUBQUERIES.items():
+        evidence = str(row.get(evidence_col) or "").strip()
+        if _has_value(row, source) and (not evidence or evidence.startswith(FAILED_EVIDENCE_PREFIXES)):
+            failed.append(query_type)
+    return failed
+
+def row_succeeded(result: dict) -> bool:
+    """A row counts as successful if either the Hint or the AET query produced evidence"""
+    hint_evidence = str(result.get("Evidence Collected by AI", "") or "")
+    aet_evidence = str(result.get("AET Evidence Collected by AI", "") or "")
+    hint_success = hint_evidence and not hint_evidence.startswith(FAILED_EVIDENCE_PREFIXES + ("No Hint information",))
+    aet_success = aet_evidence and not aet_evidence.startswith(FAILED_EVIDENCE_PREFIXES + ("No AET information",))
+    return bool(hint_success or aet_success)
+
+def summarize_results(results: list):
+    """(success_count, failed_indices) over processed rows"""
+    failed_indices = [idx for idx, result in enumerate(results) if not row_succeeded(result)]
+    return len(results) - len(failed_indices), failed_indices
+
+def resolve_rows(data, dataset_id=None, rows=None) -> list:
+    """Rows of a batch/retry request: posted inline, or read from an uploaded dataset"""
+    if data is not None:
+        return data if rows is None else [data[i] for i in rows if 0 <= i < len(data)]
+    if not dataset_id:
+        raise HTTPException(status_code=400, detail="Either data or dataset_id is required")
+    try:
+        return dataset_store.get_rows(dataset_id, rows)
+    except DatasetNotFound:
+        raise HTTPException(status_code=404, detail="Dataset not found or expired, please upload the file again")
+    except IndexError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def generate_batch_summary(total: int, success_count: int, failed_count: int, retrieval_only: bool = False):
+    """Executive summary of a finished batch; returns (summary_text, tokens)"""
+    tokens = {"input": 0, "output": 0, "cached": 0}
+    if retrieval_only:
+        return (f"Evidence-only run (no AI): {success_count} of {total} rows pre-filled with "
+                f"retrieved passages; {failed_count} rows without evidence."), tokens
+    try:
+        from rag_service import generate_ai_response
+        # Summary prompt: only use statistics to avoid extra context overhead
+        summary_query = (
+            "Provide an executive batch summary for the audit AI run. "
+            f"Total rows: {total}; Success: {success_count}; Failed: {failed_count}. "
+            "State the overall status, highlight common patterns and risks, "
+            "and propose next steps in a concise, formal audit style."
+        )
+        summary_resp = await asyncio.to_thread(generate_ai_response, summary_query, "summary", [])
+        _add_tokens(tokens, summary_resp)
+        return summary_resp.get("answer", ""), tokens
+    except Exception as e:
+        # If it fails, do not accumulate tokens
+        logger.error(f"Batch summary generation failed: {e}")
+        return "Batch summary generation failed.", tokens
 
 class StreamingService:
     @staticmethod
     def _store_processed_data(session_id: str, data: list, statistics: dict):
-        """Store processed data in the cache"""
-        data_cache[session_id] = {
-            "data": data,
-            "statistics": statistics,
-            "timestamp": datetime.now(),
-            "expires_at": datetime.now() + timedelta(hours=2)  # expires after 2 hours
-        }
+        """Store processed data in the session store (memory first, spilled to disk when cold)"""
+        session_store.put(session_id, data, statistics)
         logger.info(f"Stored processed data for session {session_id}, {len(data)} records")
     
     @staticmethod
     def get_cached_data(session_id: str):
-        """Get processed data from the cache"""
-        if session_id not in data_cache:
-            return None
-        
-        cached_item = data_cache[session_id]
-        
-        # Check whether it is expired
-        if datetime.now() > cached_item["expires_at"]:
-            del data_cache[session_id]
-            logger.info(f"Cached data for session {session_id} has expired and been removed")
-            return None
-        
-        return cached_item
+        """Get processed data from the session store (None when unknown or expired)"""
+        return session_store.get(session_id)
     
     @staticmethod
     def cleanup_expired_cache():
         """Clean up expired cached data"""
-        current_time = datetime.now()
-        expired_sessions = []
-        
-        for session_id, cached_item in data_cache.items():
-            if current_time > cached_item["expires_at"]:
-                expired_sessions.append(session_id)
-        
-        for session_id in expired_sessions:
-            del data_cache[session_id]
-            logger.info(f"Removed expired cached data for session {session_id}")
-        
-        return len(expired_sessions)
+        return session_store.sweep()
 
     @staticmethod
     async def batch_query_stream(request: BatchQueryRequest) -> StreamingResponse:
         """Stream batch query the knowledge base"""
         # Generate session ID
         session_id = str(uuid.uuid4())
-        logger.info(f"Starting batch query session {session_id}, data rows: {len(request.data)}")
+        retrieval_only = request.mode == "retrieval"
+        # Reading a stored dataset decompresses it from disk; keep that off the event loop
+        data = await asyncio.to_thread(resolve_rows, request.data, request.dataset_id, request.rows)
+        logger.info(f"Starting batch query session {session_id}, data rows: {len(data)}, mode: {request.mode or 'llm'}")
+
+        # Retrieval-only mode pre-fills evidence without any LLM call; rows can be refined
+        # with the LLM later through retry-failed-stream with the selected indices.
+        # Rows repeating a Hint/AET already answered in this batch reuse that answer; duplicates
+        # in flight in other sessions are coalesced inside query_existing_knowledge_base
+        dedup = BatchDeduplicator()
+        collapsed = {"coalesced": 0}
+
+        def run_query(query_text: str, query_type: str, clause_text: str):
+            from rag_service import query_existing_knowledge_base, query_evidence_only, query_identity
+
+            def compute():
+                if retrieval_only:
+                    return query_evidence_only(query_text, query_type=query_type, summarize=bool(request.summarize),
+                                               clause_text=clause_text)
+                return query_existing_knowledge_base(query_text, query_type=query_type, clause_text=clause_text)
+            result = dedup.run(query_identity(query_text, query_type, clause_text), compute)
+            if result.get("coalesced"):
+                collapsed["coalesced"] += 1
+            return result
         
         async def generate_progress():
+            # Cancellation of this session reaches the row tasks and their worker threads
+            token = cancel_registry.register(session_id, "batch", total_units=len(data))
+            bind(token)
+            yield {"type": "session", "session_id": session_id, "total": len(data)}
             try:
-                results = []
-                total_count = len(request.data)
+                total_count = len(data)
 
                 # Added: accumulate total token usage for this batch
                 total_input_tokens = 0
                 total_output_tokens = 0
+                total_cached_tokens = 0
                 # End
                 
-                for i, row in enumerate(request.data):
-                    logger.info(f"Start processing row {i+1}/{total_count}")
-                    
-                    # Send progress update
-                    progress_data = {
-                        "type": "progress",
-                        "completed": i,
-                        "total": total_count,
-                        "percentage": (i / total_count) * 100,
-                        "message": f"Start processing row {i+1}/{total_count}"
-                    }
-                    yield f"data: {json.dumps(progress_data, ensure_ascii=False)}\n\n"
-                    
-                    # Copy original row data
-                    result_row = row.copy()
-                    
-                    # Query Hint data separately
-                    hint_success = False
-                    if "Hint" in row and row["Hint"] and str(row["Hint"]).strip() and str(row["Hint"]).strip().lower() != 'nan':
-                        hint_query = f"Find relevant evidence based on the following hint information: {row['Hint']}"
-                        hint_result = query_existing_knowledge_base(hint_query, query_type="hint")
-                        if hint_result["success"]:
-                            result_row["Evidence Collected by AI"] = hint_result["answer"]
-                            # Added: accumulate Hint tokens
-                            try:
-                                t = hint_result.get("tokens") or {}
-                                total_input_tokens += int(t.get("input", 0))
-                                total_output_tokens += int(t.get("output", 0))
-                            except Exception:
-                                pass
-                            # End
-                            
-                            # Format reference information for Hint
-                            if hint_result.get("referenced_pages"):
-                                reference_info = []
-                                for page in hint_result["referenced_pages"]:
-                                    reference_info.append(f"Page {page}")
-                                result_row["Reference"] = "; ".join(reference_info)
-                            else:
-                                result_row["Reference"] = "No reference"
-                            hint_success = True
-                            logger.info(f"Row {i+1} Hint query successful")
-                        else:
-                            result_row["Evidence Collected by AI"] = f"Query failed: {hint_result['error']}"
-                            result_row["Reference"] = "Query failed"
-                            logger.warning(f"Row {i+1} Hint query failed: {hint_result['error']}")
-                    else:
-                        result_row["Evidence Collected by AI"] = "No Hint information available"
-                        result_row["Reference"] = "No Hint data"
-                    
-                    # Query AET data separately
-                    aet_success = False
-                    if "AET" in row and row["AET"] and str(row["AET"]).strip() and str(row["AET"]).strip().lower() != 'nan':
-                        aet_query = f"Find evidence related to the following AET: {row['AET']}"
-                        aet_result = query_existing_knowledge_base(aet_query, query_type="aet")
-                        if aet_result["success"]:
-                            result_row["AET Evidence Collected by AI"] = aet_result["answer"]
-                            # Added: accumulate AET tokens
-                            try:
-                                t = aet_result.get("tokens") or {}
-                                total_input_tokens += int(t.get("input", 0))
-                                total_output_tokens += int(t.get("output", 0))
-                            except Exception:
-                                pass
-                            # End
-                            
-                            # Format reference information for AET
-                            if aet_result.get("referenced_pages"):
-                                aet_reference_info = []
-                                for page in aet_result["referenced_pages"]:
-                                    aet_reference_info.append(f"Page {page}")
-                                result_row["AET Reference"] = "; ".join(aet_reference_info)
-                            else:
-                                result_row["AET Reference"] = "No reference"
-                            aet_success = True
-                            logger.info(f"Row {i+1} AET query successful")
-                        else:
-                            result_row["AET Evidence Collected by AI"] = f"Query failed: {aet_result['error']}"
-                            result_row["AET Reference"] = "Query failed"
-                            logger.warning(f"Row {i+1} AET query failed: {aet_result['error']}")
-                    else:
-                        result_row["AET Evidence Collected by AI"] = "No AET information available"
-                        result_row["AET Reference"] = "No AET data"
-                    
-                    results.append(result_row)
-                    
-                    logger.info(f"Row {i+1} field values:")
-                    logger.info(f"  Evidence Collected by AI: {result_row.get('Evidence Collected by AI', 'N/A')[:100]}...")
-                    logger.info(f"  Reference: {result_row.get('Reference', 'N/A')}")
-                    logger.info(f"  AET Evidence Collected by AI: {result_row.get('AET Evidence Collected by AI', 'N/A')[:100]}...")
-                    logger.info(f"  AET Reference: {result_row.get('AET Reference', 'N/A')}")
-                    
-                    # Send completion progress
-                    completed_progress = {
-                        "type": "progress",
-                        "completed": i + 1,
-                        "total": total_count,
-                        "percentage": ((i + 1) / total_count) * 100,
-                        "message": f"Completed question {i+1}/{total_count}"
-                    }
-                    yield f"data: {json.dumps(completed_progress, ensure_ascii=False)}\n\n"
+                # Rows run concurrently (LLM concurrency itself is still bounded by llm_limiter)
+                # and each row is sent as its own event as soon as it finishes
+                results = [None] * total_count
+                semaphore = asyncio.Semaphore(BATCH_ROW_CONCURRENCY)
+
+                async def run_row(i, row):
+                    async with semaphore:
+                        if token.cancelled:
+                            return i, None, None
+                        logger.info(f"Start processing row {i+1}/{total_count}")
+                        result_row, tokens = await process_batch_row(row, run_query, label=f"Row {i+1}")
+                        return i, result_row, tokens
+
+                tasks = [asyncio.create_task(run_row(i, row)) for i, row in enumerate(data)]
+                completed = 0
+                last_progress = 0.0
+                try:
+                    for next_done in asyncio.as_completed(tasks):
+                        i, result_row, tokens = await next_done
+                        if result_row is None:
+                            # Row skipped because the session was cancelled
+                            break
+                        results[i] = result_row
+                        token.record(tokens)
+                        completed += 1
+                        total_input_tokens += tokens["input"]
+                        total_output_tokens += tokens["output"]
+                        total_cached_tokens += tokens["cached"]
+
+                        logger.debug(f"Row {i+1} field values: "
+                                     f"Reference: {result_row.get('Reference', 'N/A')}, "
+                                     f"AET Reference: {result_row.get('AET Reference', 'N/A')}")
+
+                        yield {
+                            "type": "row",
+                            "index": i,
+                            "row": result_row,
+                            "success": row_succeeded(result_row),
+                            "completed": completed,
+                            "total": total_count
+                        }
+
+                        # Progress is throttled; the row events already carry the counts
+                        now = time.monotonic()
+                        if completed == total_count or now - last_progress >= SSE_PROGRESS_INTERVAL:
+                            last_progress = now
+                            yield {
+                                "type": "progress",
+                                "completed": completed,
+                                "total": total_count,
+                                "percentage": (completed / total_count) * 100,
+                                "message": f"Completed question {completed}/{total_count}"
+                            }
+                        if token.cancelled:
+                            break
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+                if token.cancelled:
+                    # Rows that did not finish are kept unprocessed; the partial set stays downloadable
+                    results = [row if row is not None else dict(data[i]) for i, row in enumerate(results)]
                 
                 # Calculate processing results
-                success_count = 0
-                failed_indices = []
-                
-                for idx, result in enumerate(results):
-                    hint_evidence = result.get("Evidence Collected by AI", "")
-                    aet_evidence = result.get("AET Evidence Collected by AI", "")
-                    
-                    # Consider successful if either Hint or AET query succeeded
-                    hint_success = hint_evidence and not hint_evidence.startswith(("Query failed", "No Hint information", "Sorry, AI service is temporarily unavailable"))
-                    aet_success = aet_evidence and not aet_evidence.startswith(("Query failed", "No AET information", "Sorry, AI service is temporarily unavailable"))
-                    
-                    if hint_success or aet_success:
-                        success_count += 1
-                    else:
-                        failed_indices.append(idx)
-                
+                success_count, failed_indices = summarize_results(results)
                 failed_count = len(failed_indices)
 
                 # Added: generate batch summary (invoke LLM again and record/accumulate tokens)
-                try:
-                    from rag_service import generate_ai_response, MAX_AI_MODEL
-                    # Summary prompt: only use statistics to avoid extra context overhead
-                    summary_query = (
-                        "Provide an executive batch summary for the audit AI run. "
-                        f"Total rows: {len(results)}; Success: {success_count}; Failed: {failed_count}. "
-                        "State the overall status, highlight common patterns and risks, "
-                        "and propose next steps in a concise, formal audit style."
-                    )
-                    summary_resp = generate_ai_response(summary_query, "summary", [])
-                    # Accumulate summary tokens
-                    try:
-                        st = summary_resp.get("tokens") or {}
-                        total_input_tokens += int(st.get("input", 0))
-                        total_output_tokens += int(st.get("output", 0))
-                    except Exception:
-                        pass
-                    batch_summary = summary_resp.get("answer", "")
-                except Exception as e:
-                    logger.error(f"Batch summary generation failed: {e}")
-                    batch_summary = "Batch summary generation failed."
-                    # If it fails, do not accumulate tokens
+                if token.cancelled:
+                    batch_summary, summary_tokens = None, {"input": 0, "output": 0, "cached": 0}
+                else:
+                    batch_summary, summary_tokens = await generate_batch_summary(len(results), success_count, failed_count, retrieval_only)
+                total_input_tokens += summary_tokens["input"]
+                total_output_tokens += summary_tokens["output"]
+                total_cached_tokens += summary_tokens["cached"]
                 # End
                 
                 # Send final result
@@ -256,26 +324,32 @@ class StreamingService:
                     "success": True,
                     "session_id": session_id,  # Add session ID
                     "message": f"Batch query completed, processed {len(results)} rows of data, successful {success_count} records, failed {failed_count} records",
-                    "data": results,
+                    # Rows were sent as "row" events; the full set stays in the session cache
                     "statistics": {
                         "total": len(results),
                         "success": success_count,
                         "failed": failed_count,
-                        "failed_indices": failed_indices
+                        "failed_indices": failed_indices,
+                        "mode": "retrieval" if retrieval_only else "llm",
+                        # Queries answered without their own retrieval/LLM call
+                        "deduplicated_queries": dedup.reused,
+                        "coalesced_queries": collapsed["coalesced"]
                     },
                     # Added: include token usage stats and summary text
                     "token_usage": {
                         "total_input_tokens": total_input_tokens,
-                        "total_output_tokens": total_output_tokens
+                        "total_output_tokens": total_output_tokens,
+                        "total_cached_tokens": total_cached_tokens
                     },
                     "summary": batch_summary
                     # End
                 }
                 
-                # Store processed data into cache
-                StreamingService._store_processed_data(
-                    session_id, 
-                    results, 
+                # Store processed data into cache (encode + compress + backend write: off the event loop)
+                await asyncio.to_thread(
+                    StreamingService._store_processed_data,
+                    session_id,
+                    results,
                     final_result["statistics"]
                 )
 
@@ -285,13 +359,19 @@ class StreamingService:
                     from token_utils import log_token_usage
                     from rag_service import generate_ai_response, get_current_model
                     total_model = get_current_model()
-                    log_token_usage(total_model, total_input_tokens, total_output_tokens, "batch_query_stream TOTAL", session_id=session_id)
+                    if not retrieval_only:
+                        log_token_usage(total_model, total_input_tokens, total_output_tokens, "batch_query_stream TOTAL",
+                                        session_id=session_id, cached_input_tokens=total_cached_tokens)
                 except Exception as _:
                     pass
                 # End
                 
-                yield f"data: {json.dumps(final_result, ensure_ascii=False)}\n\n"
-                logger.info(f"Streaming batch query completed for session {session_id}, processed {len(results)} rows of data, successful {success_count} records, failed {failed_count} records")
+                if token.cancelled:
+                    final_result["type"] = "cancelled"
+                    final_result["message"] = f"Batch query cancelled after {completed} of {len(results)} rows"
+                    final_result["cancellation"] = token.report()
+                yield final_result
+                logger.info(f"Streaming batch query {'cancelled' if token.cancelled else 'completed'} for session {session_id}, processed {len(results)} rows of data, successful {success_count} records, failed {failed_count} records")
                 
             except Exception as e:
                 logger.error(f"Streaming batch query error: {str(e)}", exc_info=True)
@@ -301,248 +381,255 @@ class StreamingService:
                     "message": "Batch query failed",
                     "error": f"Batch query error: {str(e)}"
                 }
-                yield f"data: {json.dumps(error_result, ensure_ascii=False)}\n\n"
+                yield error_result
+            finally:
+                cancel_registry.finish(token)
         
-        return StreamingResponse(
-            generate_progress(),
-            media_type="text/plain",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Content-Type": "text/event-stream"
-            }
-        )
+        # The run is owned by a background task; a dropped client reconnects to
+        # /stream/{session_id} with Last-Event-ID and misses nothing
+        stream = stream_registry.start(session_id, "batch", generate_progress())
+        return sse_response(stream)
     
     @staticmethod
-    def stop_retry():
-        """Stop current retry operation"""
-        retry_control["should_stop"] = True
-        logger.info("User requested to stop retry operation")
-        return {"success": True, "message": "Retry operation stopped"}
+    def cancel(session_id: str, kind: str):
+        """Cancel a running batch or retry session; only that session is affected"""
+        report = cancel_registry.cancel(session_id, kind)
+        if report is None:
+            raise HTTPException(status_code=404, detail=f"No running {kind} session {session_id}")
+        logger.info(f"User requested to cancel {kind} session {session_id}")
+        return {"success": True, "message": f"{kind.capitalize()} cancellation requested", "cancellation": report}
     
     @staticmethod
     async def retry_failed_stream(request: RetryFailedRequest) -> StreamingResponse:
-        """Smart streaming retry for failed records"""
-        session_id = str(uuid.uuid4())
-        retry_control["current_session_id"] = session_id
-        retry_control["should_stop"] = False
-        
-        logger.info(f"Starting smart retry session {session_id}, need to reprocess {len(request.failed_indices)} failed records")
-        
+        """
+        Smart streaming retry for failed records.
+        With session_id the rows come from that batch session and are updated in place
+        (the Excel download then includes the retried answers); otherwise the posted
+        data/dataset rows are used. Only the failed Hint/AET sub-queries of a row are
+        re-run, both at once, and several rows are retried concurrently.
+        """
+        cached = None
+        if request.session_id:
+            cached = await asyncio.to_thread(StreamingService.get_cached_data, request.session_id)
+            if not cached:
+                raise HTTPException(status_code=404, detail="Session data not found or expired")
+            results = cached["data"]
+            session_id = request.session_id
+        else:
+            results = [row.copy() for row in await asyncio.to_thread(resolve_rows, request.data, request.dataset_id)]
+            session_id = str(uuid.uuid4())
+
+        if request.failed_indices is not None:
+            target_indices = list(request.failed_indices)
+        else:
+            target_indices = [i for i, row in enumerate(results) if failed_subqueries(row) or not row_succeeded(row)]
+        retry_id = str(uuid.uuid4())
+        max_rounds = request.max_retry_rounds or 5
+        auto_retry = request.auto_retry if request.auto_retry is not None else True
+
+        logger.info(f"Starting smart retry {retry_id} on session {session_id}, need to reprocess {len(target_indices)} failed records")
+
         async def generate_retry_progress():
+            # Registered under the retry's own id, so concurrent retries never stop each other
+            token = cancel_registry.register(retry_id, "retry", total_units=len(target_indices))
+            bind(token)
+
+            def stopped() -> bool:
+                return token.cancelled
+
+            # session_id names the event stream (for resume); data_session_id the rows being updated
+            yield {"type": "session", "session_id": retry_id, "data_session_id": session_id, "total": len(target_indices)}
             try:
-                results = request.data.copy()  # Copy complete data
-                current_failed_indices = request.failed_indices.copy()
+                totals = {"input": 0, "output": 0, "cached": 0}
+                skipped_indices = [i for i in target_indices if not 0 <= i < len(results)]
+                if skipped_indices:
+                    logger.warning(f"Skipping indices out of data range (total length: {len(results)}): {skipped_indices}")
+                current_failed_indices = [i for i in target_indices if 0 <= i < len(results)]
                 retry_round = 0
-                max_rounds = request.max_retry_rounds or 5
-                auto_retry = request.auto_retry if request.auto_retry is not None else True
-                
+                was_stopped = False
+
                 while current_failed_indices and retry_round < max_rounds:
                     # Check if stopped by user
-                    if retry_control["should_stop"] or retry_control["current_session_id"] != session_id:
-                        yield f"data: {json.dumps({'type': 'stopped', 'message': 'Retry stopped by user'}, ensure_ascii=False)}\n\n"
-                        return
-                    
+                    if stopped():
+                        was_stopped = True
+                        break
+
                     retry_round += 1
                     logger.info(f"Starting round {retry_round}/{max_rounds} retry, processing {len(current_failed_indices)} records")
-                    
-                    # Send round start info
-                    round_start_data = {
+                    yield {
                         "type": "round_start",
                         "round": retry_round,
                         "max_rounds": max_rounds,
                         "failed_count": len(current_failed_indices),
                         "message": f"Starting round {retry_round}/{max_rounds} retry"
                     }
-                    yield f"data: {json.dumps(round_start_data, ensure_ascii=False)}\n\n"
-                    
-                    round_success_indices = []
-                    round_failed_indices = []
-                    
-                    for idx, original_idx in enumerate(current_failed_indices):
-                        # Check stop status again
-                        if retry_control["should_stop"] or retry_control["current_session_id"] != session_id:
-                            yield f"data: {json.dumps({'type': 'stopped', 'message': 'Retry stopped by user'}, ensure_ascii=False)}\n\n"
-                            return
-                        
-                        logger.info(f"Round {retry_round}: processing record {idx+1}/{len(current_failed_indices)} (original index: {original_idx})")
-                        
-                        # Send progress update
-                        progress_data = {
-                            "type": "progress",
+
+                    # Add exponential backoff delay (no delay for first round)
+                    if retry_round > 1:
+                        delay = min(2 ** (retry_round - 2), 10)  # Max delay 10 seconds
+                        logger.info(f"Round {retry_round} retry, waiting {delay} seconds")
+                        await asyncio.sleep(delay)
+
+                    # While the LLM circuit is open, wait out the cooldown instead of
+                    # failing rows immediately (also keeps the stream alive)
+                    wait_seconds = llm_breaker.seconds_until_retry()
+                    while wait_seconds > 0 and not stopped():
+                        yield {
+                            "type": "circuit_open",
                             "round": retry_round,
-                            "completed": idx,
-                            "total": len(current_failed_indices),
-                            "percentage": (idx / len(current_failed_indices)) * 100,
-                            "message": f"Round {retry_round}: processing record {idx+1}/{len(current_failed_indices)}",
-                            "current_index": original_idx
+                            "retry_after": round(wait_seconds, 1),
+                            "message": f"AI service unavailable, waiting {wait_seconds:.0f}s before retrying"
                         }
-                        yield f"data: {json.dumps(progress_data, ensure_ascii=False)}\n\n"
-                    
-                        # Get row data that needs reprocessing
-                        if original_idx < len(results):
+                        await asyncio.sleep(min(wait_seconds, 5))
+                        wait_seconds = llm_breaker.seconds_until_retry()
+
+                    semaphore = asyncio.Semaphore(BATCH_ROW_CONCURRENCY)
+
+                    async def retry_row(original_idx):
+                        async with semaphore:
+                            if stopped():
+                                return original_idx, None, None
                             row = results[original_idx]
-                            
-                            # Build query text, prioritize Hint, then AET
-                            query_text = ""
-                            query_type = "general"
-                            if "Hint" in row and row["Hint"] and str(row["Hint"]).strip():
-                                query_text = f"Find relevant evidence based on the following hint information: {row['Hint']}"
-                                query_type = "hint"
-                            elif "AET" in row and row["AET"] and str(row["AET"]).strip():
-                                query_text = f"Find evidence related to the following AET: {row['AET']}"
-                                query_type = "aet"
-                            
-                            if query_text:
-                                # Add exponential backoff delay (no delay for first round)
-                                if retry_round > 1:
-                                    delay = min(2 ** (retry_round - 2), 10)  # Max delay 10 seconds
-                                    logger.info(f"Round {retry_round} retry, waiting {delay} seconds before processing index {original_idx}")
-                                    await asyncio.sleep(delay)
-                                
-                                # Query knowledge base
-                                query_result = query_existing_knowledge_base(query_text, query_type=query_type)
-                                if query_result["success"]:
-                                    results[original_idx]["Evidence Collected by AI"] = query_result["answer"]
-                                    
-                                    # Reference column - format reference page info
-                                    if query_result.get("referenced_pages"):
-                                        reference_info = []
-                                        for ref in query_result["referenced_pages"]:
-                                            if isinstance(ref, dict):
-                                                ref_text = f"{ref.get('source', 'Unknown')} Page {ref.get('page', 'Unknown')}"
-                                                if ref.get('similarity_score'):
-                                                    ref_text += f" (Similarity: {(ref['similarity_score'] * 100):.1f}%)"
-                                            else:
-                                                ref_text = f"Page {ref}"
-                                            reference_info.append(ref_text)
-                                        results[original_idx]["Reference"] = "; ".join(reference_info)
-                                    else:
-                                        results[original_idx]["Reference"] = "No reference"
-                                    
-                                    round_success_indices.append(original_idx)
-                                    logger.info(f"Round {retry_round}: index {original_idx} processed successfully")
-                                else:
-                                    round_failed_indices.append(original_idx)
-                                    logger.warning(f"Round {retry_round}: index {original_idx} processing failed: {query_result['error']}")
-                            else:
+                            # Rows never answered (e.g. posted without evidence) get both sub-queries
+                            only = failed_subqueries(row) or None
+                            updated, tokens = await process_batch_row(
+                                row, _run_kb_query,
+                                label=f"Round {retry_round} index {original_idx}", only=only)
+                            return original_idx, updated, tokens
+
+                    tasks = [asyncio.create_task(retry_row(i)) for i in current_failed_indices]
+                    round_success_indices = []
+                    round_failed_indices = []
+                    completed = 0
+                    last_progress = 0.0
+                    try:
+                        for next_done in asyncio.as_completed(tasks):
+                            original_idx, updated, tokens = await next_done
+                            completed += 1
+                            if updated is None:
+                                round_failed_indices.append(original_idx)
+                                continue
+                            for k in totals:
+                                totals[k] += tokens[k]
+                            token.record(tokens, units=0 if failed_subqueries(updated) else 1)
+                            if not _has_value(updated, "Hint") and not _has_value(updated, "AET"):
                                 # Records without query info are marked as skipped, no more retries
-                                results[original_idx]["Evidence Collected by AI"] = "No available query information (both Hint and AET are empty)"
-                                results[original_idx]["Reference"] = "No query information"
-                                logger.warning(f"Round {retry_round}: index {original_idx} has no available query information, skipping")
-                        else:
-                            # Index out of range, skip processing
-                            logger.warning(f"Round {retry_round}: skipping index {original_idx}, out of data range (total length: {len(results)})")
-                        
-                        # Send single record completion progress update
-                        completed_progress = {
-                            "type": "progress",
-                            "round": retry_round,
-                            "completed": idx + 1,
-                            "total": len(current_failed_indices),
-                            "percentage": ((idx + 1) / len(current_failed_indices)) * 100,
-                            "message": f"Round {retry_round}: processed record {idx+1}/{len(current_failed_indices)}",
-                            "current_index": original_idx
-                        }
-                        yield f"data: {json.dumps(completed_progress, ensure_ascii=False)}\n\n"
-                
-                    # Round end statistics
-                    round_end_data = {
+                                updated["Evidence Collected by AI"] = "No available query information (both Hint and AET are empty)"
+                                updated["Reference"] = "No query information"
+                            # Merge into the session rows in place
+                            results[original_idx] = updated
+                            if failed_subqueries(updated):
+                                round_failed_indices.append(original_idx)
+                            else:
+                                round_success_indices.append(original_idx)
+                            yield {
+                                "type": "row",
+                                "round": retry_round,
+                                "index": original_idx,
+                                "row": updated,
+                                "success": not failed_subqueries(updated),
+                                "completed": completed,
+                                "total": len(current_failed_indices)
+                            }
+                            now = time.monotonic()
+                            if completed == len(current_failed_indices) or now - last_progress >= SSE_PROGRESS_INTERVAL:
+                                last_progress = now
+                                yield {
+                                    "type": "progress",
+                                    "round": retry_round,
+                                    "completed": completed,
+                                    "total": len(current_failed_indices),
+                                    "percentage": (completed / len(current_failed_indices)) * 100,
+                                    "message": f"Round {retry_round}: processed record {completed}/{len(current_failed_indices)}",
+                                    "current_index": original_idx
+                                }
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+
+                    yield {
                         "type": "round_completed",
                         "round": retry_round,
                         "success_count": len(round_success_indices),
                         "failed_count": len(round_failed_indices),
-                        "success_indices": round_success_indices,
-                        "failed_indices": round_failed_indices,
+                        "success_indices": sorted(round_success_indices),
+                        "failed_indices": sorted(round_failed_indices),
                         "message": f"Round {retry_round} retry completed: successful {len(round_success_indices)} records, failed {len(round_failed_indices)} records"
                     }
-                    yield f"data: {json.dumps(round_end_data, ensure_ascii=False)}\n\n"
-                    
+
                     # Update indices for next round retry
-                    current_failed_indices = round_failed_indices
-                    
-                    # Check if need to continue retry
+                    current_failed_indices = sorted(round_failed_indices)
                     if not current_failed_indices:
-                        # All records succeeded
                         logger.info(f"All failed records have been successfully fixed in round {retry_round} retry")
                         break
-                    elif retry_round >= max_rounds:
-                        # Reached max retry rounds
-                        logger.info(f"Reached maximum retry rounds {max_rounds}, stopping retry")
-                        break
-                    elif not auto_retry:
+                    if not auto_retry:
                         # Non-auto retry mode, only execute one round
                         logger.info("Non-auto retry mode, retry completed")
                         break
-                    
-                    # Check if user requested stop
-                    if retry_control["should_stop"]:
+                    if stopped():
+                        was_stopped = True
                         logger.info(f"User requested stop retry, terminating after round {retry_round}")
                         break
-                
+
+
                 # Final statistics
-                final_success_count = 0
-                final_failed_count = 0
-                final_failed_indices = []
-                skipped_count = 0
-                skipped_indices = []
-                
-                for original_idx in request.failed_indices:
-                    if original_idx < len(results):
-                        row = results[original_idx]
-                        # Check if has valid Evidence
-                        if ("Evidence Collected by AI" in row and 
-                            row["Evidence Collected by AI"] and 
-                            str(row["Evidence Collected by AI"]).strip() and
-                            not str(row["Evidence Collected by AI"]).startswith("Still failed after retry") and
-                            not str(row["Evidence Collected by AI"]).startswith("No available query information")):
-                            final_success_count += 1
-                        else:
-                            final_failed_count += 1
-                            final_failed_indices.append(original_idx)
-                    else:
-                        skipped_count += 1
-                        skipped_indices.append(original_idx)
-                
-                # Record final statistics
-                stop_reason = "User stopped" if retry_control["should_stop"] else ("All successful" if not final_failed_indices else f"Reached max retry rounds ({max_rounds})")
-                logger.info(f"Retry processing completed - Reason: {stop_reason}, Total rounds: {retry_round}, Final success: {final_success_count}, Still failed: {final_failed_count}, Skipped: {skipped_count}")
-                
-                # Send final completion message
-                final_result = {
+                final_failed_indices = [i for i in target_indices if 0 <= i < len(results) and failed_subqueries(results[i])]
+                final_success_count = len(target_indices) - len(skipped_indices) - len(final_failed_indices)
+
+                # Refresh the session statistics so the download reflects the retried rows
+                success_count, failed_indices = summarize_results(results)
+                statistics = dict(cached["statistics"]) if cached else {"total": len(results)}
+                statistics.update(success=success_count, failed=len(failed_indices), failed_indices=failed_indices)
+                await asyncio.to_thread(StreamingService._store_processed_data, session_id, results, statistics)
+
+                stop_reason = "User stopped" if was_stopped else ("All successful" if not final_failed_indices else f"Reached max retry rounds ({max_rounds})")
+                logger.info(f"Retry processing completed - Reason: {stop_reason}, Total rounds: {retry_round}, Final success: {final_success_count}, Still failed: {len(final_failed_indices)}, Skipped: {len(skipped_indices)}")
+
+                if was_stopped:
+                    yield {
+                        "type": "cancelled",
+                        "message": "Retry stopped by user",
+                        "data_session_id": session_id,
+                        "statistics": statistics,
+                        "cancellation": token.report()
+                    }
+                    return
+                yield {
                     "type": "complete",
                     "success": True,
+                    "data_session_id": session_id,
                     "message": f"Retry processing completed - {stop_reason}",
                     "total_rounds": retry_round,
                     "stop_reason": stop_reason,
-                    "data": results,
+                    # Retried rows were sent as "row" events and merged into the session
+                    "statistics": statistics,
                     "retry_statistics": {
-                        "total_retried": len(request.failed_indices),
+                        "total_retried": len(target_indices),
                         "retry_success": final_success_count,
-                        "still_failed": final_failed_count,
+                        "still_failed": len(final_failed_indices),
                         "still_failed_indices": final_failed_indices,
-                        "skipped": skipped_count,
+                        "skipped": len(skipped_indices),
                         "skipped_indices": skipped_indices
+                    },
+                    "token_usage": {
+                        "total_input_tokens": totals["input"],
+                        "total_output_tokens": totals["output"],
+                        "total_cached_tokens": totals["cached"]
                     }
                 }
-                yield f"data: {json.dumps(final_result, ensure_ascii=False)}\n\n"
-                
+
             except Exception as e:
                 logger.error(f"Error reprocessing failed records: {str(e)}", exc_info=True)
-                error_result = {
+                yield {
                     "type": "error",
                     "success": False,
                     "message": "Reprocessing failed",
                     "error": f"Error during reprocessing: {str(e)}"
                 }
-                yield f"data: {json.dumps(error_result, ensure_ascii=False)}\n\n"
-        
-        return StreamingResponse(
-            generate_retry_progress(),
-            media_type="text/plain",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Content-Type": "text/event-stream"
-            }
-        )
\ No newline at end of file
+            finally:
+                cancel_registry.finish(token)
+
+        # The run is owned by a background task; a dropped client reconnects to
+        # /stream/{retry_id} with Last-Event-ID and misses nothing
+        stream = stream_registry.start(retry_id, "retry", generate_retry_progress())
+        return sse_response(stream)
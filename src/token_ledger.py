@@ -0,0 +1,530 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Token usage ledger in SQLite.
+
+Every LLM call (and the per-run TOTAL lines of batch and job runs) is one row of the
+token_usage table, indexed by timestamp, model, session and caller. record() only puts
+the usage on an in-memory queue, so the request path does no pricing lookup and no
+disk I/O. A writer thread prices the records and writes them with one executemany per
+TOKEN_LEDGER_BATCH records or TOKEN_LEDGER_FLUSH_SECONDS after the first pending one,
+whichever comes first. Reads flush the queue first, so the metrics endpoint sees this
+process' latest calls; shutdown drains it. When more than TOKEN_QUEUE_MAX records are
+waiting (the database is locked or the disk is gone), new records are dropped and counted
+instead of blocking LLM calls.
+
+Every batch written also updates token_rollup, one row per day x model x tier with
+request count, token and cost sums and latency sum/count/max, in the same transaction.
+The "... TOTAL" rows only summarise calls that are in the ledger already and are left
+out of the rollups.
+/admin/metrics/tokens reads only the rollups, so any date range costs O(days x models)
+however many calls were made. rebuild_rollups() recomputes them from token_usage (done
+automatically the first time a ledger without rollups is opened).
+
+    python token_ledger.py rebuild-rollups
+
+The daily text logs written by earlier versions (token/YYYY-MM-DD_token_usage.txt,
+relative to the working directory or to src/) are imported once: each file's imported
+line count is remembered, so running the importer again only picks up new lines.
+
+    python token_ledger.py import [directory ...]
+"""
+
+import os
+import re
+import sys
+import time
+import queue
+import atexit
+import sqlite3
+import logging
+import threading
+from datetime import datetime, date
+from typing import Dict, Any, List, Optional, Iterable, Tuple
+
+from config import AUTH_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+TOKEN_DB_PATH = os.getenv("TOKEN_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(AUTH_DB_PATH)), "token_usage.db"))
+TOKEN_LEDGER_BATCH = int(os.environ.get("TOKEN_LEDGER_BATCH", "50") or 50)
+TOKEN_LEDGER_FLUSH_SECONDS = float(os.environ.get("TOKEN_LEDGER_FLUSH_SECONDS", "2") or 2)
+TOKEN_QUEUE_MAX = int(os.environ.get("TOKEN_QUEUE_MAX", "10000") or 10000)
+
+# PRAGMA user_version of a ledger whose rollups are maintained
+# (2: TOTAL summary rows no longer counted; older rollups are rebuilt on open)
+_ROLLUP_VERSION = 2
+# Callers of the per-run summary rows (e.g. "batch_query_stream TOTAL", "batch_job TOTAL")
+_SUMMARY_CALLER_SUFFIX = " TOTAL"
+
+_STOP = object()
+
+_COLUMNS = ("ts", "model", "caller", "session_id", "tier", "input_tokens", "output_tokens",
+            "cached_input_tokens", "input_cost", "output_cost", "total_cost", "latency_seconds", "source")
+
+# Line format of the legacy text logs
+TOKEN_LINE_RE = re.compile(
+    r"Timestamp:\s*(?P<ts>[\d\-:\s]+),\s*Model:\s*(?P<model>[^,]+),\s*Input Tokens:\s*(?P<input>\d+),\s*Output Tokens:\s*(?P<output>\d+)(?:,\s*Cached Input Tokens:\s*(?P<cached>\d+))?.*Total Cost:\s*\$(?P<total>[0-9.]+)"
+)
+_CALLER_RE = re.compile(r"Caller Method:\s*(?P<caller>.*?)(?:, Session:|, Tier:|, Latency:|, Input Cost:)")
+_SESSION_RE = re.compile(r"Session:\s*(?P<session>[^,]+)")
+_TIER_RE = re.compile(r"Tier:\s*(?P<tier>[\w\-]+)")
+_LATENCY_RE = re.compile(r"Latency:\s*(?P<latency>[0-9.]+)s")
+_IN_COST_RE = re.compile(r"Input Cost:\s*\$(?P<cost>[0-9.]+)")
+_OUT_COST_RE = re.compile(r"Output Cost:\s*\$(?P<cost>[0-9.]+)")
+
+def parse_log_line(line: str) -> Optional[Dict[str, Any]]:
+    """One legacy text-log line as a ledger record (None for lines that do not match)"""
+    m = TOKEN_LINE_RE.search(line)
+    if not m:
+        return None
+    ts = m.group("ts").strip()
+    try:
+        datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    caller = _CALLER_RE.search(line)
+    session = _SESSION_RE.search(line)
+    tier = _TIER_RE.search(line)
+    latency = _LATENCY_RE.search(line)
+    in_cost = _IN_COST_RE.search(line)
+    out_cost = _OUT_COST_RE.search(line)
+    return {
+        "ts": ts,
+        "model": m.group("model").strip(),
+        "caller": caller.group("caller").strip() if caller else None,
+        "session_id": session.group("session").strip() if session else None,
+        "tier": tier.group("tier") if tier else None,
+        "input_tokens": int(m.group("input")),
+        "output_tokens": int(m.group("output")),
+        "cached_input_tokens": int(m.group("cached") or 0),
+        "input_cost": float(in_cost.group("cost")) if in_cost else 0.0,
+        "output_cost": float(out_cost.group("cost")) if out_cost else 0.0,
+        "total_cost": float(m.group("total")),
+        "latency_seconds": float(latency.group("latency")) if latency else None,
+        "source": "import",
+    }
+
+_ROLLUP_UPSERT = """
+    INSERT INTO token_rollup (day, model, tier, requests, input_tokens, output_tokens, cached_input_tokens,
+                              total_cost, latency_sum, latency_count, latency_max)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(day, model, tier) DO UPDATE SET
+        requests = requests + excluded.requests,
+        input_tokens = input_tokens + excluded.input_tokens,
+        output_tokens = output_tokens + excluded.output_tokens,
+        cached_input_tokens = cached_input_tokens + excluded.cached_input_tokens,
+        total_cost = total_cost + excluded.total_cost,
+        latency_sum = latency_sum + excluded.latency_sum,
+        latency_count = latency_count + excluded.latency_count,
+        latency_max = MAX(COALESCE(latency_max, excluded.latency_max), COALESCE(excluded.latency_max, latency_max))
+"""
+
+def _rollup_deltas(rows: List[Tuple]) -> List[Tuple]:
+    """Per day x model x tier sums of a batch of token_usage rows (in _COLUMNS order)"""
+    deltas: Dict[Tuple[str, str, str], List[Any]] = {}
+    for ts, model, caller, _session, tier, inp, out, cached, _ic, _oc, cost, latency, _src in rows:
+        if caller and caller.endswith(_SUMMARY_CALLER_SUFFIX):
+            continue
+        d = deltas.setdefault((ts[:10], model, tier or "direct"), [0, 0, 0, 0, 0.0, 0.0, 0, None])
+        d[0] += 1
+        d[1] += inp or 0
+        d[2] += out or 0
+        d[3] += cached or 0
+        d[4] += cost or 0.0
+        if latency is not None:
+            d[5] += latency
+            d[6] += 1
+            d[7] = latency if d[7] is None else max(d[7], latency)
+    return [key + tuple(values) for key, values in deltas.items()]
+
+def _cache_hit_ratio(cached_tokens: int, input_tokens: int) -> float:
+    """Share of input tokens served from the provider prompt cache (0.0 - 1.0)."""
+    if not input_tokens:
+        return 0.0
+    return round(min(cached_tokens, input_tokens) / input_tokens, 4)
+
+class TokenLedger:
+    def __init__(self, path: str = TOKEN_DB_PATH):
+        self._path = path
+        self._init_lock = threading.Lock()
+        self._ready = False
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=TOKEN_QUEUE_MAX)
+        self._writer: Optional[threading.Thread] = None
+        self._pending = 0
+        self._stats = {"recorded": 0, "written": 0, "dropped": 0, "flushes": 0, "flush_errors": 0,
+                       "imported": 0, "rollup_rebuilds": 0}
+
+    def _get_db(self) -> sqlite3.Connection:
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+                    conn = sqlite3.connect(self._path, timeout=30)
+                    with conn:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS token_usage (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                ts TEXT NOT NULL,
+                                model TEXT NOT NULL,
+                                caller TEXT,
+                                session_id TEXT,
+                                tier TEXT,
+                                input_tokens INTEGER NOT NULL DEFAULT 0,
+                                output_tokens INTEGER NOT NULL DEFAULT 0,
+                                cached_input_tokens INTEGER NOT NULL DEFAULT 0,
+                                input_cost REAL NOT NULL DEFAULT 0,
+                                output_cost REAL NOT NULL DEFAULT 0,
+                                total_cost REAL NOT NULL DEFAULT 0,
+                                latency_seconds REAL,
+                                source TEXT NOT NULL DEFAULT 'live'
+                            )
+                        """)
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_ts ON token_usage(ts)")
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_model ON token_usage(model, ts)")
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_session ON token_usage(session_id)")
+                        conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_caller ON token_usage(caller, ts)")
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS imported_logs (
+                                path TEXT PRIMARY KEY,
+                                lines INTEGER NOT NULL,
+                                imported_at TEXT DEFAULT (datetime('now', 'localtime'))
+                            )
+                        """)
+                        conn.execute("""
+                            CREATE TABLE IF NOT EXISTS token_rollup (
+                                day TEXT NOT NULL,
+                                model TEXT NOT NULL,
+                                tier TEXT NOT NULL,
+                                requests INTEGER NOT NULL DEFAULT 0,
+                                input_tokens INTEGER NOT NULL DEFAULT 0,
+                                output_tokens INTEGER NOT NULL DEFAULT 0,
+                                cached_input_tokens INTEGER NOT NULL DEFAULT 0,
+                                total_cost REAL NOT NULL DEFAULT 0,
+                                latency_sum REAL NOT NULL DEFAULT 0,
+                                latency_count INTEGER NOT NULL DEFAULT 0,
+                                latency_max REAL,
+                                PRIMARY KEY (day, model, tier)
+                            )
+                        """)
+                    if conn.execute("PRAGMA user_version").fetchone()[0] < _ROLLUP_VERSION:
+                        # Ledger written before rollups existed (or by an older rollup version)
+                        self._rebuild_rollups(conn)
+                    conn.close()
+                    self._ready = True
+        conn = sqlite3.connect(self._path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # ---------- writes ----------
+
+    def record(self, entry: Dict[str, Any]) -> bool:
+        """Queue one usage record (costs are filled in by the writer if missing); False if dropped"""
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+                dropped = self._stats["dropped"]
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.error(f"Token usage queue full ({TOKEN_QUEUE_MAX}); {dropped} record(s) dropped so far")
+            return False
+        with self._lock:
+            self._stats["recorded"] += 1
+        return True
+
+    def _ensure_writer(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._run_writer, name="token-ledger-writer", daemon=True)
+                self._writer.start()
+
+    def _run_writer(self) -> None:
+        batch: List[Dict[str, Any]] = []
+        deadline = 0.0
+        while True:
+            timeout = max(deadline - time.monotonic(), 0) if batch else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            waiter = item if isinstance(item, threading.Event) else None
+            stop = item is _STOP
+            if isinstance(item, dict):
+                if not batch:
+                    deadline = time.monotonic() + TOKEN_LEDGER_FLUSH_SECONDS
+                batch.append(item)
+                with self._lock:
+                    self._pending = len(batch)
+            due = len(batch) >= TOKEN_LEDGER_BATCH or time.monotonic() >= deadline
+            if batch and (due or waiter or stop):
+                if self._write(batch):
+                    batch = []
+                elif len(batch) >= TOKEN_QUEUE_MAX or stop:
+                    with self._lock:
+                        self._stats["dropped"] += len(batch)
+                    logger.error(f"Dropped {len(batch)} token usage record(s) that could not be written")
+                    batch = []
+                else:
+                    # Retried with the next batch
+                    deadline = time.monotonic() + TOKEN_LEDGER_FLUSH_SECONDS
+                with self._lock:
+                    self._pending = len(batch)
+            if waiter is not None:
+                waiter.set()
+            if stop:
+                return
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        from token_utils import calculate_token_cost
+        rows = []
+        for entry in batch:
+            if entry.get("total_cost") is None:
+                try:
+                    in_cost, out_cost = calculate_token_cost(entry["model"], entry.get("input_tokens") or 0,
+                                                             entry.get("output_tokens") or 0,
+                                                             entry.get("cached_input_tokens") or 0)
+                except Exception as e:
+                    logger.warning(f"Pricing lookup failed for {entry.get('model')}: {e}")
+                    in_cost, out_cost = 0.0, 0.0
+                entry.update(input_cost=in_cost, output_cost=out_cost, total_cost=in_cost + out_cost)
+            rows.append(tuple(entry.get(c) for c in _COLUMNS[:-1]) + (entry.get("source") or "live",))
+        try:
+            self._insert(rows)
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} token usage record(s): {e}")
+            with self._lock:
+                self._stats["flush_errors"] += 1
+            return False
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["written"] += len(rows)
+        return True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far is written (or timeout)"""
+        if self._writer is None or not self._writer.is_alive():
+            return self._queue.empty()
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Drain the queue and stop the writer (shutdown)"""
+        writer = self._writer
+        if writer is None or not writer.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error("Token usage queue still full at shutdown; unwritten records are lost")
+            return
+        writer.join(timeout)
+        if writer.is_alive():
+            logger.warning(f"Token usage writer did not finish within {timeout}s")
+        else:
+            logger.info("Token usage writer drained and stopped")
+
+    def _insert(self, rows: List[Tuple], conn: Optional[sqlite3.Connection] = None) -> None:
+        if conn is None:
+            with self._get_db() as conn:
+                self._insert(rows, conn)
+            return
+        conn.executemany(
+            f"INSERT INTO token_usage ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})", rows)
+        conn.executemany(_ROLLUP_UPSERT, _rollup_deltas(rows))
+
+    def rebuild_rollups(self) -> int:
+        """Recompute token_rollup from the raw ledger; returns the number of rollup rows"""
+        self.flush()
+        with self._get_db() as conn:
+            return self._rebuild_rollups(conn)
+
+    def _rebuild_rollups(self, conn: sqlite3.Connection) -> int:
+        started = time.perf_counter()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM token_rollup")
+            conn.execute("""
+                INSERT INTO token_rollup (day, model, tier, requests, input_tokens, output_tokens,
+                                          cached_input_tokens, total_cost, latency_sum, latency_count, latency_max)
+                SELECT substr(ts, 1, 10), model, COALESCE(tier, 'direct'), COUNT(*), SUM(input_tokens),
+                       SUM(output_tokens), SUM(cached_input_tokens), SUM(total_cost),
+                       COALESCE(SUM(latency_seconds), 0), COUNT(latency_seconds), MAX(latency_seconds)
+                FROM token_usage WHERE caller IS NULL OR caller NOT LIKE ?
+                GROUP BY 1, 2, 3
+            """, (f"%{_SUMMARY_CALLER_SUFFIX}",))
+            conn.execute(f"PRAGMA user_version = {_ROLLUP_VERSION}")
+            count = conn.execute("SELECT COUNT(*) FROM token_rollup").fetchone()[0]
+        with self._lock:
+            self._stats["rollup_rebuilds"] += 1
+        logger.info(f"Rebuilt {count} token rollup row(s) in {time.perf_counter() - started:.2f}s")
+        return count
+
+    # ---------- legacy text logs ----------
+
+    def import_text_logs(self, directories: Optional[Iterable[str]] = None) -> int:
+        """Load token/*.txt logs; lines imported by an earlier run are skipped"""
+        if directories is None:
+            directories = [os.path.abspath("token"), os.path.join(os.path.dirname(os.path.abspath(__file__)), "token")]
+        imported = 0
+        seen = set()
+        for directory in directories:
+            directory = os.path.abspath(directory)
+            if directory in seen or not os.path.isdir(directory):
+                continue
+            seen.add(directory)
+            for name in sorted(os.listdir(directory)):
+                if name.endswith("_token_usage.txt"):
+                    imported += self._import_file(os.path.join(directory, name))
+        if imported:
+            with self._lock:
+                self._stats["imported"] += imported
+            logger.info(f"Imported {imported} token usage record(s) from text logs")
+        return imported
+
+    def _import_file(self, path: str) -> int:
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                lines = f.readlines()
+        except OSError as e:
+            logger.warning(f"Cannot read token log {path}: {e}")
+            return 0
+        with self._get_db() as conn:
+            # Serializes importers started by several workers at once
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT lines FROM imported_logs WHERE path = ?", (path,)).fetchone()
+            done = row["lines"] if row else 0
+            if done >= len(lines):
+                return 0
+            records = [parse_log_line(line) for line in lines[done:]]
+            rows = [tuple(r[c] for c in _COLUMNS) for r in records if r]
+            # Rows and the new line count commit together, so an interrupted import is not doubled
+            self._insert(rows, conn)
+            conn.execute("INSERT OR REPLACE INTO imported_logs (path, lines) VALUES (?, ?)", (path, len(lines)))
+        return len(rows)
+
+    # ---------- metrics ----------
+
+    def metrics(self, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                group_by: str = "date") -> Dict[str, Any]:
+        """Same response shape as the former log-parsing /admin/metrics/tokens, read from the rollups"""
+        from token_utils import normalize_model_name
+        self.flush()
+        clauses, params = [], []
+        if date_from:
+            clauses.append("day >= ?")
+            params.append(date_from.isoformat())
+        if date_to:
+            clauses.append("day <= ?")
+            params.append(date_to.isoformat())
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        sums = ("SUM(requests) AS n, SUM(input_tokens) AS input, SUM(output_tokens) AS output, "
+                "SUM(cached_input_tokens) AS cached, SUM(total_cost) AS cost")
+        with self._get_db() as conn:
+            s = conn.execute(f"SELECT {sums} FROM token_rollup{where}", params).fetchone()
+            summary = {
+                "total_requests": s["n"] or 0,
+                "total_input_tokens": s["input"] or 0,
+                "total_output_tokens": s["output"] or 0,
+                "total_cached_input_tokens": s["cached"] or 0,
+                "cache_hit_ratio": _cache_hit_ratio(s["cached"] or 0, s["input"] or 0),
+                "total_cost": round(s["cost"] or 0.0, 6),
+            }
+            if group_by == "model":
+                rows = conn.execute(f"SELECT model, {sums} FROM token_rollup{where} GROUP BY model", params).fetchall()
+                # Raw names that map to the same pricing entry are reported together
+                groups: Dict[str, Dict[str, Any]] = {}
+                for r in rows:
+                    k = normalize_model_name(r["model"])
+                    g = groups.setdefault(k, {"input_tokens": 0, "output_tokens": 0, "cached_input_tokens": 0, "cost": 0.0})
+                    g["input_tokens"] += r["input"]
+                    g["output_tokens"] += r["output"]
+                    g["cached_input_tokens"] += r["cached"]
+                    g["cost"] += r["cost"]
+                by_model = [{"model": k, "input_tokens": v["input_tokens"], "output_tokens": v["output_tokens"],
+                             "cached_input_tokens": v["cached_input_tokens"],
+                             "cache_hit_ratio": _cache_hit_ratio(v["cached_input_tokens"], v["input_tokens"]),
+                             "cost": round(v["cost"], 6)} for k, v in groups.items()]
+                return {"summary": summary, "by_model": by_model}
+            if group_by == "tier":
+                # Cost/latency split of the cheap-first cascade; "direct" = calls made without it
+                rows = conn.execute(
+                    f"SELECT tier, {sums}, SUM(latency_sum) AS latency_sum, SUM(latency_count) AS latency_count, "
+                    f"MAX(latency_max) AS latency_max FROM token_rollup{where} GROUP BY tier ORDER BY tier",
+                    params,
+                ).fetchall()
+                by_tier = [{
+                    "tier": r["tier"],
+                    "requests": r["n"],
+                    "input_tokens": r["input"],
+                    "output_tokens": r["output"],
+                    "cached_input_tokens": r["cached"],
+                    "cost": round(r["cost"], 6),
+                    "avg_latency_seconds": round(r["latency_sum"] / r["latency_count"], 3) if r["latency_count"] else None,
+                    "max_latency_seconds": round(r["latency_max"], 3) if r["latency_max"] is not None else None,
+                } for r in rows]
+                return {"summary": summary, "by_tier": by_tier}
+            rows = conn.execute(f"SELECT day, {sums} FROM token_rollup{where} GROUP BY day ORDER BY day", params).fetchall()
+        by_date = [{"date": r["day"], "input_tokens": r["input"], "output_tokens": r["output"],
+                    "cached_input_tokens": r["cached"], "cache_hit_ratio": _cache_hit_ratio(r["cached"], r["input"]),
+                    "cost": round(r["cost"], 6)} for r in rows]
+        return {"summary": summary, "by_date": by_date}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._get_db() as conn:
+            rows = conn.execute("SELECT COUNT(*) FROM token_usage").fetchone()[0]
+            rollup_rows = conn.execute("SELECT COUNT(*) FROM token_rollup").fetchone()[0]
+        with self._lock:
+            stats = dict(self._stats)
+            pending = self._pending
+        return {"path": self._path, "rows": rows, "rollup_rows": rollup_rows,
+                "queue_depth": self._queue.qsize(), "queue_max": TOKEN_QUEUE_MAX, "batch_pending": pending,
+                "writer_alive": bool(self._writer and self._writer.is_alive()),
+                "batch": TOKEN_LEDGER_BATCH, "flush_seconds": TOKEN_LEDGER_FLUSH_SECONDS, **stats}
+
+token_ledger = TokenLedger()
+# Records still queued when the process exits without the app shutdown hook
+atexit.register(token_ledger.stop)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "rebuild-rollups"):
+        print("usage: python token_ledger.py import [directory ...] | rebuild-rollups")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1] == "rebuild-rollups":
+        print(f"Rebuilt {token_ledger.rebuild_rollups()} rollup row(s) in {TOKEN_DB_PATH}")
+    else:
+        count = token_ledger.import_text_logs(sys.argv[2:] or None)
+        print(f"Imported {count} record(s) into {TOKEN_DB_PATH}")
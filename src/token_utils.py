@@ -31,6 +31,7 @@ from typing import Dict, Tuple, Optional
 import re
 import math
 from time import sleep
+from token_ledger import token_ledger
 
 logger = logging.getLogger(__name__)
 
@@ -136,7 +137,7 @@ def _parse_price(val) -> float:
 """
 Cache and normalize model names for pricing table lookups.
 """
-_PRICING_TABLE_CACHE: Tuple[str, Dict[str, Tuple[float, float]]] = ("", {})
+_PRICING_TABLE_CACHE: Tuple[str, Dict[str, Tuple[float, float, Optional[float]]]] = ("", {})
 
 def _get_default_pricing_path() -> str:
     if "PRICING_FILE" in os.environ:
@@ -145,7 +146,7 @@ def _get_default_pricing_path() -> str:
     project_root = os.path.dirname(script_dir)
     return os.path.join(project_root, "mapping", "pricing_model.csv")
 
-def _get_pricing_table() -> Tuple[str, Dict[str, Tuple[float, float]]]:
+def _get_pricing_table() -> Tuple[str, Dict[str, Tuple[float, float, Optional[float]]]]:
     global _PRICING_TABLE_CACHE
     path = _get_default_pricing_path()
     cached_path, cached_table = _PRICING_TABLE_CACHE
@@ -159,7 +160,7 @@ def _canon(s: str) -> str:
     """Case-insensitive, with non-alphanumeric characters removed, used to match different writings (such as differences in case, hyphens, spaces, and periods)."""
     return re.sub(r"[^a-z0-9]", "", (s or "").lower())
 
-def normalize_model_name(model_name: str, pricing_table: Optional[Dict[str, Tuple[float, float]]] = None) -> str:
+def normalize_model_name(model_name: str, pricing_table: Optional[Dict[str, tuple]] = None) -> str:
     """
     Normalize the incoming model name to the standard name in the pricing table:  
     • Case-insensitive, ignoring differences such as hyphens, spaces, and periods  
@@ -175,15 +176,29 @@ def normalize_model_name(model_name: str, pricing_table: Optional[Dict[str, Tupl
             return idx[key]
     return str(model_name).strip()
 
-def _load_pricing_table(csv_path: str) -> Dict[str, Tuple[float, float]]:
+def _parse_optional_price(val) -> Optional[float]:
+    """
+    Like _parse_price, but returns None for empty/None/N/A values so callers can
+    distinguish "no cached price" from "cached price is 0".
+    """
+    if val is None:
+        return None
+    s = str(val).strip()
+    if not s or s.upper() in {"NONE", "N/A"}:
+        return None
+    return _parse_price(s)
+
+def _load_pricing_table(csv_path: str) -> Dict[str, Tuple[float, float, Optional[float]]]:
     """
     Load model pricing from CSV. Expected column names:
       - Model Name
       - Input Cost(1M Tokens)
+      - Cached Input Cost(1M Tokens) (optional)
       - Output Cost(1M Tokens)
-    Returns dict: { model_name: (input_cost_per_million, output_cost_per_million) }
+    Returns dict: { model_name: (input_cost_per_million, output_cost_per_million, cached_input_cost_per_million) }
+    The cached price is None when the model has no discounted cached-input rate.
     """
-    table: Dict[str, Tuple[float, float]] = {}
+    table: Dict[str, Tuple[float, float, Optional[float]]] = {}
     if not os.path.exists(csv_path):
         logger.info(f"Pricing file not found at {csv_path}. Token costs will be 0 by default.")
         return table
@@ -197,16 +212,23 @@ def _load_pricing_table(csv_path: str) -> Dict[str, Tuple[float, float]]:
                     continue
                 in_cost = _parse_price(row.get("Input Cost(1M Tokens)"))
                 out_cost = _parse_price(row.get("Output Cost(1M Tokens)"))
-                table[name] = (in_cost, out_cost)
+                cached_cost = _parse_optional_price(row.get("Cached Input Cost(1M Tokens)"))
+                table[name] = (in_cost, out_cost, cached_cost)
     except Exception as e:
         logger.error(f"Failed to read pricing CSV at {csv_path}: {e}")
     return table
 
-def calculate_token_cost(model_name: str, input_tokens: int, output_tokens: int) -> Tuple[float, float]:
+def calculate_token_cost(model_name: str,
+                         input_tokens: int,
+                         output_tokens: int,
+                         cached_input_tokens: int = 0) -> Tuple[float, float]:
     """
     Calculate input/output costs based on per-million-token price. Price source priority:
       1) Environment variable PRICING_FILE specifies the CSV
       2) Default ./mapping/pricing_model.csv
+    cached_input_tokens is the part of input_tokens served from the provider prompt cache;
+    it is billed at "Cached Input Cost(1M Tokens)" when the model has one, otherwise at the
+    normal input rate.
     If the model or file is not found, returns zero cost and logs a warning.
     """
     if "PRICING_FILE" in os.environ:
@@ -229,45 +251,70 @@ def calculate_token_cost(model_name: str, input_tokens: int, output_tokens: int)
         )
         return 0.0, 0.0
 
-    in_per_million, out_per_million = pricing_table[canon]
-    in_cost = (input_tokens / 1_000_000.0) * in_per_million
+    in_per_million, out_per_million, cached_per_million = pricing_table[canon]
+    cached = max(0, min(int(cached_input_tokens or 0), int(input_tokens or 0)))
+    uncached = max(0, int(input_tokens or 0) - cached)
+    if cached_per_million is None:
+        cached_per_million = in_per_million
+    in_cost = (uncached / 1_000_000.0) * in_per_million + (cached / 1_000_000.0) * cached_per_million
     out_cost = (output_tokens / 1_000_000.0) * out_per_million
     return in_cost, out_cost
 
+def extract_usage_from_response(response) -> Dict[str, int]:
+    """
+    Read provider-reported token usage from a LangChain AIMessage.
+    Returns {"input": int, "output": int, "cached": int}; missing values are 0 so callers
+    can fall back to local tiktoken estimates.
+    """
+    usage = {"input": 0, "output": 0, "cached": 0}
+    if response is None:
+        return usage
+    try:
+        meta = getattr(response, "usage_metadata", None) or {}
+        if meta:
+            usage["input"] = int(meta.get("input_tokens") or 0)
+            usage["output"] = int(meta.get("output_tokens") or 0)
+            details = meta.get("input_token_details") or {}
+            usage["cached"] = int(details.get("cache_read") or 0)
+        # Raw OpenAI payload: usage.prompt_tokens_details.cached_tokens
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        if token_usage:
+            if not usage["input"]:
+                usage["input"] = int(token_usage.get("prompt_tokens") or 0)
+            if not usage["output"]:
+                usage["output"] = int(token_usage.get("completion_tokens") or 0)
+            if not usage["cached"]:
+                prompt_details = token_usage.get("prompt_tokens_details") or {}
+                usage["cached"] = int(prompt_details.get("cached_tokens") or 0)
+    except Exception as e:
+        logger.debug(f"Failed to read usage metadata from response: {e}")
+    return usage
+
 def log_token_usage(model_name: str,
                     input_tokens: int,
                     output_tokens: int,
                     caller_method: str,
-                    session_id: Optional[str] = None) -> None:
+                    session_id: Optional[str] = None,
+                    cached_input_tokens: int = 0,
+                    tier: Optional[str] = None,
+                    latency_seconds: Optional[float] = None) -> None:
     """
-    Write token usage into a daily log file (./token/YYYY-MM-DD_token_usage.txt).
-    Also compute input/output costs and the subtotal.
+    Queue token usage for the token ledger (token_ledger.py, SQLite); its writer thread
+    adds the input/output costs and the subtotal, off the request path.
+    cached_input_tokens (a subset of input_tokens) is billed at the cached-input rate.
+    tier / latency_seconds are recorded for calls routed through the model cascade.
     """
-    now = datetime.now()
-    date_str = now.strftime("%Y-%m-%d")
-    token_folder = "token"
-    if not os.path.exists(token_folder):
-        try:
-            os.makedirs(token_folder)
-            logger.info(f"Successfully created token folder at {token_folder}")
-        except Exception as e:
-            logger.error(f"Failed to create token folder at {token_folder}, error: {str(e)}")
-    log_file = os.path.join(token_folder, f"{date_str}_token_usage.txt")
-
-    in_cost, out_cost = calculate_token_cost(model_name, input_tokens, output_tokens)
-    total_cost = in_cost + out_cost
-    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-    sid = f", Session: {session_id}" if session_id else ""
-
-    line = (
-        f"Timestamp: {timestamp}, Model: {model_name}, "
-        f"Input Tokens: {input_tokens}, Output Tokens: {output_tokens}, "
-        f"Caller Method: {caller_method}{sid}, "
-        f"Input Cost: ${in_cost:.6f}, Output Cost: ${out_cost:.6f}, Total Cost: ${total_cost:.6f}\n"
-    )
-
     try:
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(line)
+        token_ledger.record({
+            "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "model": model_name,
+            "caller": caller_method,
+            "session_id": session_id,
+            "tier": tier,
+            "input_tokens": int(input_tokens or 0),
+            "output_tokens": int(output_tokens or 0),
+            "cached_input_tokens": int(cached_input_tokens or 0),
+            "latency_seconds": float(latency_seconds) if latency_seconds is not None else None,
+        })
     except Exception as e:
-        logger.error(f"Failed to write token usage log: {e}")
\ No newline at end of file
+        logger.error(f"Failed to record token usage: {e}")
\ No newline at end of file
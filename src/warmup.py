@@ -0,0 +1,186 @@
+"""
+Author: Bruce Chen <bruce.chen@effem.com>
+Date: 2025-08-29
+
+Copyright (c) 2025 Mars Corporation
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+Background warm-up of the retrieval / LLM stack.
+
+rag_service pulls in torch, sentence-transformers, langchain and chromadb, resolves (and
+possibly downloads) the embedding model and builds the LLM clients. Nothing that the
+API, login, admin pages or static assets need at startup imports it any more; instead a
+daemon thread loads it right after the server has bound its port:
+
+    rag_service     -> import of rag_service (libraries, chroma client, LLM clients)
+    embedding_model -> one embedding call, so the model weights are loaded
+    knowledge_base  -> pick up a knowledge base published by another worker
+
+Endpoints that need the models call ensure_ready(), which waits up to
+WARMUP_WAIT_SECONDS off the event loop and answers 503 (with Retry-After) if warm-up
+has not finished by then. /readyz and /healthz report the state of each step. With
+WARMUP_ON_STARTUP=false nothing is loaded until the first request needs it.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from fastapi import HTTPException
+
+from startup_profiler import startup_profiler
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ON_STARTUP = (os.environ.get("WARMUP_ON_STARTUP", "true") or "true").strip().lower() not in ("0", "false", "no")
+# How long a request that needs the models waits for warm-up before getting a 503
+WARMUP_WAIT_SECONDS = float(os.environ.get("WARMUP_WAIT_SECONDS", "120") or 120)
+# Minimum seconds before a failed warm-up (e.g. model download error) is attempted again
+WARMUP_RETRY_SECONDS = float(os.environ.get("WARMUP_RETRY_SECONDS", "30") or 30)
+
+PENDING, WARMING, READY, FAILED = "pending", "warming", "ready", "failed"
+
+def _import_rag():
+    import rag_service  # noqa: F401
+
+def _load_embedding_model():
+    import rag_service
+    rag_service.embedding_function(["warm-up"])
+
+def _sync_knowledge_base():
+    import rag_service
+    rag_service.sync_knowledge_base()
+
+_STEPS = [
+    ("rag_service", _import_rag),
+    ("embedding_model", _load_embedding_model),
+    ("knowledge_base", _sync_knowledge_base),
+]
+
+class ModelWarmup:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._state = PENDING
+        self._steps: Dict[str, Dict[str, Any]] = {}
+        self._started: Optional[float] = None
+        self._finished: Optional[float] = None
+        self._error: Optional[str] = None
+        self._attempts = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def failed(self) -> bool:
+        return self._state == FAILED
+
+    def start(self) -> bool:
+        """Start warm-up in a background thread; no-op while running, once ready, or shortly after a failure"""
+        with self._lock:
+            if self._state in (WARMING, READY):
+                return False
+            if self._state == FAILED and time.time() - (self._finished or 0) < WARMUP_RETRY_SECONDS:
+                return False
+            self._state = WARMING
+            self._steps = {name: {"state": PENDING} for name, _ in _STEPS}
+            self._started = time.time()
+            self._finished = None
+            self._error = None
+            self._attempts += 1
+        threading.Thread(target=self._run, name="model-warmup", daemon=True).start()
+        return True
+
+    def _run(self) -> None:
+        logger.info("Warming up retrieval and LLM stack")
+        for name, step in _STEPS:
+            with self._lock:
+                self._steps[name] = {"state": WARMING}
+            t0 = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                elapsed = round(time.perf_counter() - t0, 3)
+                logger.error(f"Warm-up step {name} failed after {elapsed}s: {e}", exc_info=True)
+                with self._lock:
+                    self._steps[name] = {"state": FAILED, "seconds": elapsed, "error": str(e)}
+                    self._state = FAILED
+                    self._error = f"{name}: {e}"
+                    self._finished = time.time()
+                startup_profiler.record_step(f"warmup.{name}", elapsed, error=str(e))
+                startup_profiler.write_report()
+                return
+            elapsed = round(time.perf_counter() - t0, 3)
+            logger.info(f"Warm-up step {name} done in {elapsed}s")
+            startup_profiler.record_step(f"warmup.{name}", elapsed)
+            with self._lock:
+                self._steps[name] = {"state": READY, "seconds": elapsed}
+        with self._lock:
+            self._state = READY
+            self._finished = time.time()
+        self._ready.set()
+        logger.info(f"Warm-up finished in {self._finished - self._started:.2f}s")
+        startup_profiler.write_report()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until warm-up is done (starting it if needed); False on timeout or failure"""
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready.is_set():
+            if self._state == FAILED:
+                return False
+            remaining = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            self._ready.wait(remaining)
+        return True
+
+    async def ensure_ready(self, timeout: float = WARMUP_WAIT_SECONDS) -> None:
+        """For endpoints that need the models: wait for warm-up, else 503"""
+        if self._ready.is_set():
+            return
+        if await asyncio.to_thread(self.wait, timeout):
+            return
+        snap = self.snapshot()
+        if snap["state"] == FAILED:
+            detail = f"Model warm-up failed ({snap['error']}); it is retried automatically"
+        else:
+            detail = "The server is still loading its models; try again shortly"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now = self._finished or time.time()
+            return {
+                "state": self._state,
+                "ready": self._ready.is_set(),
+                "seconds": round(now - self._started, 3) if self._started else None,
+                "attempts": self._attempts,
+                "error": self._error,
+                "steps": {name: dict(info) for name, info in self._steps.items()},
+            }
+
+model_warmup = ModelWarmup()
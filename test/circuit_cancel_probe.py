@@ -0,0 +1,73 @@
+"""
+A session cancelled while its LLM call holds the circuit breaker's half-open probe slot
+must give that slot back; otherwise the breaker stays half-open and rejects every LLM
+call in the process until /admin/llm/circuit/reset.
+
+The cancel is simulated where it happens in practice: while waiting for a limiter slot,
+after llm_breaker.allow_request() has admitted the probe. No LLM backend is needed.
+
+Usage: python test/circuit_cancel_probe.py
+"""
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC)
+
+import rag_service  # noqa: E402
+from cancellation import cancel_registry, bind  # noqa: E402
+from circuit_breaker import llm_breaker, HALF_OPEN, CircuitOpenError  # noqa: E402
+
+def main():
+    # Open the circuit and let the cooldown elapse: the next call is the half-open probe
+    llm_breaker.reset()
+    llm_breaker._trip(time.monotonic(), "test")
+    llm_breaker._opened_at -= llm_breaker._open_seconds
+    if llm_breaker.snapshot()["state"] != HALF_OPEN:
+        print("[FAIL] could not put the breaker into half_open")
+        sys.exit(1)
+
+    token = cancel_registry.register("circuit-cancel-probe", "batch")
+    bind(token)
+
+    @contextmanager
+    def acquire_then_cancel(*_args, **_kwargs):
+        # The user cancels while this call is queued for a slot
+        token.cancel()
+        token.raise_if_cancelled()
+        yield None
+
+    original_acquire = rag_service.llm_limiter.acquire
+    rag_service.llm_limiter.acquire = acquire_then_cancel
+    try:
+        result = rag_service._generate_with_model("probe", "hint", [])
+    finally:
+        rag_service.llm_limiter.acquire = original_acquire
+        bind(None)
+
+    failed = False
+    if result.get("error_type") != "cancelled":
+        failed = True
+        print(f"[FAIL] expected a cancelled result, got {result.get('error_type')}")
+    else:
+        print("[OK] cancelled call returned error_type=cancelled")
+
+    if llm_breaker._probes_in_flight != 0:
+        failed = True
+        print(f"[FAIL] probe slot not released ({llm_breaker._probes_in_flight} in flight)")
+    try:
+        llm_breaker.allow_request()
+        llm_breaker.record_neutral()
+        print("[OK] half-open breaker admits the next probe")
+    except CircuitOpenError:
+        failed = True
+        print("[FAIL] breaker rejects every call after the cancelled probe")
+
+    llm_breaker.reset()
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Import-time budget of the API process (see src/startup_profiler.py).
+
+Runs `python -X importtime -c "import main"` in src/ and fails when
+  - the cumulative import time of main exceeds IMPORT_BUDGET_MS, or
+  - any of DEFERRED_MODULES (torch, chromadb, langchain, pandas, ...) is imported;
+    those belong to the background warm-up, not to server start.
+
+Usage: python test/import_budget.py   (IMPORT_BUDGET_MS=... to override the budget)
+Timings vary between machines; run it twice and look at the second (warm cache) run.
+"""
+
+import os
+import sys
+import subprocess
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC)
+
+from startup_profiler import IMPORT_BUDGET_MS, DEFERRED_MODULES  # noqa: E402
+
+def parse_importtime(stderr: str):
+    """[(module, self_us, cumulative_us, depth)] from -X importtime output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # header line
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(parts[0]), int(parts[1]), depth))
+    return entries
+
+def main():
+    env = dict(os.environ, STARTUP_PROFILE="")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=SRC, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(proc.stderr[-4000:])
+        print("[FAIL] import main raised")
+        sys.exit(1)
+
+    entries = parse_importtime(proc.stderr)
+    main_entry = next((e for e in entries if e[0] == "main"), None)
+    if main_entry is None:
+        print("[FAIL] no importtime entry for main")
+        sys.exit(1)
+    total_ms = main_entry[2] / 1000
+
+    print("[INFO] slowest modules (self time):")
+    for name, self_us, cum_us, _ in sorted(entries, key=lambda e: e[1], reverse=True)[:15]:
+        print(f"    {self_us / 1000:8.1f} ms self {cum_us / 1000:8.1f} ms cumulative  {name}")
+
+    failed = False
+    deferred = sorted({e[0] for e in entries if e[0].split(".")[0] in DEFERRED_MODULES})
+    if deferred:
+        failed = True
+        print(f"[FAIL] deferred modules imported by main: {', '.join(deferred)}")
+    else:
+        print("[OK] no deferred module in the import graph of main")
+    if total_ms > IMPORT_BUDGET_MS:
+        failed = True
+        print(f"[FAIL] import main took {total_ms:.0f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)")
+    else:
+        print(f"[OK] import main took {total_ms:.0f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)")
+
+    if failed:
+        sys.exit(1)
+    print("[DONE] import budget met.")
+
+if __name__ == "__main__":
+    main()
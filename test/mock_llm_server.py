@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Minimal OpenAI-compatible chat completions server for exercising the LLM backend pool.
+# Example pool entry (LLM_BACKENDS):
+#   {"name": "mock", "url": "http://127.0.0.1:8901/v1", "api_key": "test"}
+
+app = FastAPI()
+
+SETTINGS = {
+    "latency": float(os.environ.get("MOCK_LATENCY", "0.5")),
+    "fail_rate": float(os.environ.get("MOCK_FAIL_RATE", "0")),
+    "fail_status": int(os.environ.get("MOCK_FAIL_STATUS", "503")),
+    "answer": os.environ.get("MOCK_ANSWER", "This is a mock answer. No relevant information in the mock backend."),
+}
+STATS = {"requests": 0, "failures": 0}
+
+def _usage(messages, answer):
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+    prompt_tokens = max(1, prompt_chars // 4)
+    completion_tokens = max(1, len(answer) // 4)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    STATS["requests"] += 1
+    await asyncio.sleep(SETTINGS["latency"])
+    if random.random() < SETTINGS["fail_rate"]:
+        STATS["failures"] += 1
+        return JSONResponse(status_code=SETTINGS["fail_status"],
+                            content={"error": {"message": "mock failure", "type": "server_error"}})
+
+    model = body.get("model", "mock")
+    messages = body.get("messages") or []
+    answer = SETTINGS["answer"]
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta, finish_reason=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        async def events():
+            yield f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n"
+            for word in answer.split(" "):
+                yield f"data: {json.dumps(chunk({'content': word + ' '}))}\n\n"
+                await asyncio.sleep(0.01)
+            yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+            if include_usage:
+                usage_chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                               "model": model, "choices": [], "usage": _usage(messages, answer)}
+                yield f"data: {json.dumps(usage_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": _usage(messages, answer),
+    }
+
+@app.get("/stats")
+async def stats():
+    return {**SETTINGS, **STATS}
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM backend")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=SETTINGS["latency"], help="seconds per request")
+    parser.add_argument("--fail-rate", type=float, default=SETTINGS["fail_rate"], help="0.0 - 1.0")
+    parser.add_argument("--fail-status", type=int, default=SETTINGS["fail_status"])
+    args = parser.parse_args()
+    SETTINGS.update(latency=args.latency, fail_rate=args.fail_rate, fail_status=args.fail_status)
+    print(f"[INFO] Mock LLM backend on http://{args.host}:{args.port}/v1 "
+          f"(latency={args.latency}s, fail_rate={args.fail_rate}, fail_status={args.fail_status})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
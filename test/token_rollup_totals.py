@@ -0,0 +1,67 @@
+"""
+Token rollups of one batch (see src/token_ledger.py).
+
+Writes the usage records a batch produces (one per LLM call, cheap and strong tier,
+plus the "batch_query_stream TOTAL" summary row) to a throw-away ledger and checks
+that /admin/metrics/tokens (TokenLedger.metrics) counts every call exactly once:
+the summary row must not add requests, tokens, cost or a "direct" tier. Rebuilding
+the rollups from the raw ledger must give the same numbers.
+
+Usage: python test/token_rollup_totals.py
+"""
+
+import os
+import sys
+import tempfile
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC)
+
+from token_ledger import TokenLedger  # noqa: E402
+
+MODEL = "GPT-4.1"
+TS = "2025-09-01 10:00:00"
+CALLS = [
+    # (tier, input, output, cost)
+    ("cheap", 1000, 200, 0.001),
+    ("cheap", 1200, 150, 0.001),
+    ("strong", 1500, 300, 0.01),
+]
+
+def check(name, actual, expected):
+    if actual != expected:
+        print(f"[FAIL] {name}: {actual} != {expected}")
+        return False
+    print(f"[OK] {name}: {actual}")
+    return True
+
+def main():
+    ledger = TokenLedger(os.path.join(tempfile.mkdtemp(), "token_usage.db"))
+    for tier, inp, out, cost in CALLS:
+        ledger.record({"ts": TS, "model": MODEL, "caller": "generate_ai_response", "session_id": "s1",
+                       "tier": tier, "input_tokens": inp, "output_tokens": out, "cached_input_tokens": 0,
+                       "input_cost": cost, "output_cost": 0.0, "total_cost": cost, "latency_seconds": 1.0})
+    total_in = sum(c[1] for c in CALLS)
+    total_out = sum(c[2] for c in CALLS)
+    total_cost = round(sum(c[3] for c in CALLS), 6)
+    ledger.record({"ts": TS, "model": MODEL, "caller": "batch_query_stream TOTAL", "session_id": "s1",
+                   "input_tokens": total_in, "output_tokens": total_out, "cached_input_tokens": 0,
+                   "input_cost": total_cost, "output_cost": 0.0, "total_cost": total_cost})
+
+    ok = True
+    for label in ("incremental", "rebuilt"):
+        if label == "rebuilt":
+            ledger.rebuild_rollups()
+        summary = ledger.metrics(group_by="date")["summary"]
+        ok &= check(f"{label} requests", summary["total_requests"], len(CALLS))
+        ok &= check(f"{label} input tokens", summary["total_input_tokens"], total_in)
+        ok &= check(f"{label} output tokens", summary["total_output_tokens"], total_out)
+        ok &= check(f"{label} cost", summary["total_cost"], total_cost)
+        tiers = {t["tier"]: t["requests"] for t in ledger.metrics(group_by="tier")["by_tier"]}
+        ok &= check(f"{label} tiers", tiers, {"cheap": 2, "strong": 1})
+
+    ledger.stop()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()